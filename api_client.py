@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import aiohttp
+import openai
+import requests
+from openai.api_requestor import MAX_CONNECTION_RETRIES
+from requests.adapters import HTTPAdapter
+from typing import *
+
+# Default settings of the shared HTTP client, overridden by the 'http' section of the configuration
+DEFAULT_HTTP_CONFIG = {
+    'pool_size': 32,
+    'connect_timeout': 10,
+    'read_timeout': 600,
+    'keepalive_timeout': 60
+}
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_aiohttp_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+
+# Class for the process-wide requests session
+class SharedSession(requests.Session):
+    """
+    Requests session shared by all bot backends for the lifetime of the process.
+
+    The openai module closes its session every few minutes to recycle it; closing is ignored here so the shared
+    connection pool survives. Use close_pool to drop the pooled connections explicitly. The last response received by
+    each thread is kept, so the caller of a streamed request can close its connection, which the openai module does
+    not expose.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.responses = threading.local()
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        """
+        Send a request, keeping its response as the last response of the current thread.
+        """
+        response = super().send(request, **kwargs)
+        self.responses.last = response
+        return response
+
+    def last_response(self) -> Union[requests.Response, None]:
+        """
+        Return the last response received by the current thread, or None.
+        """
+        return getattr(self.responses, 'last', None)
+
+    def close(self):
+        """
+        Do nothing. The openai module calls this every few minutes to recycle its session, which would drop the
+        pooled connections of every bot backend; call close_pool to close them.
+        """
+        pass
+
+    def close_pool(self):
+        """
+        Close all pooled connections.
+        """
+        super().close()
+
+
+# Function to get the HTTP client configuration
+def get_http_config(config: Dict) -> Dict:
+    """
+    This function merges the 'http' section of the configuration with the default HTTP client settings.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    Dict: The HTTP client settings.
+    """
+    return {**DEFAULT_HTTP_CONFIG, **config.get('http', {})}
+
+
+# Function to get the process-wide requests session
+def get_http_session(http_config: Dict) -> SharedSession:
+    """
+    This function returns the requests session shared by all bot backends, creating it on first use. Its connection
+    pool keeps connections to the API alive between turns, so a turn does not pay for a new TLS handshake.
+
+    Parameters:
+    http_config (Dict): The HTTP client settings.
+
+    Returns:
+    SharedSession: The shared session.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = SharedSession()
+                adapter = HTTPAdapter(
+                    pool_connections=http_config['pool_size'],
+                    pool_maxsize=http_config['pool_size'],
+                    max_retries=MAX_CONNECTION_RETRIES
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+
+# Function to get the aiohttp session of the running event loop
+def get_aiohttp_session(http_config: Dict) -> aiohttp.ClientSession:
+    """
+    This function returns the aiohttp session shared by all bot backends on the running event loop, creating it on
+    first use. It must be called from a coroutine.
+
+    Parameters:
+    http_config (Dict): The HTTP client settings.
+
+    Returns:
+    aiohttp.ClientSession: The shared session of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        for other_loop in [other_loop for other_loop in _aiohttp_sessions if other_loop.is_closed()]:
+            del _aiohttp_sessions[other_loop]
+        connector = aiohttp.TCPConnector(
+            limit=http_config['pool_size'],
+            keepalive_timeout=http_config['keepalive_timeout']
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _aiohttp_sessions[loop] = session
+    return session
+
+
+# Function to close the aiohttp session of the running event loop
+async def close_aiohttp_session():
+    """
+    This function closes the aiohttp session of the running event loop, if one was created. Call it before an event
+    loop that made requests is closed.
+    """
+    session = _aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+# Function to build the per-request options of a chat completion
+def request_options(config: Dict, api_settings: Dict) -> Dict:
+    """
+    This function installs the shared requests session in the openai module and returns the keyword arguments that
+    route a request with the given API settings, without changing the global API settings of the openai module.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+    api_settings (Dict): The api_type, api_base, api_version and api_key of the request.
+
+    Returns:
+    Dict: The keyword arguments to pass to openai.ChatCompletion.create.
+    """
+    http_config = get_http_config(config)
+    # The openai module closes the installed session when it recycles it; SharedSession.close ignores this on purpose
+    openai.requestssession = get_http_session(http_config)
+    return {
+        **api_settings,
+        'request_timeout': (http_config['connect_timeout'], http_config['read_timeout'])
+    }
+
+
+# Function to build the per-request options of an asynchronous chat completion
+def arequest_options(config: Dict, api_settings: Dict) -> Dict:
+    """
+    This function is the asynchronous counterpart of request_options. It sets the shared aiohttp session of the
+    running event loop for the current task and returns the keyword arguments to pass to openai.ChatCompletion.acreate.
+    It must be called from a coroutine.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+    api_settings (Dict): The api_type, api_base, api_version and api_key of the request.
+
+    Returns:
+    Dict: The keyword arguments to pass to openai.ChatCompletion.acreate.
+    """
+    http_config = get_http_config(config)
+    openai.aiosession.set(get_aiohttp_session(http_config))
+    return {
+        **api_settings,
+        'request_timeout': (http_config['connect_timeout'], http_config['read_timeout'])
+    }
@@ -1,31 +1,38 @@
 import json
-import openai
 import os
-import copy
+import sys
+import threading
 import shutil
+import uuid
 from typing import *
-
-
-
-# functions = [
-#     {
-#         "name": "execute_code",
-#         "description": "This function allows you to execute ##worker_language## code and retrieve the terminal output. If the code "
-#                        "generates image output, the function will return the text '[image]'. The code is sent to a "
-#                        "Jupyter kernel for execution. The kernel will remain active after execution, retaining all "
-#                        "variables in memory.",
-#         "parameters": {
-#             "type": "object",
-#             "properties": {
-#                 "code": {
-#                     "type": "string",
-#                     "description": "The code text"
-#                 }
-#             },
-#             "required": ["code"],
-#         }
-#     }
-# ]
+from stream_parser import IncrementalCodeParser
+from token_window import window_conversation
+from messages import *
+from jupyter_backend import get_code_execution_config, get_kernel_pool
+from image_store import get_image_store
+
+
+
+# Define the functions the bot can call when code execution is enabled
+functions = [
+    {
+        "name": "execute_code",
+        "description": "This function allows you to execute Python code and retrieve the terminal output. If the code "
+                       "generates image output, the function will return the text '[image]'. The code is sent to a "
+                       "Jupyter kernel for execution. The kernel will remain active after execution, retaining all "
+                       "variables in memory.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "code": {
+                    "type": "string",
+                    "description": "The code text"
+                }
+            },
+            "required": ["code"],
+        }
+    }
+]
 
 # Define the system message for the bot
 system_msg ='''Act as Professor Synapse🧙🏾‍♂️, a conductor of expert agents. Your job is to support me in accomplishing my goals by finding alignment with me, then calling upon an expert agent perfectly suited to the task by initializing:
@@ -60,25 +67,55 @@ Rules:
 -🧙🏾‍♂️, recommend save after each task is completed
 '''
 
-# Load the configuration from the json file
-with open('config.json') as f:
-    config = json.load(f)
+# Record of the system message, shared by the conversations of all sessions
+system_message = Message(ROLE_SYSTEM, system_msg)
+
+# Path of the configuration file, unless the WIZTALK_CONFIG environment variable is set
+CONFIG_PATH = 'config.json'
+
+_config = None
+_config_lock = threading.Lock()
+
 
-# If the API key is not in the configuration, get it from the environment variables
-if not config['API_KEY']:
-    config['API_KEY'] = os.getenv('OPENAI_API_KEY')
-    os.unsetenv('OPENAI_API_KEY')
+# Function to load the configuration
+def load_config(path: str = None) -> Dict:
+    """
+    This function loads the configuration dictionary from a JSON file. If the API key is not in the configuration, it
+    is taken from the OPENAI_API_KEY environment variable, which is then unset.
+
+    Parameters:
+    path (str): The path of the JSON file. Defaults to the WIZTALK_CONFIG environment variable, or CONFIG_PATH.
+
+    Returns:
+        dict: The configuration dictionary.
+    """
+    if path is None:
+        path = os.getenv('WIZTALK_CONFIG', CONFIG_PATH)
+    with open(path) as f:
+        config = json.load(f)
+
+    # If the API key is not in the configuration, get it from the environment variables
+    if not config['API_KEY']:
+        config['API_KEY'] = os.getenv('OPENAI_API_KEY')
+        os.unsetenv('OPENAI_API_KEY')
+    return config
 
 
 # Function to get the configuration
 def get_config():
     """
-    This function returns the configuration dictionary loaded from the JSON file.
+    This function returns the configuration dictionary, loading it from the JSON file on first use, so importing the
+    package neither reads files nor touches the environment variables.
 
     Returns:
         dict: The configuration dictionary.
     """
-    return config
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = load_config()
+    return _config
 
 
 # Function to configure the OpenAI API
@@ -95,57 +132,169 @@ def config_openai_api(api_type, api_base, api_version, api_key):
     Returns:
     None
     """
+    import openai
+
     openai.api_type = api_type
     openai.api_base = api_base
     openai.api_version = api_version
     openai.api_key = api_key
 
 
+# Class to snapshot the chat history when a function call starts
+class HistorySnapshot:
+    """
+    Copy-on-write view of the chat history taken when a function call starts.
+
+    Only the last row, the one the function call is rendered into, is copied. Restoring the snapshot drops any rows
+    added after it was taken and rewrites the last row, so the cost does not depend on the length of the conversation.
+    """
+
+    def __init__(self, history: List):
+        """
+        Take a snapshot of the history.
+
+        Parameters:
+        history (List): The chat history shown in the UI.
+        """
+        self.history = history
+        self.length = len(history)
+        self.last_row = list(history[-1]) if history else None
+
+    def restore(self, suffix: str = '') -> List:
+        """
+        Restore the history to the snapshot and append a suffix to the bot message of the last row.
+
+        Parameters:
+        suffix (str): The text to append to the bot message of the last row.
+
+        Returns:
+        List: The restored history.
+        """
+        del self.history[self.length:]
+        if self.last_row is not None:
+            last_row = list(self.last_row)
+            last_row[1] += suffix
+            self.history[-1] = last_row
+        return self.history
+
+
+# Class to accumulate streamed text
+class ChunkBuffer:
+    """
+    Append-only accumulator for streamed text.
+
+    Fragments are kept in a list, so adding one costs the same however long the text already is. The full string is
+    only joined when it is read, and the result is cached until the next fragment arrives.
+    """
+
+    __slots__ = ('_fragments', '_length', '_value')
+
+    def __init__(self, value: str = ''):
+        """
+        Initialize the buffer.
+
+        Parameters:
+        value (str): The initial text of the buffer.
+        """
+        self._fragments: List[str] = [value] if value else []
+        self._length = len(value)
+        self._value = value
+
+    def append(self, fragment: str):
+        """
+        Append a fragment to the buffer.
+
+        Parameters:
+        fragment (str): The fragment to append.
+        """
+        if fragment:
+            self._fragments.append(fragment)
+            self._length += len(fragment)
+            self._value = None
+
+    def getvalue(self) -> str:
+        """
+        Return the accumulated text, joining the pending fragments if needed.
+
+        Returns:
+        str: The accumulated text.
+        """
+        if self._value is None:
+            self._value = ''.join(self._fragments)
+            self._fragments = [self._value]
+        return self._value
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return self.getvalue()
+
+
 # Class to log the responses from the GPT model
 class GPTResponseLog:
+    __slots__ = ('assistant_role_name', '_content_buffer', 'function_name', '_function_args_buffer',
+                 'function_args_parser', 'display_code_block', 'finish_reason', 'bot_history', 'content_row')
+
+    # Default values of the attributes holding immutable values, set again on every reset
+    defaults = (('assistant_role_name', ''), ('function_name', None), ('display_code_block', ''),
+                ('finish_reason', 'stop'), ('bot_history', None), ('content_row', None))
+
     def __init__(self):
         """
         Initialize the GPTResponseLog class with default values.
         """
-        self.assistant_role_name = ''
-        self.content = ''
-        self.function_name = None
-        self.function_args_str = ''
-        self.display_code_block = ''
-        self.finish_reason = 'stop'
-        self.bot_history = None
+        self.function_args_parser = IncrementalCodeParser()
+        self.reset_gpt_response_log_values()
 
-    def reset_gpt_response_log_values(self, exclude=None):
+    @property
+    def content(self) -> str:
+        """
+        The content received so far, materialized from the content buffer.
         """
-        Reset the log values to their default values, excluding the attributes specified.
+        return self._content_buffer.getvalue()
 
-        Parameters:
-        exclude (list): A list of attribute names to exclude from resetting.
+    @content.setter
+    def content(self, content: str):
+        self._content_buffer = ChunkBuffer(content)
+
+    @property
+    def function_args_str(self) -> str:
         """
-        if exclude is None:
-            exclude = []
+        The function arguments received so far, materialized from the function arguments buffer.
+        """
+        return self._function_args_buffer.getvalue()
 
-        attributes = {'assistant_role_name': '',
-                      'content': '',
-                      'function_name': None,
-                      'function_args_str': '',
-                      'display_code_block': '',
-                      'finish_reason': 'stop',
-                      'bot_history': None}
+    @function_args_str.setter
+    def function_args_str(self, function_args_str: str):
+        self._function_args_buffer = ChunkBuffer(function_args_str)
 
-        for attr_name in exclude:
-            del attributes[attr_name]
-        for attr_name, value in attributes.items():
-            setattr(self, attr_name, value)
+    def reset_gpt_response_log_values(self, exclude=()):
+        """
+        Reset the log values to their default values, excluding the attributes specified. The buffers are only created
+        for the attributes that are reset, and the code parser is created once and reset in place afterwards.
+
+        Parameters:
+        exclude (list): A list of attribute names to exclude from resetting.
+        """
+        for attr_name, value in self.defaults:
+            if attr_name not in exclude:
+                setattr(self, attr_name, value)
+        if 'content' not in exclude:
+            self._content_buffer = ChunkBuffer()
+        if 'function_args_str' not in exclude:
+            self._function_args_buffer = ChunkBuffer()
+        if 'function_args_parser' not in exclude:
+            self.function_args_parser.reset()
 
     def set_assistant_role_name(self, assistant_role_name: str):
         """
-        Set the assistant role name.
+        Set the assistant role name, interned so the messages of the assistant share it.
 
         Parameters:
         assistant_role_name (str): The assistant role name to set.
         """
-        self.assistant_role_name = assistant_role_name
+        self.assistant_role_name = sys.intern(assistant_role_name)
 
     def add_content(self, content: str):
         """
@@ -154,7 +303,23 @@ class GPTResponseLog:
         Parameters:
         content (str): The content to add.
         """
-        self.content += content
+        self._content_buffer.append(content)
+
+    def set_content_row(self, content_row: List):
+        """
+        Set the history row that displays the content.
+
+        Parameters:
+        content_row (List): The history row whose bot message shows the content.
+        """
+        self.content_row = content_row
+
+    def sync_content_row(self):
+        """
+        Write the content received so far into the history row that displays it.
+        """
+        if self.content_row is not None:
+            self.content_row[1] = self.content
 
     def set_function_name(self, function_name: str):
         """
@@ -167,21 +332,22 @@ class GPTResponseLog:
 
     def copy_current_bot_history(self, bot_history: List):
         """
-        Copy the current bot history to the log.
+        Take a copy-on-write snapshot of the current bot history.
 
         Parameters:
-        bot_history (List): The bot history to copy.
+        bot_history (List): The bot history to snapshot.
         """
-        self.bot_history = copy.deepcopy(bot_history)
+        self.bot_history = HistorySnapshot(bot_history)
 
     def add_function_args_str(self, function_args_str: str):
         """
-        Add function arguments to the log.
+        Add function arguments to the log and feed them to the incremental code parser.
 
         Parameters:
         function_args_str (str): The function arguments to add.
         """
-        self.function_args_str += function_args_str
+        self._function_args_buffer.append(function_args_str)
+        self.function_args_parser.feed(function_args_str)
 
     def update_display_code_block(self, display_code_block):
         """
@@ -214,34 +380,39 @@ class BotBackend(GPTResponseLog):
         Initializes the BotBackend instance.
         """
         super().__init__()
-        self.unique_id = hash(id(self))
-        self.gpt_model_choice = "GPT-4"
+        self.unique_id = uuid.uuid4().hex
+        # Position of the conversation in the session store log, and number of its messages already saved there
+        self.store_cursor = [0, 1]
+        # Whether a turn of the bot is running, so the session manager does not evict the bot backend meanwhile
+        self.in_turn = False
+        self.worker_language_choice = "python"
         self._init_conversation()
         self._init_api_config()
+        self.gpt_model_choice = self.config['model'].get('default', "GPT-4")
         self._init_kwargs_for_chat_completion()
 
     def _init_conversation(self):
         """
-        Initializes the conversation with a system message.
+        Initializes the conversation with the system message shared by all sessions.
         """
-        system_msg_now = system_msg
-        first_system_msg = {'role': 'system', 'content': system_msg_now}
         if hasattr(self, 'conversation'):
             self.conversation.clear()
-            self.conversation.append(first_system_msg)
+            self.conversation.append(system_message)
         else:
-            self.conversation: List[Dict] = [first_system_msg]
+            self.conversation: List[Message] = [system_message]
 
     def _init_api_config(self):
         """
-        Initializes the API configuration.
+        Initializes the API configuration. The settings are kept on the instance and passed with every request,
+        so the global state of the openai module is left untouched.
         """
         self.config = get_config()
-        api_type = self.config['API_TYPE']
-        api_base = self.config['API_base']
-        api_version = self.config['API_VERSION']
-        api_key = config['API_KEY']
-        config_openai_api(api_type, api_base, api_version, api_key)
+        self.api_settings = {
+            'api_type': self.config['API_TYPE'],
+            'api_base': self.config['API_base'],
+            'api_version': self.config['API_VERSION'],
+            'api_key': self.config['API_KEY']
+        }
 
     def _init_kwargs_for_chat_completion(self):
         """
@@ -259,20 +430,56 @@ class BotBackend(GPTResponseLog):
         else:
             self.kwargs_for_chat_completion['model'] = model_name
 
+        if get_code_execution_config(self.config)['enabled']:
+            self.kwargs_for_chat_completion['functions'] = functions
+
+    def windowed_conversation(self) -> List[Message]:
+        """
+        Returns the messages of the conversation to send, fitted into the context budget of the chosen model.
+        """
+        model_config = self.config['model'][self.gpt_model_choice]
+        return window_conversation(
+            conversation=self.conversation,
+            model_name=model_config['model_name'],
+            budget=model_config.get('context_budget')
+        )
+
     def add_gpt_response_content_message(self):
         """
         Adds a response content message to the conversation.
         """
         self.conversation.append(
-            {'role': self.assistant_role_name, 'content': self.content}
+            Message(self.assistant_role_name, self.content)
         )
 
+    def add_function_call_response_message(self, function_response: str):
+        """
+        Adds the function call made by GPT and the response of the function to the conversation.
+        """
+        self.conversation.append(
+            Message(self.assistant_role_name, None,
+                    function_call={'name': self.function_name, 'arguments': self.function_args_str})
+        )
+        self.conversation.append(
+            Message(ROLE_FUNCTION, function_response, name=self.function_name)
+        )
+
+    def execute_code(self, code: str) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Executes code in the Jupyter kernel leased to this bot backend.
+        Returns the text to send back to GPT and the outputs to display.
+        """
+        kernel_pool = get_kernel_pool(self.config)
+        if kernel_pool is None:
+            raise RuntimeError('Code execution is disabled in the configuration')
+        return kernel_pool.execute(unique_id=self.unique_id, code=code)
+
     def add_text_message(self, user_text):
         """
         Adds a text message from the user to the conversation.
         """
         self.conversation.append(
-            {'role': 'user', 'content': user_text}
+            Message(ROLE_USER, user_text)
         )
         self.update_finish_reason(finish_reason='new_input')
 
@@ -283,6 +490,46 @@ class BotBackend(GPTResponseLog):
         self.gpt_model_choice = model_choice
         self._init_kwargs_for_chat_completion()
 
+    def _clear_all_files_in_work_dir(self):
+        """
+        Releases the Jupyter kernel leased to this bot backend, removes its work directory and its image directory.
+        """
+        kernel_pool = get_kernel_pool(self.config)
+        if kernel_pool is not None:
+            kernel_pool.release(unique_id=self.unique_id)
+        get_image_store(self.config).remove_session(unique_id=self.unique_id)
+
+    def close(self):
+        """
+        Ends the session of the bot backend by releasing its Jupyter kernel and removing its files.
+        """
+        self._clear_all_files_in_work_dir()
+
+    def to_state(self) -> Dict:
+        """
+        Returns the state needed to rehydrate the bot backend later, as a JSON-serializable dictionary.
+        """
+        return {
+            'unique_id': self.unique_id,
+            'gpt_model_choice': self.gpt_model_choice,
+            'conversation': to_api_messages(self.conversation)
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'BotBackend':
+        """
+        Creates a bot backend from a state returned by to_state, or by the session store, which adds its store_cursor.
+        """
+        bot_backend = cls()
+        bot_backend.unique_id = state['unique_id']
+        bot_backend.store_cursor = list(state.get('store_cursor', (0, 1)))
+        bot_backend.conversation[:] = [Message.from_dict(message) for message in state['conversation']]
+        # Share the system message record with the other sessions instead of keeping the decoded copy
+        if bot_backend.conversation and bot_backend.conversation[0] == system_message:
+            bot_backend.conversation[0] = system_message
+        bot_backend.update_gpt_model_choice(state['gpt_model_choice'])
+        return bot_backend
+
     def restart(self):
         """
         Restarts the bot backend by clearing all files in the work directory,
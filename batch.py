@@ -0,0 +1,302 @@
+from wiztalk_ui import *
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Function to read the conversations of a batch
+def load_conversations(path: str) -> List[Dict]:
+    """
+    This function reads the conversations of a batch from a JSONL file. Each line is a JSON object with an id, under
+    'request_id' or 'id', and either a 'messages' list of user messages sent in turn, or a single message under 'body'
+    (with its 'title' on a first line if there is one), like the lines of requests.jsonl. A 'model' key selects the
+    model entry of the conversation.
+
+    Parameters:
+    path (str): The path of the JSONL file.
+
+    Returns:
+    List[Dict]: The conversations, each with its 'id', its 'messages' and its 'model' or None.
+    """
+    conversations = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'messages' in record:
+                messages = [message if isinstance(message, str) else message['content'] for message in record['messages']]
+            else:
+                messages = ['\n\n'.join(part for part in (record.get('title'), record['body']) if part)]
+            conversations.append({
+                'id': str(record.get('request_id', record.get('id', line_number))),
+                'messages': messages,
+                'model': record.get('model')
+            })
+    return conversations
+
+
+# Function to read the finished conversations of an interrupted batch
+def load_finished_ids(output_path: str) -> Set[str]:
+    """
+    This function reads the ids of the conversations already answered without error in an output file, so a batch
+    can be resumed. A line cut off by a crash is ignored.
+
+    Parameters:
+    output_path (str): The path of the output JSONL file.
+
+    Returns:
+    Set[str]: The ids of the finished conversations.
+    """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('error') is None:
+                finished.add(record['id'])
+    return finished
+
+
+# Class to write the results of a batch
+class ResultWriter:
+    """
+    Appends the result of each conversation to the output JSONL file as soon as it finishes.
+    """
+
+    def __init__(self, output_path: str):
+        """
+        Open the output file for appending, ending a line cut off by a crash first.
+
+        Parameters:
+        output_path (str): The path of the output JSONL file.
+        """
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(output_path, 'a+', encoding='utf-8')
+        self.lock = threading.Lock()
+        if self.file.tell() > 0:
+            self.file.seek(self.file.tell() - 1)
+            if self.file.read(1) != '\n':
+                self.file.write('\n')
+
+    def write(self, result: Dict):
+        """
+        Write the result of a conversation as a line of the output.
+
+        Parameters:
+        result (Dict): The result to write.
+        """
+        line = json.dumps(result, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        """
+        Close the output file.
+        """
+        self.file.close()
+
+
+# Function to start a conversation
+def start_conversation(conversation: Dict) -> BotBackend:
+    """
+    This function creates the bot backend of a conversation, outside of the session manager of the UI.
+
+    Parameters:
+    conversation (Dict): The conversation.
+
+    Returns:
+    BotBackend: The bot backend.
+    """
+    bot_backend = BotBackend()
+    if conversation['model'] is not None:
+        bot_backend.update_gpt_model_choice(conversation['model'])
+    return bot_backend
+
+
+# Function to collect the replies of a turn
+def turn_replies(bot_backend: BotBackend, start: int) -> str:
+    """
+    This function joins the replies of the assistant added to the conversation since a turn started.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend.
+    start (int): The length of the conversation when the turn started.
+
+    Returns:
+    str: The replies of the turn.
+    """
+    return '\n\n'.join(
+        message.content for message in bot_backend.conversation[start:]
+        if message.role == ROLE_ASSISTANT and message.content
+    )
+
+
+# Function to build the result of a conversation
+def conversation_result(conversation: Dict, bot_backend: BotBackend, replies: List[str], start: float,
+                        error: Union[BaseException, None]) -> Dict:
+    """
+    This function builds the result written for a conversation.
+
+    Parameters:
+    conversation (Dict): The conversation.
+    bot_backend (BotBackend): The bot backend that ran it.
+    replies (List[str]): The replies of the turns that finished.
+    start (float): The time the conversation started.
+    error (BaseException): The error that stopped the conversation, or None.
+
+    Returns:
+    Dict: The id, the model, the messages and replies of each turn, the duration and the error of the conversation.
+    """
+    return {
+        'id': conversation['id'],
+        'model': bot_backend.gpt_model_choice,
+        'turns': [{'message': message, 'reply': reply} for message, reply in zip(conversation['messages'], replies)],
+        'duration_s': round(time.perf_counter() - start, 3),
+        'error': None if error is None else repr(error)
+    }
+
+
+# Function to run a conversation
+def run_conversation(conversation: Dict, use_cache: bool = False) -> Dict:
+    """
+    This function sends the messages of a conversation in turn, running each turn with run_bot as the UI does.
+
+    Parameters:
+    conversation (Dict): The conversation.
+    use_cache (bool): Whether the replies may be answered from, and stored in, the response cache.
+
+    Returns:
+    Dict: The result of the conversation.
+    """
+    start = time.perf_counter()
+    bot_backend = start_conversation(conversation)
+    replies, error = [], None
+    try:
+        for message in conversation['messages']:
+            turn_start = len(bot_backend.conversation)
+            bot_backend.add_text_message(user_text=message)
+            for _ in run_bot(bot_backend=bot_backend, history=[[message, None]], use_cache=use_cache):
+                pass
+            replies.append(turn_replies(bot_backend, turn_start))
+    except Exception as e:
+        error = e
+    finally:
+        bot_backend.close()
+    return conversation_result(conversation, bot_backend, replies, start, error)
+
+
+# Function to run a conversation asynchronously
+async def arun_conversation(conversation: Dict, use_cache: bool = False) -> Dict:
+    """
+    This function is the asynchronous counterpart of run_conversation, running each turn with arun_bot.
+
+    Parameters:
+    conversation (Dict): The conversation.
+    use_cache (bool): Whether the replies may be answered from, and stored in, the response cache.
+
+    Returns:
+    Dict: The result of the conversation.
+    """
+    start = time.perf_counter()
+    bot_backend = start_conversation(conversation)
+    replies, error = [], None
+    try:
+        for message in conversation['messages']:
+            turn_start = len(bot_backend.conversation)
+            bot_backend.add_text_message(user_text=message)
+            async for _ in arun_bot(bot_backend=bot_backend, history=[[message, None]], use_cache=use_cache):
+                pass
+            replies.append(turn_replies(bot_backend, turn_start))
+    except Exception as e:
+        error = e
+    finally:
+        bot_backend.close()
+    return conversation_result(conversation, bot_backend, replies, start, error)
+
+
+# Function to run a batch
+def run_batch(input_path: str, output_path: str, concurrency: int = 8, use_async: bool = False,
+              use_cache: bool = False) -> Dict:
+    """
+    This function runs the conversations of a JSONL file with at most `concurrency` of them at once, and appends the
+    result of each to the output JSONL file as soon as it finishes. Conversations already answered without error in
+    the output file are skipped, so a batch interrupted by a crash is resumed by running it again.
+
+    Parameters:
+    input_path (str): The path of the JSONL file of conversations.
+    output_path (str): The path of the output JSONL file.
+    concurrency (int): The maximum number of conversations run at once.
+    use_async (bool): Whether to run the conversations with arun_bot on one event loop instead of one thread each.
+    use_cache (bool): Whether the replies may be answered from, and stored in, the response cache. Off by default, so
+    every conversation of a batch is really sent.
+
+    Returns:
+    Dict: The number of conversations run, skipped and failed, and the duration of the batch.
+    """
+    finished = load_finished_ids(output_path)
+    pending = [conversation for conversation in load_conversations(input_path) if conversation['id'] not in finished]
+    writer = ResultWriter(output_path)
+    errors = []
+    start = time.perf_counter()
+
+    def write(result: Dict):
+        writer.write(result)
+        if result['error'] is not None:
+            errors.append(result['id'])
+
+    try:
+        if use_async:
+            async def run_all():
+                from api_client import close_aiohttp_session
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def run_one(conversation):
+                    async with semaphore:
+                        write(await arun_conversation(conversation, use_cache=use_cache))
+
+                try:
+                    await asyncio.gather(*(run_one(conversation) for conversation in pending))
+                finally:
+                    await close_aiohttp_session()
+
+            asyncio.run(run_all())
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+                futures = [executor.submit(run_conversation, conversation, use_cache) for conversation in pending]
+                for future in as_completed(futures):
+                    write(future.result())
+    finally:
+        writer.close()
+    return {
+        'conversations': len(pending),
+        'skipped': len(finished),
+        'errors': len(errors),
+        'duration_s': time.perf_counter() - start
+    }
+
+
+# Main function
+if __name__ == '__main__':
+    """
+    This is the main function that gets executed when the script is run directly.
+    It runs a batch of conversations without the UI and prints a summary.
+    """
+    parser = argparse.ArgumentParser(description='Run conversations from a JSONL file without the UI')
+    parser.add_argument('input', help='JSONL file of conversations')
+    parser.add_argument('--out', required=True, help='JSONL file the results are appended to, and resumed from')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of conversations run at once')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='run the conversations with arun_bot')
+    parser.add_argument('--use-cache', action='store_true', help='answer repeated requests from the response cache')
+    args = parser.parse_args()
+
+    summary = run_batch(input_path=args.input, output_path=args.out, concurrency=args.concurrency,
+                        use_async=args.use_async, use_cache=args.use_cache)
+    print(json.dumps(summary))
@@ -0,0 +1,315 @@
+from parse_response import *
+import argparse
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+
+# Function to benchmark the accumulation of a long streamed reply
+def benchmark_content(num_tokens: int = 10000, num_buckets: int = 10, token: str = 'lorem ') -> List[Dict]:
+    """
+    This function streams a long synthetic reply through the response log and parse_response, and measures the average
+    cost per token for consecutive buckets of tokens. A flat profile means the cost of a token does not depend on the
+    length of the reply received so far.
+
+    Parameters:
+    num_tokens (int): The number of tokens in the reply.
+    num_buckets (int): The number of buckets the reply is split into.
+    token (str): The text of every token.
+
+    Returns:
+    List[Dict]: One dictionary per bucket with the average nanoseconds per token for each measured path.
+    """
+    bucket_size = max(num_tokens // num_buckets, 1)
+
+    # Attribute concatenation plus a copy into the history row, as the response log used to do
+    legacy_log = argparse.Namespace(content='')
+    legacy_row = [None, '']
+    concat_times = []
+    for _ in range(num_tokens):
+        start = time.perf_counter_ns()
+        legacy_log.content += token
+        legacy_row[1] = legacy_log.content
+        concat_times.append(time.perf_counter_ns() - start)
+    concatenated = legacy_row[1]
+
+    # The response log alone
+    response_log = GPTResponseLog()
+    add_content_times = []
+    for _ in range(num_tokens):
+        start = time.perf_counter_ns()
+        response_log.add_content(content=token)
+        add_content_times.append(time.perf_counter_ns() - start)
+    assert response_log.content == concatenated
+
+    # Full chunk parsing with the history row written only once at the end
+    bot_backend = BotBackend()
+    history = [[None, '']]
+    chunk = {'choices': [{'delta': {'content': token}, 'finish_reason': None}]}
+    parse_times = []
+    for _ in range(num_tokens):
+        start = time.perf_counter_ns()
+        history, _ = parse_response(chunk=chunk, history=history, bot_backend=bot_backend, sync_history=False)
+        parse_times.append(time.perf_counter_ns() - start)
+    bot_backend.sync_content_row()
+    assert history[-1][1] == concatenated
+
+    results = []
+    for bucket_start in range(0, num_tokens, bucket_size):
+        bucket_end = min(bucket_start + bucket_size, num_tokens)
+        count = bucket_end - bucket_start
+        results.append({
+            'tokens': f'{bucket_start}-{bucket_end}',
+            'legacy_concat_ns': sum(concat_times[bucket_start:bucket_end]) / count,
+            'add_content_ns': sum(add_content_times[bucket_start:bucket_end]) / count,
+            'parse_response_ns': sum(parse_times[bucket_start:bucket_end]) / count,
+        })
+    return results
+
+
+# Function to build a synthetic stream of chunks
+def synthetic_stream(num_content_chunks: int = 2000, num_argument_chunks: int = 0, token: str = 'lorem ') -> List[Dict]:
+    """
+    This function builds a stream of chunks shaped like the ones returned by the chat completion API: a role chunk,
+    content chunks, optionally a function call with its argument chunks, and a finish chunk.
+
+    Parameters:
+    num_content_chunks (int): The number of content chunks.
+    num_argument_chunks (int): The number of function call argument chunks. No function call is made if it is 0.
+    token (str): The text of every content chunk.
+
+    Returns:
+    List[Dict]: The chunks of the stream.
+    """
+    chunks = [{'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]}]
+    for _ in range(num_content_chunks):
+        chunks.append({'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]})
+    if num_argument_chunks:
+        chunks.append({'choices': [{'index': 0, 'delta': {
+            'content': None, 'function_call': {'name': 'execute_code', 'arguments': ''}
+        }, 'finish_reason': None}]})
+        chunks.append({'choices': [{'index': 0, 'delta': {'function_call': {'arguments': '{"code": "'}},
+                                    'finish_reason': None}]})
+        for _ in range(num_argument_chunks):
+            chunks.append({'choices': [{'index': 0, 'delta': {'function_call': {'arguments': 'x = 1\\n'}},
+                                        'finish_reason': None}]})
+        chunks.append({'choices': [{'index': 0, 'delta': {'function_call': {'arguments': '"}'}},
+                                    'finish_reason': None}]})
+    else:
+        chunks.append({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+    return chunks
+
+
+# Function to benchmark the per-chunk cost of parse_response
+def benchmark_dispatch(num_content_chunks: int = 2000, num_argument_chunks: int = 2000, repeat: int = 5) -> List[Dict]:
+    """
+    This function replays synthetic streams through parse_response with a fresh bot backend and measures the average
+    cost per chunk, keeping the best of several runs.
+
+    Parameters:
+    num_content_chunks (int): The number of content chunks in the content stream.
+    num_argument_chunks (int): The number of argument chunks in the function call stream.
+    repeat (int): The number of runs per stream.
+
+    Returns:
+    List[Dict]: One dictionary per stream with the number of chunks and the best nanoseconds per chunk.
+    """
+    streams = {
+        'content': synthetic_stream(num_content_chunks=num_content_chunks),
+        'function_call': synthetic_stream(num_content_chunks=10, num_argument_chunks=num_argument_chunks),
+    }
+    results = []
+    for name, chunks in streams.items():
+        best = None
+        for _ in range(repeat):
+            bot_backend = BotBackend()
+            history = [[None, '']]
+            start = time.perf_counter_ns()
+            for chunk in chunks:
+                history, _ = parse_response(chunk=chunk, history=history, bot_backend=bot_backend, sync_history=False)
+            elapsed = (time.perf_counter_ns() - start) / len(chunks)
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'stream': name, 'chunks': len(chunks), 'ns_per_chunk': best})
+    return results
+
+
+# Function to benchmark the memory held by sessions
+def benchmark_session_memory(sessions: int = 1000, turns: int = 100, reply_chunks: int = 20) -> List[Dict]:
+    """
+    This function builds many sessions with long histories, streaming each reply through parse_response from chunks
+    decoded from JSON as they are received from the API, and measures the memory they hold with tracemalloc.
+
+    Parameters:
+    sessions (int): The number of sessions.
+    turns (int): The number of turns of each session, each adding a message of the user and a reply.
+    reply_chunks (int): The number of content chunks of each reply.
+
+    Returns:
+    List[Dict]: One dictionary with the sessions, the messages per session and the bytes held per session and per
+    message.
+    """
+    words = 'the goal plan expert agent step data model result value stream token code python test measure'.split()
+    stream_json = json.dumps(
+        [{'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]}]
+        + [{'choices': [{'index': 0, 'delta': {'content': f' {words[index % len(words)]}'}, 'finish_reason': None}]}
+           for index in range(reply_chunks)]
+        + [{'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}]
+    )
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        bot_backends = []
+        for session in range(sessions):
+            bot_backend = BotBackend()
+            for turn in range(turns):
+                bot_backend.add_text_message(user_text=f'Session {session}, turn {turn}: what is the next step?')
+                history = [[None, '']]
+                for chunk in json.loads(stream_json):
+                    history, _ = parse_response(chunk=chunk, history=history, bot_backend=bot_backend, sync_history=False)
+            bot_backends.append(bot_backend)
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    messages = len(bot_backends[0].conversation)
+    return [{
+        'sessions': sessions,
+        'messages_per_session': messages,
+        'bytes_per_session': held / sessions,
+        'bytes_per_message': held / sessions / messages
+    }]
+
+
+# Function to benchmark the import time of the modules
+def benchmark_imports(modules: List[str] = None, repeat: int = 5) -> List[Dict]:
+    """
+    This function imports each module in a fresh interpreter and measures how long the import takes, so the cost of
+    the import chain is measured without anything already cached in the process.
+
+    Parameters:
+    modules (List[str]): The names of the modules to import.
+    repeat (int): The number of fresh interpreters started for each module.
+
+    Returns:
+    List[Dict]: One dictionary per module with the median and minimum import time in milliseconds.
+    """
+    modules = modules or ['stream_parser', 'backend', 'parse_response', 'wiztalk_ui']
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'],
+                cwd=package_dir
+            )
+            times.append(float(output) * 1000)
+        rows.append({'import': module, 'median_ms': statistics.median(times), 'min_ms': min(times)})
+    return rows
+
+
+# Function to benchmark the time until the UI serves its first request
+def benchmark_ui_startup(repeat: int = 3, timeout: float = 60) -> List[Dict]:
+    """
+    This function starts the Gradio UI in a fresh interpreter and measures the time until it answers its first HTTP
+    request.
+
+    Parameters:
+    repeat (int): The number of times the UI is started.
+    timeout (float): The number of seconds to wait for the UI before giving up.
+
+    Returns:
+    List[Dict]: One dictionary with the median and minimum time to first request in milliseconds.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        env = {**os.environ, 'GRADIO_SERVER_PORT': str(port), 'BROWSER': 'true'}
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, 'wiztalk_ui.py'], cwd=package_dir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while True:
+                if time.perf_counter() - start > timeout or process.poll() is not None:
+                    raise RuntimeError('The UI did not start')
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1):
+                        break
+                except OSError:
+                    time.sleep(0.01)
+            times.append((time.perf_counter() - start) * 1000)
+        finally:
+            process.terminate()
+            process.wait()
+    return [{'measurement': 'time to first request', 'median_ms': statistics.median(times), 'min_ms': min(times)}]
+
+
+# Function to print benchmark results as a table
+def print_table(rows: List[Dict]):
+    """
+    This function prints a list of dictionaries sharing the same keys as an aligned table.
+
+    Parameters:
+    rows (List[Dict]): The rows to print.
+    """
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    cells = [[f'{row[column]:.1f}' if isinstance(row[column], float) else str(row[column]) for column in columns]
+             for row in rows]
+    widths = [max(len(column), *(len(line[index]) for line in cells)) for index, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print('  '.join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+# Main function
+if __name__ == '__main__':
+    """
+    This is the main function that gets executed when the script is run directly.
+    It runs the selected benchmark and prints its results.
+    """
+    parser = argparse.ArgumentParser(description='WizTalk micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    content_parser = subparsers.add_parser('content', help='per-token cost of accumulating a long streamed reply')
+    content_parser.add_argument('--tokens', type=int, default=10000)
+    content_parser.add_argument('--buckets', type=int, default=10)
+
+    dispatch_parser = subparsers.add_parser('dispatch', help='per-chunk cost of parse_response on replayed streams')
+    dispatch_parser.add_argument('--content-chunks', type=int, default=2000)
+    dispatch_parser.add_argument('--argument-chunks', type=int, default=2000)
+
+    startup_parser = subparsers.add_parser('startup', help='import time of the modules and time to first UI request')
+    startup_parser.add_argument('--repeat', type=int, default=5)
+    startup_parser.add_argument('--skip-ui', action='store_true')
+
+    memory_parser = subparsers.add_parser('memory', help='memory held by many sessions with long histories')
+    memory_parser.add_argument('--sessions', type=int, default=1000)
+    memory_parser.add_argument('--turns', type=int, default=100)
+
+    args = parser.parse_args()
+    if args.benchmark == 'content':
+        print_table(benchmark_content(num_tokens=args.tokens, num_buckets=args.buckets))
+    elif args.benchmark == 'dispatch':
+        print_table(benchmark_dispatch(
+            num_content_chunks=args.content_chunks, num_argument_chunks=args.argument_chunks
+        ))
+    elif args.benchmark == 'memory':
+        print_table(benchmark_session_memory(sessions=args.sessions, turns=args.turns))
+    elif args.benchmark == 'startup':
+        print_table(benchmark_imports(repeat=args.repeat))
+        if not args.skip_ui:
+            print()
+            print_table(benchmark_ui_startup())
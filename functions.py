@@ -1,30 +1,210 @@
 from backend import *
-import base64
+from response_cache import get_response_cache
+from metrics import get_metrics
+from model_router import get_model_router
+from rate_limiter import request_admission
+from single_flight import get_single_flight
+from image_store import get_image_store
 import time
 
 
-def chat_completion(bot_backend: BotBackend):
+def prepare_chat_completion(bot_backend: BotBackend, messages: List[Message] = None) -> Dict:
     """
-    Completes a chat using the provided bot backend.
+    Prepares the arguments of a chat completion request.
 
-    This function uses the bot backend to complete a chat. It first checks if the chosen model is available for the 
-    API key in the configuration. If the model is available, it creates a chat completion using the arguments provided 
-    in the bot backend.
+    This function checks if the chosen model is available for the API key in the configuration, and returns the
+    arguments provided in the bot backend with the messages to send: the conversation fitted into the context budget
+    of the model, unless other messages are given. The message records are converted to the dictionaries of the API
+    here, so the conversation never holds them.
 
     Parameters:
     bot_backend (BotBackend): The bot backend to use for the chat completion.
+    messages (List[Message]): The messages to send instead of the conversation of the bot backend.
 
     Returns:
-    openai.ChatCompletion: The response from the chat completion.
+    Dict: The arguments of the chat completion request.
     """
     model_choice = bot_backend.gpt_model_choice
     config = bot_backend.config
-    kwargs_for_chat_completion = bot_backend.kwargs_for_chat_completion
 
     assert config['model'][model_choice]['available'], f"{model_choice} is not available for your API key"
 
-    response = openai.ChatCompletion.create(**kwargs_for_chat_completion)
-    return response
+    if messages is None:
+        messages = bot_backend.windowed_conversation()
+    return {**bot_backend.kwargs_for_chat_completion, 'messages': to_api_messages(messages)}
+
+
+def lookup_response_cache(config: Dict, kwargs_for_chat_completion: Dict, use_cache: bool):
+    """
+    Looks up a chat completion request in the response cache.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+    kwargs_for_chat_completion (Dict): The arguments of the chat completion request.
+    use_cache (bool): Whether this request may be answered from, and stored in, the response cache.
+
+    Returns:
+    Tuple[ResponseCache, str, List[Dict]]: The response cache, the cache key and the cached chunks. The cache and the key
+    are None if the cache is not used, and the chunks are None if the response is not cached.
+    """
+    response_cache = get_response_cache(config) if use_cache else None
+    if response_cache is None:
+        return None, None, None
+    cache_key = response_cache.make_key(kwargs_for_chat_completion)
+    return response_cache, cache_key, response_cache.get(cache_key)
+
+
+def admit_chat_completion(bot_backend: BotBackend, kwargs_for_chat_completion: Dict, use_cache: bool = True):
+    """
+    Queues a chat completion request with the rate limiter of its model, unless it will be answered from the response
+    cache or share the stream of an identical request in flight, neither of which is sent.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend sending the request.
+    kwargs_for_chat_completion (Dict): The arguments of the request, as returned by prepare_chat_completion.
+    use_cache (bool): Whether this request may be answered from the response cache.
+
+    Returns:
+    Ticket: The ticket of the request, or None if the request does not wait for the rate limiter. The request must then
+    be sent with admitted=False, so it still waits for the rate limiter if it is sent after all.
+    """
+    response_cache = get_response_cache(bot_backend.config) if use_cache else None
+    if response_cache is not None and response_cache.contains(response_cache.make_key(kwargs_for_chat_completion)):
+        return None
+    return request_admission(bot_backend=bot_backend, kwargs_for_chat_completion=kwargs_for_chat_completion)
+
+
+def observe_time_to_first_chunk(bot_backend: BotBackend, seconds: float):
+    """
+    Reports the time to first chunk of a chat completion to the model router, if routing is enabled.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend that sent the chat completion.
+    seconds (float): The time from sending the request to receiving its first chunk.
+    """
+    model_router = get_model_router(bot_backend.config)
+    if model_router is not None:
+        model_router.observe(model_choice=bot_backend.gpt_model_choice, seconds=seconds, unique_id=bot_backend.unique_id)
+
+
+def chat_completion(bot_backend: BotBackend, use_cache: bool = True, messages: List[Message] = None,
+                    admitted: bool = False, kwargs_for_chat_completion: Dict = None):
+    """
+    Completes a chat using the provided bot backend.
+
+    This function uses the bot backend to complete a chat. It creates a chat completion using the arguments prepared by
+    prepare_chat_completion, and sends it to the endpoints of the model over the shared pooled HTTP session, retrying
+    transient failures and hedging slow requests as set in the 'retry' section of the configuration. If an
+    identical request was already answered, the cached response is replayed as a stream of chunks instead.
+    Otherwise the request first waits for its turn within the requests and tokens per minute of the model, unless the
+    caller already did. A streamed request identical to one in flight shares its stream instead of being sent again.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend to use for the chat completion.
+    use_cache (bool): Whether this request may be answered from, and stored in, the response cache.
+    messages (List[Message]): The messages to send instead of the conversation of the bot backend.
+    admitted (bool): Whether the caller already waited for the rate limiter of the model.
+    kwargs_for_chat_completion (Dict): The arguments already prepared by prepare_chat_completion, if any.
+
+    Returns:
+    openai.ChatCompletion: The response from the chat completion.
+    """
+    config = bot_backend.config
+    if kwargs_for_chat_completion is None:
+        kwargs_for_chat_completion = prepare_chat_completion(bot_backend=bot_backend, messages=messages)
+
+    response_cache, cache_key, cached_chunks = lookup_response_cache(
+        config=config, kwargs_for_chat_completion=kwargs_for_chat_completion, use_cache=use_cache
+    )
+    if cached_chunks is not None:
+        return response_cache.replay(cached_chunks)
+
+    # The OpenAI client is imported on the first request, so importing this module stays fast
+    from resilient_client import ResilientCompletion, get_endpoints
+
+    def open_stream():
+        if not admitted:
+            ticket = request_admission(
+                bot_backend=bot_backend, kwargs_for_chat_completion=kwargs_for_chat_completion, check_in_flight=False
+            )
+            if ticket is not None:
+                ticket.wait()
+        start = time.perf_counter()
+        response = ResilientCompletion(
+            config=config, kwargs_for_chat_completion=kwargs_for_chat_completion,
+            endpoints=get_endpoints(
+                config=config, model_choice=bot_backend.gpt_model_choice, api_settings=bot_backend.api_settings
+            ),
+            metrics=get_metrics(config), metric_labels={'model': bot_backend.gpt_model_choice}
+        ).create()
+        observe_time_to_first_chunk(bot_backend=bot_backend, seconds=time.perf_counter() - start)
+        if response_cache is not None:
+            response = response_cache.record(cache_key, response)
+        return response
+
+    # Share the stream of an identical request in flight, or send the request and let identical ones share it
+    single_flight = get_single_flight(config)
+    if single_flight is None or not kwargs_for_chat_completion.get('stream'):
+        return open_stream()
+    return single_flight.stream(kwargs_for_chat_completion=kwargs_for_chat_completion, open_stream=open_stream)
+
+
+async def achat_completion(bot_backend: BotBackend, use_cache: bool = True, messages: List[Message] = None,
+                           admitted: bool = False, kwargs_for_chat_completion: Dict = None):
+    """
+    Completes a chat using the provided bot backend without blocking the event loop.
+
+    This function is the asynchronous counterpart of chat_completion. It creates the chat completion with
+    openai.ChatCompletion.acreate, so many streams can be served concurrently on a single event loop.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend to use for the chat completion.
+    use_cache (bool): Whether this request may be answered from, and stored in, the response cache.
+    messages (List[Message]): The messages to send instead of the conversation of the bot backend.
+    admitted (bool): Whether the caller already waited for the rate limiter of the model.
+    kwargs_for_chat_completion (Dict): The arguments already prepared by prepare_chat_completion, if any.
+
+    Returns:
+    AsyncGenerator: The streamed response from the chat completion.
+    """
+    config = bot_backend.config
+    if kwargs_for_chat_completion is None:
+        kwargs_for_chat_completion = prepare_chat_completion(bot_backend=bot_backend, messages=messages)
+
+    # A response cached on disk is read in a worker thread, so the event loop is not blocked
+    import asyncio
+    response_cache, cache_key, cached_chunks = await asyncio.to_thread(
+        lookup_response_cache, config=config, kwargs_for_chat_completion=kwargs_for_chat_completion, use_cache=use_cache
+    )
+    if cached_chunks is not None:
+        return response_cache.areplay(cached_chunks)
+
+    from resilient_client import ResilientCompletion, get_endpoints
+
+    async def open_stream():
+        if not admitted:
+            ticket = request_admission(
+                bot_backend=bot_backend, kwargs_for_chat_completion=kwargs_for_chat_completion, check_in_flight=False
+            )
+            if ticket is not None:
+                await ticket.await_admission()
+        start = time.perf_counter()
+        response = await ResilientCompletion(
+            config=config, kwargs_for_chat_completion=kwargs_for_chat_completion,
+            endpoints=get_endpoints(
+                config=config, model_choice=bot_backend.gpt_model_choice, api_settings=bot_backend.api_settings
+            ),
+            metrics=get_metrics(config), metric_labels={'model': bot_backend.gpt_model_choice}
+        ).acreate()
+        observe_time_to_first_chunk(bot_backend=bot_backend, seconds=time.perf_counter() - start)
+        if response_cache is not None:
+            response = response_cache.arecord(cache_key, response)
+        return response
+
+    single_flight = get_single_flight(config)
+    if single_flight is None or not kwargs_for_chat_completion.get('stream'):
+        return await open_stream()
+    return await single_flight.astream(kwargs_for_chat_completion=kwargs_for_chat_completion, open_stream=open_stream)
 
 
 def add_function_response_to_bot_history(content_to_display, history, unique_id):
@@ -33,6 +213,8 @@ def add_function_response_to_bot_history(content_to_display, history, unique_id)
 
     This function separates the content to display into text and images and adds them to the history.
     If an error occurs during the execution of the function, it is indicated in the history.
+    Images are named after their content and written to the session directory by the image store in the background;
+    the UI waits for their writes before showing the history.
 
     Parameters:
     content_to_display (list): A list of tuples where each tuple contains a mark and a string. The mark indicates the type of the string (e.g., 'stdout', 'execute_result_text', 'display_text', 'execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg', 'error').
@@ -62,21 +244,20 @@ def add_function_response_to_bot_history(content_to_display, history, unique_id)
     else:
         history.append([None, f'✔️Terminal output:\n```shell\n{text}\n```'])
 
-    # image output
+    # image output, written to disk in the background
+    image_store = get_image_store(get_config())
+    metrics = get_metrics(get_config())
+    start = time.perf_counter()
     for filetype, img in images:
-        image_bytes = base64.b64decode(img)
-        temp_path = f'cache/temp_{unique_id}'
-        if not os.path.exists(temp_path):
-            os.mkdir(temp_path)
-        path = f'{temp_path}/{hash(time.time())}.{filetype}'
-        with open(path, 'wb') as f:
-            f.write(image_bytes)
+        path = image_store.save(unique_id=unique_id, filetype=filetype, image_base64=img)
         history.append(
             [
                 None,
                 f'<img src=\"file={path}\" style=\'width: 600px; max-width:none; max-height:none\'>'
             ]
         )
+    if metrics is not None and images:
+        metrics.observe('wiztalk_image_save_seconds', time.perf_counter() - start)
 
 
 def parse_json(function_args: str, finished: bool) -> Union[str, None]:
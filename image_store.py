@@ -0,0 +1,243 @@
+import base64
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import *
+from metrics import get_metrics
+
+# Default settings of the image store, overridden by the 'image_store' section of the configuration
+DEFAULT_IMAGE_STORE_CONFIG = {
+    'directory': 'cache',
+    'max_bytes': 200 * 1024 * 1024
+}
+
+# File extensions of the stored images
+IMAGE_EXTENSIONS = ('.png', '.jpg')
+
+_image_store = None
+_image_store_lock = threading.Lock()
+
+
+# Class for the image output store
+class ImageStore:
+    """
+    Content-addressed store of the images output by executed code.
+
+    An image is named after the hash of its content and saved under the directory of its session, so a plot output
+    twice in a session is written once. Saving returns the path immediately and leaves decoding and writing to a
+    background thread, so the chat turn never waits for the disk; the UI waits for the pending writes of a session
+    before showing their paths. The total size of the stored images is bounded, and the least recently used images
+    are deleted once it is exceeded.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, config: Dict):
+        """
+        Initialize the store, index the images already on disk and start the writer thread.
+
+        Parameters:
+        directory (str): The directory containing the session directories.
+        max_bytes (int): The maximum total size of the stored images in bytes.
+        config (Dict): The configuration dictionary, used to find the metrics registry.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.config = config
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.writes: Dict[str, Future] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.tasks = queue.Queue()
+
+        if os.path.isdir(self.directory):
+            entries = []
+            for session_dir in os.scandir(self.directory):
+                if not (session_dir.is_dir() and session_dir.name.startswith('temp_')):
+                    continue
+                for entry in os.scandir(session_dir.path):
+                    if entry.is_file() and entry.name.endswith(IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        entries.append((stat.st_atime, entry.path, stat.st_size))
+            for _, path, size in sorted(entries):
+                self.files[path] = size
+                self.total_bytes += size
+
+        writer = threading.Thread(target=self._write_forever, name='image-store-writer', daemon=True)
+        writer.start()
+
+    def session_dir(self, unique_id) -> str:
+        """
+        Return the directory of the images of a session.
+
+        Parameters:
+        unique_id: The unique id of the bot backend of the session.
+
+        Returns:
+        str: The directory of the session.
+        """
+        return f'{self.directory}/temp_{unique_id}'
+
+    def save(self, unique_id, filetype: str, image_base64: str) -> str:
+        """
+        Queue a base64 encoded image to be written, unless the same image is already stored for the session, and
+        return the path it is written to. The write can be waited for with pending_writes.
+
+        Parameters:
+        unique_id: The unique id of the bot backend of the session.
+        filetype (str): The file extension of the image, 'png' or 'jpg'.
+        image_base64 (str): The base64 encoded image.
+
+        Returns:
+        str: The path of the image.
+        """
+        digest = hashlib.sha256(image_base64.encode('ascii')).hexdigest()
+        path = f'{self.session_dir(unique_id)}/{digest}.{filetype}'
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+                return path
+            size = len(image_base64) * 3 // 4
+            self.files[path] = size
+            self.total_bytes += size
+            future = self.writes[path] = Future()
+            self.tasks.put(('write', path, image_base64, future))
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                evicted_path, evicted_size = self.files.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.tasks.put(('delete', evicted_path))
+        return path
+
+    def pending_writes(self, unique_id) -> List[Future]:
+        """
+        Return the futures of the queued writes of a session, resolved once their image is on disk.
+
+        Parameters:
+        unique_id: The unique id of the bot backend of the session.
+
+        Returns:
+        List[Future]: The futures of the writes not done yet.
+        """
+        prefix = self.session_dir(unique_id) + '/'
+        with self.lock:
+            return [future for path, future in self.writes.items() if path.startswith(prefix)]
+
+    def remove_session(self, unique_id):
+        """
+        Queue the removal of the directory of a session, after the images already queued for it are written.
+
+        Parameters:
+        unique_id: The unique id of the bot backend of the session.
+        """
+        session_dir = self.session_dir(unique_id)
+        prefix = session_dir + '/'
+        with self.lock:
+            for path in [path for path in self.files if path.startswith(prefix)]:
+                self.total_bytes -= self.files.pop(path)
+            self.tasks.put(('remove_session', session_dir))
+
+    def flush(self):
+        """
+        Wait until every queued write, deletion and removal has been done.
+        """
+        self.tasks.join()
+
+    def stats(self) -> Dict:
+        """
+        Return the number and total size of the stored images and the number of pending tasks.
+
+        Returns:
+        Dict: The store statistics.
+        """
+        with self.lock:
+            return {'images': len(self.files), 'bytes': self.total_bytes, 'pending': self.tasks.qsize()}
+
+    def _write_forever(self):
+        """
+        Run the queued writes, deletions and session removals.
+        """
+        while True:
+            action, path, *args = self.tasks.get()
+            try:
+                if action == 'write':
+                    self._write(path, args[0])
+                elif action == 'delete':
+                    self._delete(path)
+                elif action == 'remove_session':
+                    shutil.rmtree(path, ignore_errors=True)
+            except Exception:
+                pass
+            finally:
+                if action == 'write':
+                    future = args[1]
+                    with self.lock:
+                        if self.writes.get(path) is future:
+                            del self.writes[path]
+                    future.set_result(path)
+                self.tasks.task_done()
+
+    def _write(self, path: str, image_base64: str):
+        """
+        Decode an image and write it atomically, unless it was evicted or its session removed in the meantime.
+
+        Parameters:
+        path (str): The path of the image.
+        image_base64 (str): The base64 encoded image.
+        """
+        with self.lock:
+            if path not in self.files:
+                return
+        metrics = get_metrics(self.config)
+        start = time.perf_counter()
+        image_bytes = base64.b64decode(image_base64)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(temp_path, path)
+        if metrics is not None:
+            metrics.observe('wiztalk_image_write_seconds', time.perf_counter() - start)
+        with self.lock:
+            if path in self.files:
+                self.total_bytes += len(image_bytes) - self.files[path]
+                self.files[path] = len(image_bytes)
+
+    def _delete(self, path: str):
+        """
+        Delete an evicted image, unless it was saved again since it was evicted.
+
+        Parameters:
+        path (str): The path of the image.
+        """
+        with self.lock:
+            if path in self.files:
+                return
+            os.remove(path)
+
+
+# Function to get the process-wide image store
+def get_image_store(config: Dict) -> ImageStore:
+    """
+    This function returns the image store shared by all bot backends, creating it on first use from the 'image_store'
+    section of the configuration.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    ImageStore: The shared image store.
+    """
+    global _image_store
+    if _image_store is None:
+        with _image_store_lock:
+            if _image_store is None:
+                image_store_config = {**DEFAULT_IMAGE_STORE_CONFIG, **config.get('image_store', {})}
+                _image_store = ImageStore(
+                    directory=image_store_config['directory'],
+                    max_bytes=image_store_config['max_bytes'],
+                    config=config
+                )
+    return _image_store
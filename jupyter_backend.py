@@ -0,0 +1,413 @@
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from typing import *
+
+# Default settings of the code execution backend, overridden by the 'code_execution' section of the configuration
+DEFAULT_CODE_EXECUTION_CONFIG = {
+    'enabled': False,
+    'kernel_name': 'python3',
+    'max_kernels': 8,
+    'prewarm_kernels': 2,
+    'idle_timeout': 900,
+    'execution_timeout': 120,
+    'startup_timeout': 60,
+    'max_output_chars': 2000,
+    'work_directory': 'cache/work'
+}
+
+# Seconds to wait for an interrupted execution to stop
+INTERRUPT_GRACE_PERIOD = 10
+
+# Escape sequences used by IPython to color tracebacks
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+_kernel_pool = None
+_kernel_pool_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+# Function to get the code execution configuration
+def get_code_execution_config(config: Dict) -> Dict:
+    """
+    This function merges the 'code_execution' section of the configuration with the default settings.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    Dict: The code execution settings.
+    """
+    return {**DEFAULT_CODE_EXECUTION_CONFIG, **config.get('code_execution', {})}
+
+
+# Class for a running Jupyter kernel
+class JupyterKernel:
+    """
+    A Jupyter kernel started by the kernel pool, with a blocking client connected to it.
+    """
+
+    def __init__(self, kernel_name: str, work_dir: str, startup_timeout: float):
+        """
+        Start the kernel and wait until it is ready.
+
+        Parameters:
+        kernel_name (str): The name of the kernel spec to start.
+        work_dir (str): The working directory of the kernel.
+        startup_timeout (float): The maximum number of seconds to wait for the kernel to be ready.
+        """
+        from jupyter_client import KernelManager
+
+        os.makedirs(work_dir, exist_ok=True)
+        self.kernel_manager = KernelManager(kernel_name=kernel_name)
+        self.kernel_manager.start_kernel(cwd=work_dir)
+        self.kernel_client = self.kernel_manager.client()
+        self.kernel_client.start_channels()
+        try:
+            self.kernel_client.wait_for_ready(timeout=startup_timeout)
+        except RuntimeError:
+            self.shutdown()
+            raise
+        self.lock = threading.Lock()
+
+    def execute(self, code: str, timeout: float) -> List[Tuple[str, str]]:
+        """
+        Execute code in the kernel and collect its outputs.
+
+        Parameters:
+        code (str): The code to execute.
+        timeout (float): The maximum number of seconds the execution may take before the kernel is interrupted.
+
+        Returns:
+        List[Tuple[str, str]]: The outputs as (mark, string) tuples, with the marks expected by
+        functions.add_function_response_to_bot_history.
+        """
+        content_to_display = []
+        with self.lock:
+            msg_id = self.kernel_client.execute(code)
+            deadline = time.monotonic() + timeout
+            interrupted = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if interrupted:
+                        content_to_display.append(('error', 'The kernel did not respond after being interrupted.'))
+                        break
+                    self.kernel_manager.interrupt_kernel()
+                    content_to_display.append(('error', f'Execution timed out after {timeout} seconds.'))
+                    interrupted = True
+                    deadline = time.monotonic() + INTERRUPT_GRACE_PERIOD
+                    continue
+                try:
+                    message = self.kernel_client.get_iopub_msg(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if message['parent_header'].get('msg_id') != msg_id:
+                    continue
+                msg_type = message['msg_type']
+                content = message['content']
+                if msg_type == 'status' and content['execution_state'] == 'idle':
+                    break
+                elif msg_type == 'stream':
+                    content_to_display.append(('stdout', content['text']))
+                elif msg_type in ('execute_result', 'display_data'):
+                    prefix = 'execute_result' if msg_type == 'execute_result' else 'display'
+                    data = content['data']
+                    if 'image/png' in data:
+                        content_to_display.append((f'{prefix}_png', data['image/png']))
+                    elif 'image/jpeg' in data:
+                        content_to_display.append((f'{prefix}_jpeg', data['image/jpeg']))
+                    elif 'text/plain' in data:
+                        content_to_display.append((f'{prefix}_text', data['text/plain']))
+                elif msg_type == 'error':
+                    traceback = _ANSI_ESCAPE.sub('', '\n'.join(content['traceback']))
+                    content_to_display.append(('error', traceback))
+        return content_to_display
+
+    def shutdown(self):
+        """
+        Stop the client channels and shut the kernel down.
+        """
+        try:
+            self.kernel_client.stop_channels()
+        finally:
+            self.kernel_manager.shutdown_kernel(now=True)
+
+
+# Class for a kernel leased to a bot backend
+class KernelLease:
+    """
+    A kernel leased to one bot backend, with the time it was last used.
+    """
+
+    def __init__(self, kernel: JupyterKernel, work_dir: str):
+        """
+        Initialize the lease.
+
+        Parameters:
+        kernel (JupyterKernel): The leased kernel.
+        work_dir (str): The working directory of the bot backend.
+        """
+        self.kernel = kernel
+        self.work_dir = work_dir
+        self.last_used = time.monotonic()
+
+
+# Class for the pool of Jupyter kernels
+class KernelPool:
+    """
+    Pool of Jupyter kernels executing the code of the execute_code function.
+
+    A few kernels are started ahead of time, so a bot backend gets a ready kernel on its first code call instead of
+    waiting for one to start. Each kernel is leased to a single bot backend, identified by its unique_id, and keeps its
+    variables between calls. Leases that have not been used for idle_timeout seconds are reaped, and the number of
+    kernels, started or starting, never exceeds max_kernels.
+    """
+
+    def __init__(self, code_execution_config: Dict):
+        """
+        Initialize the pool and start pre-warming kernels.
+
+        Parameters:
+        code_execution_config (Dict): The code execution settings.
+        """
+        self.kernel_name = code_execution_config['kernel_name']
+        self.max_kernels = code_execution_config['max_kernels']
+        self.prewarm_kernels = code_execution_config['prewarm_kernels']
+        self.idle_timeout = code_execution_config['idle_timeout']
+        self.execution_timeout = code_execution_config['execution_timeout']
+        self.startup_timeout = code_execution_config['startup_timeout']
+        self.max_output_chars = code_execution_config['max_output_chars']
+        self.work_directory = code_execution_config['work_directory']
+
+        self.idle_kernels: List[JupyterKernel] = []
+        self.leases: Dict[Any, KernelLease] = {}
+        self.starting = 0
+        self.start_failures = 0
+        self.start_error: Union[BaseException, None] = None
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self._refill()
+        reaper = threading.Thread(target=self._reap_forever, name='kernel-pool-reaper', daemon=True)
+        reaper.start()
+
+    def work_dir(self, unique_id) -> str:
+        """
+        Return the working directory of a bot backend.
+
+        Parameters:
+        unique_id: The unique id of the bot backend.
+
+        Returns:
+        str: The working directory.
+        """
+        return os.path.join(self.work_directory, str(unique_id))
+
+    def lease(self, unique_id) -> JupyterKernel:
+        """
+        Return the kernel leased to a bot backend, leasing a pre-warmed kernel on its first call.
+
+        Parameters:
+        unique_id: The unique id of the bot backend.
+
+        Returns:
+        JupyterKernel: The kernel leased to the bot backend.
+
+        Raises:
+        RuntimeError: If no kernel becomes available within the startup timeout, or if a kernel failed to start while
+        waiting for one, chained to the startup error.
+        """
+        with self.condition:
+            lease = self.leases.get(unique_id)
+            if lease is not None:
+                lease.last_used = time.monotonic()
+                return lease.kernel
+
+            deadline = time.monotonic() + self.startup_timeout
+            start_failures = self.start_failures
+            while not self.idle_kernels:
+                if self.start_failures > start_failures:
+                    raise RuntimeError(f'The Jupyter kernel failed to start: {self.start_error}') from self.start_error
+                if self._total_kernels() < self.max_kernels:
+                    self._start_kernel_in_background()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(timeout=remaining):
+                    raise RuntimeError('No Jupyter kernel is available, please try again later.')
+            kernel = self.idle_kernels.pop()
+            work_dir = self.work_dir(unique_id)
+            self.leases[unique_id] = KernelLease(kernel=kernel, work_dir=work_dir)
+            self._refill()
+
+        os.makedirs(work_dir, exist_ok=True)
+        kernel.execute(f'import os\nos.chdir({os.path.abspath(work_dir)!r})', timeout=self.execution_timeout)
+        return kernel
+
+    def execute(self, unique_id, code: str) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Execute code in the kernel leased to a bot backend.
+
+        Parameters:
+        unique_id: The unique id of the bot backend.
+        code (str): The code to execute.
+
+        Returns:
+        Tuple[str, List[Tuple[str, str]]]: The text sent back to GPT, and the outputs to display.
+        """
+        kernel = self.lease(unique_id)
+        content_to_display = kernel.execute(code, timeout=self.execution_timeout)
+        with self.condition:
+            lease = self.leases.get(unique_id)
+            if lease is not None:
+                lease.last_used = time.monotonic()
+
+        text_to_gpt = []
+        for mark, out_str in content_to_display:
+            if mark.endswith(('_png', '_jpeg')):
+                text_to_gpt.append('[image]')
+            else:
+                text_to_gpt.append(out_str)
+        text_to_gpt = '\n'.join(text_to_gpt)
+        if len(text_to_gpt) > self.max_output_chars:
+            half = self.max_output_chars // 2
+            text_to_gpt = f'{text_to_gpt[:half]}\n[Output too long, the middle part is omitted]\n{text_to_gpt[-half:]}'
+        return text_to_gpt, content_to_display
+
+    def release(self, unique_id, remove_work_dir: bool = True):
+        """
+        Shut down the kernel leased to a bot backend, and optionally remove its working directory.
+
+        Parameters:
+        unique_id: The unique id of the bot backend.
+        remove_work_dir (bool): Whether to remove the working directory of the bot backend.
+        """
+        with self.condition:
+            lease = self.leases.pop(unique_id, None)
+            self._refill()
+            self.condition.notify_all()
+        if lease is not None:
+            lease.kernel.shutdown()
+        if remove_work_dir:
+            shutil.rmtree(self.work_dir(unique_id), ignore_errors=True)
+
+    def reap(self):
+        """
+        Release the leases that have been idle for longer than the idle timeout.
+        """
+        now = time.monotonic()
+        with self.condition:
+            expired = [unique_id for unique_id, lease in self.leases.items()
+                       if now - lease.last_used > self.idle_timeout]
+        for unique_id in expired:
+            self.release(unique_id, remove_work_dir=False)
+
+    def stats(self) -> Dict:
+        """
+        Return the number of idle, leased and starting kernels.
+
+        Returns:
+        Dict: The pool statistics.
+        """
+        with self.condition:
+            return {'idle': len(self.idle_kernels), 'leased': len(self.leases), 'starting': self.starting}
+
+    def shutdown(self):
+        """
+        Shut down every kernel of the pool.
+        """
+        with self.condition:
+            self.closed = True
+            kernels = self.idle_kernels + [lease.kernel for lease in self.leases.values()]
+            self.idle_kernels = []
+            self.leases = {}
+            self.condition.notify_all()
+        for kernel in kernels:
+            kernel.shutdown()
+
+    def _total_kernels(self) -> int:
+        """
+        Count the kernels of the pool, including the ones being started. Must be called with the condition held.
+
+        Returns:
+        int: The number of kernels.
+        """
+        return len(self.idle_kernels) + len(self.leases) + self.starting
+
+    def _refill(self):
+        """
+        Start kernels in the background until the pre-warmed target is met. Must be called with the condition held.
+        """
+        while (not self.closed and len(self.idle_kernels) + self.starting < self.prewarm_kernels
+               and self._total_kernels() < self.max_kernels):
+            self._start_kernel_in_background()
+
+    def _start_kernel_in_background(self):
+        """
+        Start a kernel in a background thread. Must be called with the condition held.
+        """
+        self.starting += 1
+        thread = threading.Thread(target=self._start_kernel, name='kernel-pool-starter', daemon=True)
+        thread.start()
+
+    def _start_kernel(self):
+        """
+        Start a kernel and add it to the idle kernels. A startup error is logged and kept for the leases waiting for a
+        kernel.
+        """
+        kernel = None
+        error = None
+        try:
+            kernel = JupyterKernel(
+                kernel_name=self.kernel_name, work_dir=self.work_directory, startup_timeout=self.startup_timeout
+            )
+        except Exception as e:
+            logger.exception('The Jupyter kernel %r failed to start', self.kernel_name)
+            error = e
+        with self.condition:
+            self.starting -= 1
+            if error is not None:
+                self.start_failures += 1
+                self.start_error = error
+            if kernel is not None and not self.closed:
+                self.idle_kernels.append(kernel)
+                kernel = None
+            self.condition.notify_all()
+        if kernel is not None:
+            kernel.shutdown()
+
+    def _reap_forever(self):
+        """
+        Reap idle leases periodically until the pool is shut down.
+        """
+        interval = max(min(self.idle_timeout / 4, 60), 1)
+        while not self.closed:
+            time.sleep(interval)
+            self.reap()
+
+
+# Function to get the process-wide kernel pool
+def get_kernel_pool(config: Dict) -> Union[KernelPool, None]:
+    """
+    This function returns the kernel pool shared by all bot backends, creating it, and pre-warming its kernels, on
+    first use.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    KernelPool: The shared kernel pool, or None if code execution is disabled.
+    """
+    global _kernel_pool
+    code_execution_config = get_code_execution_config(config)
+    if not code_execution_config['enabled']:
+        return None
+    if _kernel_pool is None:
+        with _kernel_pool_lock:
+            if _kernel_pool is None:
+                _kernel_pool = KernelPool(code_execution_config)
+    return _kernel_pool
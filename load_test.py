@@ -0,0 +1,253 @@
+from wiztalk_ui import *
+from benchmark import print_table
+from token_window import count_text_tokens
+import argparse
+import asyncio
+import math
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+
+# Function to compute a percentile
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    This function returns the nearest-rank percentile of a list of values.
+
+    Parameters:
+    values (List[float]): The values.
+    fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+    float: The percentile, or NaN if there are no values.
+    """
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+# Function to start the mock server in another process
+def start_mock_server(mock_args: List[str]) -> Tuple[subprocess.Popen, str]:
+    """
+    This function starts mock_openai_server.py in a separate process, so its CPU time is not counted in the sessions.
+
+    Parameters:
+    mock_args (List[str]): The command line arguments of the mock server.
+
+    Returns:
+    Tuple[subprocess.Popen, str]: The process of the server and its base url.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_openai_server.py'),
+         '--port', str(port), *mock_args],
+        stdout=subprocess.PIPE, text=True
+    )
+    process.stdout.readline()
+    return process, f'http://127.0.0.1:{port}/v1'
+
+
+# Function to write the configuration of the load test
+def write_load_test_config(api_base: str, model: str) -> str:
+    """
+    This function writes a copy of the configuration pointed to the API under test, with the response cache disabled,
+    and makes the package load it.
+
+    Parameters:
+    api_base (str): The base url of the API.
+    model (str): The model entry used by the sessions.
+
+    Returns:
+    str: The path of the configuration file.
+    """
+    config = load_config()
+    config['API_base'] = api_base
+    config['API_TYPE'] = 'open_ai'
+    config['API_KEY'] = config['API_KEY'] or 'mock'
+    config['response_cache'] = {**config.get('response_cache', {}), 'enabled': False}
+    config['model'][model]['available'] = True
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(config, f)
+    os.environ['WIZTALK_CONFIG'] = f.name
+    return f.name
+
+
+# Function to run the turns of a session with the bot function
+def run_session(index: int, turns: int, model: str, results: List[Dict]):
+    """
+    This function runs the turns of a session through add_text and bot, as the UI does, and records the time to first
+    token, the duration, the number of tokens and the CPU time of each turn.
+
+    Parameters:
+    index (int): The index of the session.
+    turns (int): The number of turns.
+    model (str): The model entry to use.
+    results (List[Dict]): The list the results of the turns are appended to.
+    """
+    state = {'session_id': None}
+    get_bot_backend(state).update_gpt_model_choice(model)
+    history = []
+    for turn in range(turns):
+        history, _ = add_text(state, history, f'Session {index}, turn {turn}: what is the next step?')
+        history = [list(row) for row in history]
+        start, first_token, cpu_start = time.perf_counter(), None, time.thread_time()
+        try:
+            for history in bot(state, history):
+                if first_token is None and history[-1][1]:
+                    first_token = time.perf_counter()
+        except Exception as e:
+            results.append({'error': repr(e)})
+            continue
+        results.append(turn_result(history, start, first_token, time.thread_time() - cpu_start, model))
+
+
+# Function to run the turns of a session with the asynchronous bot function
+async def arun_session(index: int, turns: int, model: str, results: List[Dict]):
+    """
+    This function is the asynchronous counterpart of run_session, running the turns through add_text and abot. The CPU
+    time of a turn cannot be told apart from the other sessions on the event loop, so it is not recorded.
+
+    Parameters:
+    index (int): The index of the session.
+    turns (int): The number of turns.
+    model (str): The model entry to use.
+    results (List[Dict]): The list the results of the turns are appended to.
+    """
+    state = {'session_id': None}
+    get_bot_backend(state).update_gpt_model_choice(model)
+    history = []
+    for turn in range(turns):
+        history, _ = add_text(state, history, f'Session {index}, turn {turn}: what is the next step?')
+        history = [list(row) for row in history]
+        start, first_token = time.perf_counter(), None
+        try:
+            async for history in abot(state, history):
+                if first_token is None and history[-1][1]:
+                    first_token = time.perf_counter()
+        except Exception as e:
+            results.append({'error': repr(e)})
+            continue
+        results.append(turn_result(history, start, first_token, None, model))
+
+
+# Function to measure a finished turn
+def turn_result(history: List, start: float, first_token: float, cpu_seconds: Union[float, None], model: str) -> Dict:
+    """
+    This function builds the result of a finished turn.
+
+    Parameters:
+    history (List): The history after the turn.
+    start (float): The time the turn started.
+    first_token (float): The time the first token was shown, or None.
+    cpu_seconds (float): The CPU time of the turn, or None if it is unknown.
+    model (str): The model entry used.
+
+    Returns:
+    Dict: The time to first token, the duration, the number of tokens and the CPU time of the turn.
+    """
+    end = time.perf_counter()
+    first_token = first_token or end
+    tokens = count_text_tokens(history[-1][1] or '', get_config()['model'][model]['model_name'])
+    return {
+        'ttft': first_token - start,
+        'duration': end - start,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / (end - first_token) if end > first_token else float('nan'),
+        'cpu': cpu_seconds
+    }
+
+
+# Function to run the load test
+def load_test(sessions: int, turns: int = 1, model: str = 'GPT-3.5', use_async: bool = False) -> Dict:
+    """
+    This function runs concurrent sessions against the configured API and summarizes their turns.
+
+    Parameters:
+    sessions (int): The number of concurrent sessions.
+    turns (int): The number of turns of each session.
+    model (str): The model entry to use.
+    use_async (bool): Whether to run the sessions with abot on one event loop instead of bot in one thread each.
+
+    Returns:
+    Dict: The number of sessions, turns and errors, the p50 and p99 time to first token, the p50 tokens per second of
+    a turn and of all sessions together, the p50 CPU time of a turn's thread and the CPU time of the process per
+    session.
+    """
+    results = []
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if use_async:
+        async def run_all():
+            from api_client import close_aiohttp_session
+            try:
+                await asyncio.gather(*(arun_session(index, turns, model, results) for index in range(sessions)))
+            finally:
+                await close_aiohttp_session()
+
+        asyncio.run(run_all())
+    else:
+        threads = [threading.Thread(target=run_session, args=(index, turns, model, results), daemon=True)
+                   for index in range(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    finished = [result for result in results if 'error' not in result]
+    errors = [result['error'] for result in results if 'error' in result]
+    return {
+        'sessions': sessions,
+        'turns': len(results),
+        'errors': len(errors),
+        'ttft_p50_ms': percentile([result['ttft'] for result in finished], 0.50) * 1000,
+        'ttft_p99_ms': percentile([result['ttft'] for result in finished], 0.99) * 1000,
+        'turn_tok_per_sec_p50': percentile([result['tokens_per_sec'] for result in finished], 0.50),
+        'total_tok_per_sec': sum(result['tokens'] for result in finished) / wall,
+        'turn_cpu_ms_p50': percentile([result['cpu'] for result in finished if result['cpu'] is not None], 0.50) * 1000,
+        'cpu_ms_per_session': cpu / sessions * 1000,
+        'wall_s': wall
+    }
+
+
+# Main function
+if __name__ == '__main__':
+    """
+    This is the main function that gets executed when the script is run directly.
+    It starts the mock server unless an API is given, runs the load test for each number of sessions and prints the
+    results.
+    """
+    parser = argparse.ArgumentParser(description='Drive concurrent chat sessions through add_text and bot')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--turns', type=int, default=1)
+    parser.add_argument('--model', default='GPT-3.5', help='model entry of config.json to use')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='run the sessions with abot')
+    parser.add_argument('--api-base', default=None, help='API to load, instead of starting the mock server')
+    parser.add_argument('--tokens-per-second', default='50', help='token rate of the mock server')
+    parser.add_argument('--ttft-ms', default='300', help='time to first token of the mock server')
+    parser.add_argument('--reply-tokens', default='200', help='length of the replies of the mock server')
+    parser.add_argument('--error-rate', default='0', help='fraction of the requests the mock server fails')
+    args = parser.parse_args()
+
+    mock_process = None
+    api_base = args.api_base
+    if api_base is None:
+        mock_process, api_base = start_mock_server([
+            '--tokens-per-second', args.tokens_per_second, '--ttft-ms', args.ttft_ms,
+            '--reply-tokens', args.reply_tokens, '--error-rate', args.error_rate
+        ])
+    config_path = write_load_test_config(api_base=api_base, model=args.model)
+    try:
+        # Warm up with one session, so the first measurement does not include the lazy imports
+        load_test(sessions=1, model=args.model, use_async=args.use_async)
+        print_table([load_test(sessions=sessions, turns=args.turns, model=args.model, use_async=args.use_async)
+                     for sessions in args.sessions])
+    finally:
+        os.remove(config_path)
+        if mock_process is not None:
+            mock_process.terminate()
+            mock_process.wait()
@@ -0,0 +1,98 @@
+import sys
+from typing import *
+
+# Roles of the messages, interned so every message of every session shares the same role strings
+ROLE_SYSTEM = sys.intern('system')
+ROLE_USER = sys.intern('user')
+ROLE_ASSISTANT = sys.intern('assistant')
+ROLE_FUNCTION = sys.intern('function')
+
+
+# Class for a message of a conversation
+class Message:
+    """
+    Compact record of a message of a conversation.
+
+    Conversations hold one record per message for the lifetime of their session, so the record has fixed slots instead
+    of the dictionary the API expects, and its role is interned, so a role decoded from a streamed response does not
+    keep its own copy. Records are converted to dictionaries with to_dict only when a request is sent. A record is not
+    modified once it is added to a conversation, so one record, like the system message, may be shared by all of them.
+    """
+
+    __slots__ = ('role', 'content', 'name', 'function_call')
+
+    def __init__(self, role: str, content: Union[str, None], name: str = None, function_call: Dict = None):
+        """
+        Initialize the message.
+
+        Parameters:
+        role (str): The role of the author of the message.
+        content (str): The text of the message, or None for a function call.
+        name (str): The name of the function whose response the message is, or None.
+        function_call (Dict): The 'name' and 'arguments' of the function called by the assistant, or None.
+        """
+        self.role = sys.intern(role)
+        self.content = content
+        self.name = name
+        self.function_call = function_call
+
+    def values(self) -> Tuple:
+        """
+        Return the fields of the message that are set, like the values of its dictionary.
+
+        Returns:
+        Tuple: The role, the content, and the name and function call if any.
+        """
+        return tuple(value for value in (self.role, self.content, self.name, self.function_call) if value is not None)
+
+    def to_dict(self) -> Dict:
+        """
+        Convert the message to the dictionary sent to the API.
+
+        Returns:
+        Dict: The message, with 'name' and 'function_call' only if they are set.
+        """
+        message = {'role': self.role, 'content': self.content}
+        if self.name is not None:
+            message['name'] = self.name
+        if self.function_call is not None:
+            message['function_call'] = self.function_call
+        return message
+
+    @classmethod
+    def from_dict(cls, message: Dict) -> 'Message':
+        """
+        Create a message from its dictionary.
+
+        Parameters:
+        message (Dict): The message, as sent to the API.
+
+        Returns:
+        Message: The message record.
+        """
+        return cls(role=message['role'], content=message.get('content'), name=message.get('name'),
+                   function_call=message.get('function_call'))
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return (self.role, self.content, self.name, self.function_call) == \
+            (other.role, other.content, other.name, other.function_call)
+
+    def __repr__(self):
+        return f'Message({self.to_dict()!r})'
+
+
+# Function to convert messages for a request
+def to_api_messages(messages: List[Union[Message, Dict]]) -> List[Dict]:
+    """
+    This function converts the messages of a request to the dictionaries sent to the API. Messages that are already
+    dictionaries are kept as they are.
+
+    Parameters:
+    messages (List[Union[Message, Dict]]): The messages to send.
+
+    Returns:
+    List[Dict]: The messages as dictionaries.
+    """
+    return [message.to_dict() if isinstance(message, Message) else message for message in messages]
@@ -0,0 +1,396 @@
+import atexit
+import threading
+import time
+from bisect import bisect_left
+from typing import *
+
+# Default settings of the metrics, overridden by the 'metrics' section of the configuration
+DEFAULT_METRICS_CONFIG = {
+    'enabled': False,
+    'port': None,
+    'dump_path': None,
+    'buckets': [
+        0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+    ]
+}
+
+# Help text of the metrics, exported with the metrics
+METRIC_HELP = {
+    'wiztalk_completion_connect_seconds': 'Time from sending a chat completion request to receiving its response headers.',
+    'wiztalk_completion_first_chunk_seconds': 'Time from sending a chat completion request to receiving its first chunk.',
+    'wiztalk_completion_chunk_gap_seconds': 'Time between consecutive chunks of a streamed chat completion.',
+    'wiztalk_completion_seconds': 'Time from sending a chat completion request to receiving its last chunk.',
+    'wiztalk_completion_retry_delay_seconds': 'Time waited before retrying a failed chat completion request.',
+    'wiztalk_chunk_seconds': 'Time spent handling a chunk in parse_response.',
+    'wiztalk_strategy_seconds': 'Time spent by a choice strategy handling a chunk in parse_response.',
+    'wiztalk_image_save_seconds': 'Time spent hashing and queueing the images of a function response.',
+    'wiztalk_image_write_seconds': 'Time spent by the image store writer thread decoding and writing an image.',
+    'wiztalk_image_wait_seconds': 'Time the bot generator waits for the images of a session to be written.',
+    'wiztalk_ui_yield_seconds': 'Time the bot generator waits for the UI to take an update.',
+}
+
+_metrics = None
+_metrics_configured = False
+_metrics_lock = threading.Lock()
+
+
+# Class for a latency histogram
+class Histogram:
+    """
+    Histogram of observed durations in seconds, with fixed bucket bounds.
+    """
+
+    def __init__(self, buckets: List[float]):
+        """
+        Initialize an empty histogram.
+
+        Parameters:
+        buckets (List[float]): The upper bounds of the buckets, in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        """
+        Add an observation to the histogram.
+
+        Parameters:
+        value (float): The observed duration in seconds.
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """
+        Return the cumulative bucket counts, the sum and the count of the observations.
+
+        Returns:
+        Tuple[List[int], float, int]: The cumulative counts of each bucket and of +Inf, the sum and the count.
+        """
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+# Class for a timing span
+class Span:
+    """
+    Context manager observing the time spent in its block into a histogram of a registry.
+    """
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, labels: Dict[str, str]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+# Class for the metrics registry
+class MetricsRegistry:
+    """
+    Registry of the latency histograms of the process, exported in the Prometheus text format.
+
+    A histogram is identified by its name and its labels, and created on its first observation. The registry only
+    exists when metrics are enabled: instrumented code gets it with get_metrics and skips timing when it is None, so
+    disabled metrics cost a single function call.
+    """
+
+    def __init__(self, buckets: List[float]):
+        """
+        Initialize an empty registry.
+
+        Parameters:
+        buckets (List[float]): The upper bounds of the buckets of the histograms, in seconds.
+        """
+        self.buckets = sorted(buckets)
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        """
+        Get a histogram, creating it on first use.
+
+        Parameters:
+        name (str): The name of the histogram.
+        **labels: The labels of the histogram.
+
+        Returns:
+        Histogram: The histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add an observation to a histogram.
+
+        Parameters:
+        name (str): The name of the histogram.
+        value (float): The observed duration in seconds.
+        **labels: The labels of the histogram.
+        """
+        self.histogram(name, **labels).observe(value)
+
+    def span(self, name: str, **labels) -> Span:
+        """
+        Return a context manager observing the time spent in its block.
+
+        Parameters:
+        name (str): The name of the histogram.
+        **labels: The labels of the histogram.
+
+        Returns:
+        Span: The context manager.
+        """
+        return Span(self, name, labels)
+
+    def instrument_stream(self, response: Iterable, start: float, **labels) -> Iterator:
+        """
+        Observe the connect time of a streamed chat completion, and pass its chunks through while observing its time to
+        first chunk, the gaps between its chunks and its total time.
+
+        Parameters:
+        response (Iterable): The stream of chunks, just returned by the request.
+        start (float): The time.perf_counter() value taken before the request was sent.
+        **labels: The labels of the histograms.
+
+        Returns:
+        Iterator: The same stream of chunks.
+        """
+        connected = time.perf_counter()
+        self.observe('wiztalk_completion_connect_seconds', connected - start, **labels)
+        return self._instrument_chunks(response, start, connected, labels)
+
+    def ainstrument_stream(self, response: AsyncIterable, start: float, **labels) -> AsyncIterator:
+        """
+        Asynchronous counterpart of instrument_stream.
+
+        Parameters:
+        response (AsyncIterable): The stream of chunks, just returned by the request.
+        start (float): The time.perf_counter() value taken before the request was sent.
+        **labels: The labels of the histograms.
+
+        Returns:
+        AsyncIterator: The same stream of chunks.
+        """
+        connected = time.perf_counter()
+        self.observe('wiztalk_completion_connect_seconds', connected - start, **labels)
+        return self._ainstrument_chunks(response, start, connected, labels)
+
+    def instrument_yields(self, updates: Iterable) -> Iterator:
+        """
+        Pass the updates of the bot generator through while observing how long the UI takes to consume each of them.
+
+        Parameters:
+        updates (Iterable): The updates yielded by the bot generator.
+
+        Returns:
+        Iterator: The same updates.
+        """
+        for update in updates:
+            start = time.perf_counter()
+            yield update
+            self.observe('wiztalk_ui_yield_seconds', time.perf_counter() - start)
+
+    async def ainstrument_yields(self, updates: AsyncIterable) -> AsyncIterator:
+        """
+        Asynchronous counterpart of instrument_yields.
+
+        Parameters:
+        updates (AsyncIterable): The updates yielded by the bot generator.
+
+        Returns:
+        AsyncIterator: The same updates.
+        """
+        async for update in updates:
+            start = time.perf_counter()
+            yield update
+            self.observe('wiztalk_ui_yield_seconds', time.perf_counter() - start)
+
+    def render(self) -> str:
+        """
+        Render all histograms in the Prometheus text exposition format.
+
+        Returns:
+        str: The exported metrics.
+        """
+        with self.lock:
+            items = sorted(self.histograms.items())
+        lines, described = [], set()
+        for (name, labels), histogram in items:
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+            cumulative, total, count = histogram.snapshot()
+            bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+            for bound, bucket_count in zip(bounds, cumulative):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {bucket_count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Write the exported metrics to a file.
+
+        Parameters:
+        path (str): The path of the file.
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> 'ThreadingHTTPServer':
+        """
+        Serve the exported metrics at /metrics in a background thread.
+
+        Parameters:
+        port (int): The port to listen on.
+        host (str): The host to listen on.
+
+        Returns:
+        ThreadingHTTPServer: The server.
+        """
+        # http.server is imported only when the metrics are served, so importing this module stays fast
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        return server
+
+    def _instrument_chunks(self, response: Iterable, start: float, previous: float, labels: Dict[str, str]) -> Iterator:
+        """
+        Pass the chunks of a stream through while observing their arrival times.
+
+        Parameters:
+        response (Iterable): The stream of chunks.
+        start (float): The time the request was sent.
+        previous (float): The time the response headers were received.
+        labels (Dict[str, str]): The labels of the histograms.
+
+        Returns:
+        Iterator: The same stream of chunks.
+        """
+        first = True
+        for chunk in response:
+            now = time.perf_counter()
+            if first:
+                self.observe('wiztalk_completion_first_chunk_seconds', now - start, **labels)
+            else:
+                self.observe('wiztalk_completion_chunk_gap_seconds', now - previous, **labels)
+            first, previous = False, now
+            yield chunk
+        self.observe('wiztalk_completion_seconds', time.perf_counter() - start, **labels)
+
+    async def _ainstrument_chunks(self, response: AsyncIterable, start: float, previous: float,
+                                  labels: Dict[str, str]) -> AsyncIterator:
+        """
+        Asynchronous counterpart of _instrument_chunks.
+
+        Parameters:
+        response (AsyncIterable): The stream of chunks.
+        start (float): The time the request was sent.
+        previous (float): The time the response headers were received.
+        labels (Dict[str, str]): The labels of the histograms.
+
+        Returns:
+        AsyncIterator: The same stream of chunks.
+        """
+        first = True
+        async for chunk in response:
+            now = time.perf_counter()
+            if first:
+                self.observe('wiztalk_completion_first_chunk_seconds', now - start, **labels)
+            else:
+                self.observe('wiztalk_completion_chunk_gap_seconds', now - previous, **labels)
+            first, previous = False, now
+            yield chunk
+        self.observe('wiztalk_completion_seconds', time.perf_counter() - start, **labels)
+
+
+# Function to format the labels of a sample
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """
+    This function formats labels in the Prometheus text format.
+
+    Parameters:
+    labels (Tuple[Tuple[str, str], ...]): The label names and values.
+
+    Returns:
+    str: The formatted labels, or an empty string if there are none.
+    """
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+# Function to get the process-wide metrics registry
+def get_metrics(config: Dict = None) -> Union[MetricsRegistry, None]:
+    """
+    This function returns the metrics registry of the process, or None if metrics are disabled. The first call with a
+    configuration creates the registry from its 'metrics' section, starts the /metrics endpoint if a port is set, and
+    schedules the dump of the metrics at exit if a dump path is set. Calls without a configuration return None until
+    then.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    MetricsRegistry: The registry, or None if metrics are disabled.
+    """
+    global _metrics, _metrics_configured
+    if _metrics_configured or config is None:
+        return _metrics
+    with _metrics_lock:
+        if not _metrics_configured:
+            metrics_config = {**DEFAULT_METRICS_CONFIG, **config.get('metrics', {})}
+            if metrics_config['enabled']:
+                _metrics = MetricsRegistry(buckets=metrics_config['buckets'])
+                if metrics_config['port'] is not None:
+                    _metrics.serve(port=metrics_config['port'])
+                if metrics_config['dump_path']:
+                    atexit.register(_metrics.write, metrics_config['dump_path'])
+            _metrics_configured = True
+    return _metrics
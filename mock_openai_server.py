@@ -0,0 +1,271 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+# Default behaviour of the mock server
+DEFAULT_MOCK_CONFIG = {
+    'tokens_per_second': 50.0,
+    'ttft_ms': 300.0,
+    'reply_tokens': 200,
+    'error_rate': 0.0,
+    'error_status': 500,
+    'disconnect_rate': 0.0,
+    'seed': None
+}
+
+# Words the mock replies are made of
+MOCK_WORDS = (
+    'the goal plan expert agent step data model result value stream token code python test measure '
+    'context question answer next reason progress task focus path risk approach simple first'
+).split()
+
+
+# Class for the request handler of the mock server
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Answers chat completion requests like the OpenAI API, with a generated reply.
+
+    Both the OpenAI path (/v1/chat/completions) and the Azure path (/openai/deployments/<engine>/chat/completions)
+    are accepted. Streamed replies are sent as server-sent events, one token per chunk, after the configured time to
+    first token and at the configured token rate. Errors and dropped connections are injected at the configured rates.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        """
+        Answer a chat completion request.
+        """
+        config = self.server.mock_config
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+            return
+
+        rng = self.server.next_random()
+        self.server.count('requests')
+        if rng.random() < config['error_rate']:
+            self.server.count('errors')
+            self._send_json(config['error_status'], {
+                'error': {'message': 'Injected error of the mock server', 'type': 'server_error'}
+            })
+            return
+
+        model = body.get('model') or self.path.split('/deployments/')[-1].split('/')[0]
+        tokens = self.server.reply_tokens(rng)
+        time.sleep(config['ttft_ms'] / 1000)
+        if body.get('stream'):
+            self._stream(model=model, tokens=tokens, rng=rng)
+        else:
+            self._send_json(200, {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens), 'total_tokens': len(tokens)}
+            })
+
+    def _stream(self, model: str, tokens: List[str], rng: random.Random):
+        """
+        Stream a reply as server-sent events.
+
+        Parameters:
+        model (str): The model of the request.
+        tokens (List[str]): The tokens of the reply.
+        rng (random.Random): The random generator of the request.
+        """
+        config = self.server.mock_config
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        disconnect_at = rng.randrange(len(tokens)) if rng.random() < config['disconnect_rate'] else None
+        interval = 1 / config['tokens_per_second'] if config['tokens_per_second'] > 0 else 0
+        deltas = [{'role': 'assistant', 'content': ''}] + [{'content': token} for token in tokens]
+        next_time = time.monotonic()
+        try:
+            for index, delta in enumerate(deltas):
+                if index == disconnect_at:
+                    self.server.count('disconnects')
+                    self.close_connection = True
+                    return
+                if index > 1 and interval:
+                    next_time += interval
+                    time.sleep(max(0.0, next_time - time.monotonic()))
+                self._send_event(model=model, delta=delta, finish_reason=None)
+            self._send_event(model=model, delta={}, finish_reason='stop')
+            self._send_chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_event(self, model: str, delta: Dict, finish_reason: Union[str, None]):
+        """
+        Send a chat completion chunk as a server-sent event.
+
+        Parameters:
+        model (str): The model of the request.
+        delta (Dict): The delta of the chunk.
+        finish_reason (str): The finish reason of the chunk, or None.
+        """
+        chunk = {
+            'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+        }
+        self._send_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+
+    def _send_chunk(self, data: bytes):
+        """
+        Send data as a chunk of the chunked transfer encoding.
+
+        Parameters:
+        data (bytes): The data to send.
+        """
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, status: int, payload: Dict):
+        """
+        Send a JSON response.
+
+        Parameters:
+        status (int): The HTTP status.
+        payload (Dict): The JSON payload.
+        """
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Class for the mock server
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI chat completion API, to load test the UI without network access. Point the
+    'API_base' of config.json to the url of the server to use it.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, mock_config: Dict = None):
+        """
+        Bind the server.
+
+        Parameters:
+        host (str): The host to listen on.
+        port (int): The port to listen on, 0 for a free port.
+        mock_config (Dict): The behaviour of the server, see DEFAULT_MOCK_CONFIG.
+        """
+        super().__init__((host, port), MockOpenAIHandler)
+        self.mock_config = {**DEFAULT_MOCK_CONFIG, **(mock_config or {})}
+        self.random = random.Random(self.mock_config['seed'])
+        self.counters = {'requests': 0, 'errors': 0, 'disconnects': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """
+        Return the url to set as 'API_base'.
+
+        Returns:
+        str: The base url of the API served.
+        """
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self) -> 'MockOpenAIServer':
+        """
+        Serve requests in a background thread.
+
+        Returns:
+        MockOpenAIServer: The server.
+        """
+        threading.Thread(target=self.serve_forever, name='mock-openai-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+        self.shutdown()
+        self.server_close()
+
+    def next_random(self) -> random.Random:
+        """
+        Return a random generator for a request, seeded from the server generator so a seeded run is reproducible.
+
+        Returns:
+        random.Random: The random generator.
+        """
+        with self.lock:
+            return random.Random(self.random.random())
+
+    def reply_tokens(self, rng: random.Random) -> List[str]:
+        """
+        Generate the tokens of a reply.
+
+        Parameters:
+        rng (random.Random): The random generator of the request.
+
+        Returns:
+        List[str]: The tokens of the reply.
+        """
+        return ['🧙🏾‍♂️:'] + [f' {rng.choice(MOCK_WORDS)}' for _ in range(self.mock_config['reply_tokens'] - 1)]
+
+    def count(self, name: str):
+        """
+        Increment a counter of the server.
+
+        Parameters:
+        name (str): The name of the counter.
+        """
+        with self.lock:
+            self.counters[name] += 1
+
+
+# Main function
+if __name__ == '__main__':
+    """
+    This is the main function that gets executed when the script is run directly.
+    It serves the mock API until interrupted.
+    """
+    parser = argparse.ArgumentParser(description='Local mock of the OpenAI streaming chat completion API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--tokens-per-second', type=float, default=DEFAULT_MOCK_CONFIG['tokens_per_second'],
+                        help='token rate of the streamed replies, 0 for no delay')
+    parser.add_argument('--ttft-ms', type=float, default=DEFAULT_MOCK_CONFIG['ttft_ms'],
+                        help='time to first token in milliseconds')
+    parser.add_argument('--reply-tokens', type=int, default=DEFAULT_MOCK_CONFIG['reply_tokens'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_MOCK_CONFIG['error_rate'],
+                        help='fraction of the requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=DEFAULT_MOCK_CONFIG['error_status'])
+    parser.add_argument('--disconnect-rate', type=float, default=DEFAULT_MOCK_CONFIG['disconnect_rate'],
+                        help='fraction of the streams dropped before they finish')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(host=args.host, port=args.port, mock_config={
+        'tokens_per_second': args.tokens_per_second,
+        'ttft_ms': args.ttft_ms,
+        'reply_tokens': args.reply_tokens,
+        'error_rate': args.error_rate,
+        'error_status': args.error_status,
+        'disconnect_rate': args.disconnect_rate,
+        'seed': args.seed
+    })
+    print(f'Mock OpenAI API listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
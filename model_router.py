@@ -0,0 +1,222 @@
+from backend import *
+from token_window import count_text_tokens
+import threading
+import time
+
+# Default settings of the model router, overridden by the 'router' entry of the 'model' section of the configuration
+DEFAULT_ROUTER_CONFIG = {
+    'enabled': False,
+    'fast_model': 'GPT-3.5',
+    'strong_model': 'GPT-4',
+    'commands': {'/start': 'GPT-4', '/save': 'GPT-3.5', '/ts': 'GPT-4'},
+    'strong_first_turns': 1,
+    'short_prompt_tokens': 64,
+    'latency_budget_ms': None,
+    'latency_smoothing': 0.2,
+    'log_path': 'cache/router.jsonl'
+}
+
+# Keys of the 'model' section that are settings rather than model entries
+MODEL_SETTING_KEYS = ('default', 'router')
+
+_model_router = None
+_model_router_configured = False
+_model_router_lock = threading.Lock()
+
+
+# Function to list the model entries of the configuration
+def get_model_choices(config: Dict) -> List[str]:
+    """
+    This function lists the model entries of the 'model' section of the configuration, skipping its settings.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    List[str]: The names of the model entries.
+    """
+    return [name for name in config['model'] if name not in MODEL_SETTING_KEYS]
+
+
+# Class for the model router
+class ModelRouter:
+    """
+    Picks the model answering each turn of a chat, and keeps a moving average of the time to first chunk of each model.
+
+    The rules are applied in order: a command listed in 'commands' is answered by its model; the first
+    'strong_first_turns' turns of a chat are answered by the strong model, while the goal is being aligned; a message
+    of at most 'short_prompt_tokens' tokens is answered by the fast model; other messages are answered by the strong
+    model, unless its average time to first chunk exceeds 'latency_budget_ms' and the fast model is quicker. Models
+    that are not available are never picked.
+
+    Each decision is appended to the JSONL file at 'log_path', with the average time to first chunk of each model at
+    the time, and each observed time to first chunk follows as a 'latency' record, so the latency saved by routing can
+    be measured.
+    """
+
+    def __init__(self, config: Dict):
+        """
+        Initialize the router from the configuration.
+
+        Parameters:
+        config (Dict): The configuration dictionary.
+        """
+        self.config = config
+        self.router_config = {**DEFAULT_ROUTER_CONFIG, **config['model'].get('router', {})}
+        self.latencies: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.log_file = None
+        if self.router_config['log_path']:
+            os.makedirs(os.path.dirname(self.router_config['log_path']) or '.', exist_ok=True)
+            self.log_file = open(self.router_config['log_path'], 'a', encoding='utf-8')
+
+    def route(self, bot_backend: BotBackend) -> Dict:
+        """
+        Pick the model answering the new turn of a bot backend, switch the bot backend to it and log the decision.
+
+        Parameters:
+        bot_backend (BotBackend): The bot backend whose last message is the new message of the user.
+
+        Returns:
+        Dict: The decision, with the chosen model and the rule that chose it.
+        """
+        last_message = bot_backend.conversation[-1]
+        text = (last_message.content or '') if last_message.role == ROLE_USER else ''
+        words = text.split(maxsplit=1)
+        command = words[0] if words and words[0].startswith('/') else None
+        turn = sum(1 for message in bot_backend.conversation if message.role == ROLE_USER)
+        prompt_tokens = count_text_tokens(text, self.config['model'][bot_backend.gpt_model_choice]['model_name'])
+
+        model, reason = self._decide(command=command, turn=turn, prompt_tokens=prompt_tokens)
+        if not self._available(model):
+            model, reason = bot_backend.gpt_model_choice, 'unavailable'
+        if model != bot_backend.gpt_model_choice:
+            bot_backend.update_gpt_model_choice(model)
+
+        with self.lock:
+            latencies = {name: round(seconds * 1000, 1) for name, seconds in self.latencies.items()}
+        decision = {
+            'type': 'decision',
+            'time': time.time(),
+            'session_id': bot_backend.unique_id,
+            'model': model,
+            'reason': reason,
+            'command': command,
+            'turn': turn,
+            'prompt_tokens': prompt_tokens,
+            'ttft_ms': latencies
+        }
+        self._log(decision)
+        return decision
+
+    def observe(self, model_choice: str, seconds: float, unique_id: str = None):
+        """
+        Update the moving average of the time to first chunk of a model, and log the observation.
+
+        Parameters:
+        model_choice (str): The model entry that answered.
+        seconds (float): The time to first chunk in seconds.
+        unique_id (str): The unique id of the session.
+        """
+        smoothing = self.router_config['latency_smoothing']
+        with self.lock:
+            average = self.latencies.get(model_choice)
+            self.latencies[model_choice] = seconds if average is None else average + smoothing * (seconds - average)
+        self._log({
+            'type': 'latency', 'time': time.time(), 'session_id': unique_id, 'model': model_choice,
+            'ttft_ms': round(seconds * 1000, 1)
+        })
+
+    def _decide(self, command: Union[str, None], turn: int, prompt_tokens: int) -> Tuple[str, str]:
+        """
+        Apply the routing rules.
+
+        Parameters:
+        command (str): The command starting the message, or None.
+        turn (int): The number of the turn in the chat, starting at 1.
+        prompt_tokens (int): The number of tokens of the message.
+
+        Returns:
+        Tuple[str, str]: The model entry and the rule that chose it.
+        """
+        fast_model, strong_model = self.router_config['fast_model'], self.router_config['strong_model']
+        if command in self.router_config['commands']:
+            return self.router_config['commands'][command], 'command'
+        if turn <= self.router_config['strong_first_turns']:
+            return strong_model, 'first_turns'
+        if prompt_tokens <= self.router_config['short_prompt_tokens']:
+            return fast_model, 'short_prompt'
+        budget = self.router_config['latency_budget_ms']
+        with self.lock:
+            strong_latency, fast_latency = self.latencies.get(strong_model), self.latencies.get(fast_model)
+        if (budget is not None and strong_latency is not None and strong_latency * 1000 > budget
+                and (fast_latency is None or fast_latency < strong_latency)):
+            return fast_model, 'latency'
+        return strong_model, 'long_prompt'
+
+    def _available(self, model_choice: str) -> bool:
+        """
+        Tell whether a model entry exists and is available.
+
+        Parameters:
+        model_choice (str): The model entry.
+
+        Returns:
+        bool: True if the model can be picked.
+        """
+        return model_choice in get_model_choices(self.config) and self.config['model'][model_choice]['available']
+
+    def _log(self, record: Dict):
+        """
+        Append a record to the decision log.
+
+        Parameters:
+        record (Dict): The record to write.
+        """
+        if self.log_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.log_file.write(line)
+            self.log_file.flush()
+
+
+# Function to get the process-wide model router
+def get_model_router(config: Dict) -> Union[ModelRouter, None]:
+    """
+    This function returns the model router shared by the whole process, creating it on first use from the 'router'
+    entry of the 'model' section of the configuration, or None if routing is disabled.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    ModelRouter: The shared model router, or None if routing is disabled.
+    """
+    global _model_router, _model_router_configured
+    if _model_router_configured:
+        return _model_router
+    with _model_router_lock:
+        if not _model_router_configured:
+            if {**DEFAULT_ROUTER_CONFIG, **config['model'].get('router', {})}['enabled']:
+                _model_router = ModelRouter(config)
+            _model_router_configured = True
+    return _model_router
+
+
+# Function to route a new turn
+def route_turn(bot_backend: BotBackend) -> Union[Dict, None]:
+    """
+    This function picks the model answering a bot backend that is about to answer a new message of the user, if
+    routing is enabled. Function call responses keep the model of their turn.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend about to answer.
+
+    Returns:
+    Dict: The decision, or None if the model was left unchanged.
+    """
+    model_router = get_model_router(bot_backend.config)
+    if model_router is None or bot_backend.finish_reason != 'new_input':
+        return None
+    return model_router.route(bot_backend)
@@ -1,26 +1,27 @@
 from abc import ABCMeta, abstractmethod
 from functions import *
+from metrics import MetricsRegistry
+import atexit
+import threading
 
 class ChoiceStrategy(metaclass=ABCMeta):
     """
     Abstract base class for different choice strategies.
+
+    Strategies are stateless: a single instance is built when it is registered on a ChoiceHandler, and every choice is
+    passed to its methods. The support method must only depend on the shape of the choice described by
+    ChoiceHandler.route_key, because its answer is cached per route.
     """
-    def __init__(self, choice):
-        """
-        Initialize the ChoiceStrategy with a given choice.
-        
-        Parameters:
-        choice (dict): The choice dictionary containing the 'delta' key.
-        """
-        self.choice = choice
-        self.delta = choice['delta']
 
     @abstractmethod
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         Abstract method to be implemented by subclasses.
         
         This method should return a boolean value indicating whether the current choice strategy supports the given choice.
+
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         
         Returns:
         bool: True if the strategy supports the choice, False otherwise.
@@ -28,13 +29,14 @@ class ChoiceStrategy(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
         Abstract method to be implemented by subclasses.
         
         This method should execute the strategy for the given choice.
         
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -50,20 +52,24 @@ class RoleChoiceStrategy(ChoiceStrategy):
     This class is a strategy for handling role choices. It inherits from the ChoiceStrategy class.
     """
 
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         This method checks if 'role' is in the delta dictionary.
 
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
+
         Returns:
         bool: True if 'role' is in the delta dictionary, False otherwise.
         """
-        return 'role' in self.delta
+        return 'role' in choice['delta']
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
         This method sets the assistant role name in the bot backend and returns the history and whether_exit flag.
 
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -71,7 +77,7 @@ class RoleChoiceStrategy(ChoiceStrategy):
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        bot_backend.set_assistant_role_name(assistant_role_name=self.delta['role'])
+        bot_backend.set_assistant_role_name(assistant_role_name=choice['delta']['role'])
         return history, whether_exit
 
 
@@ -80,20 +86,25 @@ class ContentChoiceStrategy(ChoiceStrategy):
     This class is a strategy for handling content choices. It inherits from the ChoiceStrategy class.
     """
 
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         This method checks if 'content' is in the delta dictionary and is not None.
 
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
+
         Returns:
         bool: True if 'content' is in the delta dictionary and is not None, False otherwise.
         """
-        return 'content' in self.delta and self.delta['content'] is not None
+        return 'content' in choice['delta'] and choice['delta']['content'] is not None
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
-        This method adds the content to the bot backend and updates the history.
+        This method adds the content to the bot backend and binds the last history row to it. The row is written when
+        the history is synchronized, not on every chunk.
 
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -101,8 +112,8 @@ class ContentChoiceStrategy(ChoiceStrategy):
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        bot_backend.add_content(content=self.delta.get('content', ''))
-        history[-1][1] = bot_backend.content
+        bot_backend.add_content(content=choice['delta'].get('content', ''))
+        bot_backend.set_content_row(content_row=history[-1])
         return history, whether_exit
 
 
@@ -111,20 +122,24 @@ class NameFunctionCallChoiceStrategy(ChoiceStrategy):
     This class is a strategy for handling function call name choices. It inherits from the ChoiceStrategy class.
     """
 
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         This method checks if 'function_call' and 'name' are keys in the delta dictionary.
 
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
+
         Returns:
         bool: True if 'function_call' and 'name' are keys in the delta dictionary, False otherwise.
         """
-        return 'function_call' in self.delta and 'name' in self.delta['function_call']
+        return 'function_call' in choice['delta'] and 'name' in choice['delta']['function_call']
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
         This method sets the function name in the bot backend and copies the current bot history.
 
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -132,7 +147,8 @@ class NameFunctionCallChoiceStrategy(ChoiceStrategy):
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        bot_backend.set_function_name(function_name=self.delta['function_call']['name'])
+        bot_backend.set_function_name(function_name=choice['delta']['function_call']['name'])
+        bot_backend.sync_content_row()
         bot_backend.copy_current_bot_history(bot_history=history)
 
         return history, whether_exit
@@ -143,20 +159,25 @@ class ArgumentsFunctionCallChoiceStrategy(ChoiceStrategy):
     This class is a strategy for handling function call argument choices. It inherits from the ChoiceStrategy class.
     """
 
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         This method checks if 'function_call' and 'arguments' are keys in the delta dictionary.
 
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
+
         Returns:
         bool: True if 'function_call' and 'arguments' are keys in the delta dictionary, False otherwise.
         """
-        return 'function_call' in self.delta and 'arguments' in self.delta['function_call']
+        return 'function_call' in choice['delta'] and 'arguments' in choice['delta']['function_call']
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
         This method adds the function arguments to the bot backend and handles hallucinatory function calls.
+        The arguments are decoded incrementally by the parser held on the bot backend, so each delta is scanned once.
 
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -164,18 +185,14 @@ class ArgumentsFunctionCallChoiceStrategy(ChoiceStrategy):
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        bot_backend.add_function_args_str(function_args_str=self.delta['function_call']['arguments'])
+        bot_backend.add_function_args_str(function_args_str=choice['delta']['function_call']['arguments'])
 
         # Handle hallucinatory function calls
         if bot_backend.function_name == 'python':
-            temp_code_str = bot_backend.function_args_str
-            history = copy.deepcopy(bot_backend.bot_history)
-            history[-1][1] += bot_backend.display_code_block
+            history = bot_backend.bot_history.restore(suffix=bot_backend.display_code_block)
         else:
-            temp_code_str = parse_json(function_args=bot_backend.function_args_str, finished=False)
-            if temp_code_str is not None:
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
+            if bot_backend.function_args_parser.has_code:
+                history = bot_backend.bot_history.restore(suffix=bot_backend.display_code_block)
 
         return history, whether_exit
 
@@ -185,22 +202,26 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
     This class is a strategy for handling finish reason choices. It inherits from the ChoiceStrategy class.
     """
 
-    def support(self):
+    def support(self, choice: Dict) -> bool:
         """
         This method checks if the finish reason is not None in the choice dictionary.
 
+        Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
+
         Returns:
         bool: True if the finish reason is not None, False otherwise.
         """
-        return self.choice['finish_reason'] is not None
+        return choice['finish_reason'] is not None
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
         """
         This method handles finish reason choices and handles exceptions. It updates the finish reason in the bot backend,
         and if the finish reason is 'function_call', it tries to execute the function and add the response to the bot history.
         If any error occurs during this process, it adds an error message to the bot history and sets the whether_exit flag to True.
 
         Parameters:
+        choice (dict): The choice dictionary containing the 'delta' key.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of the conversation.
         whether_exit (bool): A flag indicating whether to exit the conversation.
@@ -208,21 +229,28 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        function_dict={'execute_code': 'dummy code'}
+        function_dict = {
+            'execute_code': bot_backend.execute_code,
+            bot_backend.worker_language_choice: bot_backend.execute_code
+        }
+        bot_backend.sync_content_row()
         if bot_backend.content:
             bot_backend.add_gpt_response_content_message()
 
-        bot_backend.update_finish_reason(finish_reason=self.choice['finish_reason'])
+        bot_backend.update_finish_reason(finish_reason=choice['finish_reason'])
         if bot_backend.finish_reason == 'function_call':
             try:
                 code_str = self.get_code_str(bot_backend)
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
+                bot_backend.update_display_code_block(
+                    display_code_block=f"\n```{bot_backend.worker_language_choice}\n{code_str}\n```"
+                )
+                history = bot_backend.bot_history.restore(suffix=bot_backend.display_code_block)
 
                 # Function response
                 text_to_gpt, content_to_display = function_dict[
                     bot_backend.function_name
                 ](code_str)
+                bot_backend.add_function_call_response_message(function_response=text_to_gpt)
 
                 add_function_response_to_bot_history(
                     content_to_display=content_to_display, history=history, unique_id=bot_backend.unique_id
@@ -248,8 +276,8 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
     def get_code_str(bot_backend):
         """
         This method gets the code string based on the function name. If the function name is the same as the worker language choice,
-        it directly uses the function arguments string as the code string. Otherwise, it tries to parse the function arguments string
-        as JSON. If the parsing fails, it raises a JSONDecodeError.
+        it directly uses the function arguments string as the code string. Otherwise, it takes the final result of the incremental
+        parser that has consumed the function arguments. If the parsing fails, it raises a JSONDecodeError.
 
         Parameters:
         bot_backend (BotBackend): The bot backend instance.
@@ -263,35 +291,278 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
         if bot_backend.function_name.lower() == bot_backend.worker_language_choice.lower():
             code_str = bot_backend.function_args_str
         else:
-            code_str = parse_json(function_args=bot_backend.function_args_str, finished=True)
+            code_str = bot_backend.function_args_parser.finish()
             if code_str is None:
                 raise json.JSONDecodeError
         return code_str
 
 
+class ChoiceHook:
+    """
+    Base class for the hooks of a ChoiceHandler.
+
+    A hook is called before and after each choice handled, and before and after each strategy executed for it, with
+    the choice, the bot backend and, after, the elapsed time in seconds. Subclasses override the methods they need.
+    Hooks must not modify the choice or the bot backend.
+    """
+
+    def before_chunk(self, choice: Dict, bot_backend: BotBackend):
+        """
+        Called before the strategies of a choice are executed.
+
+        Parameters:
+        choice (dict): The choice of the chunk.
+        bot_backend (BotBackend): The bot backend instance.
+        """
+        pass
+
+    def after_chunk(self, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        """
+        Called after the strategies of a choice have been executed.
+
+        Parameters:
+        choice (dict): The choice of the chunk.
+        bot_backend (BotBackend): The bot backend instance.
+        elapsed (float): The time spent handling the choice, in seconds.
+        """
+        pass
+
+    def before_strategy(self, strategy: ChoiceStrategy, choice: Dict, bot_backend: BotBackend):
+        """
+        Called before a strategy is executed.
+
+        Parameters:
+        strategy (ChoiceStrategy): The strategy.
+        choice (dict): The choice of the chunk.
+        bot_backend (BotBackend): The bot backend instance.
+        """
+        pass
+
+    def after_strategy(self, strategy: ChoiceStrategy, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        """
+        Called after a strategy has been executed.
+
+        Parameters:
+        strategy (ChoiceStrategy): The strategy.
+        choice (dict): The choice of the chunk.
+        bot_backend (BotBackend): The bot backend instance.
+        elapsed (float): The time spent in the strategy, in seconds.
+        """
+        pass
+
+
+class MetricsHook(ChoiceHook):
+    """
+    Hook observing the time spent handling each chunk, and in each strategy, into the metrics registry.
+    """
+
+    def __init__(self, metrics: MetricsRegistry):
+        """
+        Initialize the hook.
+
+        Parameters:
+        metrics (MetricsRegistry): The metrics registry.
+        """
+        self.metrics = metrics
+
+    def after_chunk(self, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        self.metrics.observe('wiztalk_chunk_seconds', elapsed)
+
+    def after_strategy(self, strategy: ChoiceStrategy, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        self.metrics.observe('wiztalk_strategy_seconds', elapsed, strategy=type(strategy).__name__)
+
+
+class SamplingProfilerHook(ChoiceHook):
+    """
+    Hook running cProfile on one chunk in every sample_every, to profile the hot path of a running server.
+
+    The profiles of the sampled chunks are merged, and the merged statistics are written to output_path in the pstats
+    format every write_every samples and when the process exits. Read them with pstats.Stats(output_path). A chunk is
+    not sampled if another profiler is already running in its thread.
+    """
+
+    def __init__(self, sample_every: int, output_path: str, write_every: int = 10):
+        """
+        Initialize the hook.
+
+        Parameters:
+        sample_every (int): The number of chunks between two sampled chunks.
+        output_path (str): The path of the statistics file.
+        write_every (int): The number of samples between two writes of the statistics file.
+        """
+        self.sample_every = max(1, sample_every)
+        self.output_path = output_path
+        self.write_every = max(1, write_every)
+        self.chunks = 0
+        self.samples = 0
+        self.stats: Union[pstats.Stats, None] = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        atexit.register(self.write)
+
+    def before_chunk(self, choice: Dict, bot_backend: BotBackend):
+        with self.lock:
+            self.chunks += 1
+            sampled = self.chunks % self.sample_every == 0
+        if not sampled:
+            return
+        # The profiler is imported by the first sampled chunk, so importing this module stays fast
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return
+        self.local.profiler = profiler
+
+    def after_chunk(self, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        profiler = getattr(self.local, 'profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        self.local.profiler = None
+        import pstats
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+            self.samples += 1
+            write = self.samples % self.write_every == 0
+        if write:
+            self.write()
+
+    def write(self):
+        """
+        Write the merged statistics of the samples taken so far.
+        """
+        with self.lock:
+            if self.stats is None:
+                return
+            directory = os.path.dirname(self.output_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.stats.dump_stats(self.output_path)
+
+
 class ChoiceHandler:
     """
     Handler for different choice strategies.
+
+    Strategies are instantiated once. The strategies supporting a choice are looked up in a routing table keyed by the
+    shape of the choice, so a chunk is sent straight to its strategies without asking each of them. A new strategy is
+    registered by adding it to the strategies list, which the handlers built from it pick up on their next choice, or
+    by calling register on a handler. Hooks registered with add_hook are called around each choice and each strategy,
+    and their after methods are called even if a strategy raises; without hooks, nothing is timed.
     """
     strategies = [
         RoleChoiceStrategy, ContentChoiceStrategy, NameFunctionCallChoiceStrategy,
         ArgumentsFunctionCallChoiceStrategy, FinishReasonChoiceStrategy
     ]
 
-    def __init__(self, choice):
+    def __init__(self, strategies: List[Type[ChoiceStrategy]] = None):
         """
-        Initialize the ChoiceHandler with a given choice.
+        Initialize the ChoiceHandler with an instance of each strategy.
 
         Parameters:
-        choice (dict): The choice to be handled.
+        strategies (List[Type[ChoiceStrategy]]): The strategy classes to use. Defaults to the strategies class attribute,
+        which the handler then follows when it changes.
+        """
+        self.follows_class_strategies = strategies is None
+        self.strategy_classes: List[Type[ChoiceStrategy]] = list(self.strategies if strategies is None else strategies)
+        self.registered: List[Type[ChoiceStrategy]] = []
+        self.strategy_instances: List[ChoiceStrategy] = [Strategy() for Strategy in self.strategy_classes]
+        self.routes: Dict[Tuple, Tuple[ChoiceStrategy, ...]] = {}
+        self.hooks: List[ChoiceHook] = []
+        self.reversed_hooks: List[ChoiceHook] = []
+
+    def register(self, Strategy: Type[ChoiceStrategy]):
+        """
+        Register a new strategy on this handler. It runs after the strategies already registered.
+
+        Parameters:
+        Strategy (Type[ChoiceStrategy]): The strategy class to register.
+        """
+        self.registered.append(Strategy)
+        self.strategy_instances = self.strategy_instances + [Strategy()]
+        self.routes.clear()
+
+    def rebuild(self):
+        """
+        Instantiate the strategies again after the strategies class attribute changed, followed by those registered on
+        this handler.
+        """
+        self.strategy_classes = list(self.strategies)
+        self.strategy_instances = [Strategy() for Strategy in self.strategy_classes + self.registered]
+        self.routes.clear()
+
+    def add_hook(self, hook: ChoiceHook):
+        """
+        Register a hook on this handler. Hooks are nested: its before methods are called after those of the hooks
+        already registered, and its after methods before theirs.
+
+        Parameters:
+        hook (ChoiceHook): The hook to register.
         """
-        self.choice = choice
+        self.hooks = self.hooks + [hook]
+        self.reversed_hooks = self.hooks[::-1]
 
-    def handle(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def remove_hook(self, hook: ChoiceHook):
         """
-        Handle the choice using the appropriate strategy.
+        Unregister a hook from this handler.
 
         Parameters:
+        hook (ChoiceHook): The hook to unregister.
+        """
+        self.hooks = [registered for registered in self.hooks if registered is not hook]
+        self.reversed_hooks = self.hooks[::-1]
+
+    @staticmethod
+    def route_key(choice: Dict) -> Tuple:
+        """
+        Compute the routing key of a choice: the delta keys, whether the content is None, the function call keys and
+        whether a finish reason is set.
+
+        Parameters:
+        choice (dict): The choice to route.
+
+        Returns:
+        Tuple: The routing key.
+        """
+        delta = choice['delta']
+        function_call = delta.get('function_call')
+        return (
+            tuple(delta),
+            delta.get('content') is None,
+            tuple(function_call) if function_call else (),
+            choice['finish_reason'] is not None
+        )
+
+    def route(self, choice: Dict) -> Tuple[ChoiceStrategy, ...]:
+        """
+        Get the strategies supporting a choice, building the route the first time a choice of this shape is seen.
+
+        Parameters:
+        choice (dict): The choice to route.
+
+        Returns:
+        Tuple[ChoiceStrategy, ...]: The strategies to execute, in registration order.
+        """
+        if self.follows_class_strategies and self.strategies != self.strategy_classes:
+            self.rebuild()
+        key = self.route_key(choice)
+        strategies = self.routes.get(key)
+        if strategies is None:
+            strategies = tuple(strategy for strategy in self.strategy_instances if strategy.support(choice))
+            self.routes[key] = strategies
+        return strategies
+
+    def handle(self, choice: Dict, bot_backend: BotBackend, history: List, whether_exit: bool):
+        """
+        Handle the choice using the appropriate strategy, calling the hooks around the choice and each strategy.
+
+        Parameters:
+        choice (dict): The choice to be handled.
         bot_backend (BotBackend): The bot backend instance.
         history (List): The history of choices.
         whether_exit (bool): The flag indicating whether to exit.
@@ -299,19 +570,89 @@ class ChoiceHandler:
         Returns:
         Tuple[List, bool]: The updated history and the whether_exit flag.
         """
-        for Strategy in self.strategies:
-            strategy_instance = Strategy(choice=self.choice)
-            if not strategy_instance.support():
-                continue
-            history, whether_exit = strategy_instance.execute(
-                bot_backend=bot_backend,
-                history=history,
-                whether_exit=whether_exit
-            )
+        hooks = self.hooks
+        if not hooks:
+            for strategy in self.route(choice):
+                history, whether_exit = strategy.execute(
+                    choice=choice,
+                    bot_backend=bot_backend,
+                    history=history,
+                    whether_exit=whether_exit
+                )
+            return history, whether_exit
+
+        reversed_hooks = self.reversed_hooks
+        for hook in hooks:
+            hook.before_chunk(choice, bot_backend)
+        chunk_start = time.perf_counter()
+        try:
+            for strategy in self.route(choice):
+                for hook in hooks:
+                    hook.before_strategy(strategy, choice, bot_backend)
+                start = time.perf_counter()
+                try:
+                    history, whether_exit = strategy.execute(
+                        choice=choice,
+                        bot_backend=bot_backend,
+                        history=history,
+                        whether_exit=whether_exit
+                    )
+                finally:
+                    elapsed = time.perf_counter() - start
+                    for hook in reversed_hooks:
+                        hook.after_strategy(strategy, choice, bot_backend, elapsed)
+        finally:
+            elapsed = time.perf_counter() - chunk_start
+            for hook in reversed_hooks:
+                hook.after_chunk(choice, bot_backend, elapsed)
         return history, whether_exit
 
 
-def parse_response(chunk, history, bot_backend: BotBackend):
+# Default settings of the sampling profiler, overridden by the 'profiling' section of the configuration
+DEFAULT_PROFILING_CONFIG = {
+    'enabled': False,
+    'sample_every': 100,
+    'output_path': 'cache/parse_response.pstats',
+    'write_every': 10
+}
+
+# The handler shared by all calls to parse_response
+choice_handler = ChoiceHandler()
+_choice_handler_configured = False
+_choice_handler_lock = threading.Lock()
+
+
+def get_choice_handler(config: Dict) -> ChoiceHandler:
+    """
+    This function returns the handler shared by all calls to parse_response. On first use, it registers the hooks
+    enabled by the configuration: the metrics hook if the 'metrics' section is enabled, and the sampling profiler if
+    the 'profiling' section is enabled.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    ChoiceHandler: The shared handler.
+    """
+    global _choice_handler_configured
+    if not _choice_handler_configured:
+        with _choice_handler_lock:
+            if not _choice_handler_configured:
+                metrics = get_metrics(config)
+                if metrics is not None:
+                    choice_handler.add_hook(MetricsHook(metrics))
+                profiling_config = {**DEFAULT_PROFILING_CONFIG, **config.get('profiling', {})}
+                if profiling_config['enabled']:
+                    choice_handler.add_hook(SamplingProfilerHook(
+                        sample_every=profiling_config['sample_every'],
+                        output_path=profiling_config['output_path'],
+                        write_every=profiling_config['write_every']
+                    ))
+                _choice_handler_configured = True
+    return choice_handler
+
+
+def parse_response(chunk, history, bot_backend: BotBackend, sync_history: bool = False):
     """
     This function parses the response from the bot backend and updates the history and exit flag accordingly.
 
@@ -319,18 +660,43 @@ def parse_response(chunk, history, bot_backend: BotBackend):
     chunk (dict): The chunk of data to be parsed.
     history (List): The history of choices.
     bot_backend (BotBackend): The bot backend instance.
+    sync_history (bool): Whether to write the streamed content into the history after this chunk. Writing it joins the
+        whole reply so far, so by default it is only written when the reply finishes or turns into a function call,
+        and callers reading the history in between call bot_backend.sync_content_row() before reading it.
 
     Returns:
     Tuple[List, bool]: The updated history and the whether_exit flag.
     """
     whether_exit = False
     if chunk['choices']:
-        choice = chunk['choices'][0]
-        choice_handler = ChoiceHandler(choice=choice)
-        history, whether_exit = choice_handler.handle(
+        history, whether_exit = get_choice_handler(bot_backend.config).handle(
+            choice=chunk['choices'][0],
             history=history,
             bot_backend=bot_backend,
             whether_exit=whether_exit
         )
+        if sync_history:
+            bot_backend.sync_content_row()
 
     return history, whether_exit
+
+
+async def aparse_response(chunk, history, bot_backend: BotBackend, sync_history: bool = False):
+    """
+    This function is the asynchronous counterpart of parse_response. A chunk finishing with a function call executes
+    the code of the call and writes its outputs, which may take up to the execution timeout, so it is parsed in a
+    worker thread while the event loop keeps serving the other chats. Other chunks are parsed in place.
+
+    Parameters:
+    chunk (dict): The chunk of data to be parsed.
+    history (List): The history of choices.
+    bot_backend (BotBackend): The bot backend instance.
+    sync_history (bool): Whether to write the streamed content into the history after this chunk.
+
+    Returns:
+    Tuple[List, bool]: The updated history and the whether_exit flag.
+    """
+    if chunk['choices'] and chunk['choices'][0]['finish_reason'] == 'function_call':
+        import asyncio
+        return await asyncio.to_thread(parse_response, chunk, history, bot_backend, sync_history)
+    return parse_response(chunk, history, bot_backend, sync_history)
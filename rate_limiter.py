@@ -0,0 +1,414 @@
+from backend import *
+from collections import deque
+from model_router import get_model_choices
+from single_flight import get_single_flight
+from token_window import TOKENS_PER_REPLY, count_message_tokens
+import time
+
+# Default settings of the rate limiter, overridden by the 'rate_limit' section of the configuration
+DEFAULT_RATE_LIMIT_CONFIG = {
+    'reply_tokens': 500,
+    'poll_interval': 0.5
+}
+
+_rate_limiter = None
+_rate_limiter_configured = False
+_rate_limiter_lock = threading.Lock()
+
+
+# Class for a token bucket
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a rate given per minute, holding at most one minute of tokens.
+    """
+
+    def __init__(self, per_minute: float):
+        """
+        Initialize a full bucket.
+
+        Parameters:
+        per_minute (float): The number of tokens added per minute, and the capacity of the bucket.
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float, now: float) -> float:
+        """
+        Return the time until an amount of tokens can be taken. An amount larger than the capacity waits for a full
+        bucket.
+
+        Parameters:
+        amount (float): The amount of tokens.
+        now (float): The current time.monotonic() value.
+
+        Returns:
+        float: The delay in seconds, 0 if the tokens can be taken now.
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        """
+        Take an amount of tokens, after delay returned 0 for it. An amount larger than the capacity empties the bucket.
+
+        Parameters:
+        amount (float): The amount of tokens.
+        """
+        self.level -= min(amount, self.capacity)
+
+
+# Class for a place in the queue of a rate limiter
+class Ticket:
+    """
+    Place of a chat completion request in the queue of a model, admitted once the limits of the model allow it.
+    """
+
+    def __init__(self, limiter: 'ModelRateLimiter', tokens: int):
+        """
+        Initialize the ticket.
+
+        Parameters:
+        limiter (ModelRateLimiter): The limiter of the model.
+        tokens (int): The estimated tokens of the request.
+        """
+        self.limiter = limiter
+        self.tokens = tokens
+        self.admitted = threading.Event()
+
+    @property
+    def position(self) -> int:
+        """
+        The position of the request in the queue of the model, starting at 1, or 0 once it is admitted.
+        """
+        return self.limiter.position(self)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until the request is admitted.
+
+        Parameters:
+        timeout (float): The maximum time to wait in seconds, or None to wait until admitted.
+
+        Returns:
+        bool: True if the request was admitted, False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                delay = self.limiter.dispatch()
+                if self.admitted.is_set():
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    delay = min(delay, remaining)
+                self.admitted.wait(delay)
+        except BaseException:
+            # Leave the queue if the wait is interrupted, so the requests behind are not blocked
+            self.cancel()
+            raise
+
+    async def await_admission(self, timeout: float = None) -> bool:
+        """
+        Asynchronous counterpart of wait.
+
+        Parameters:
+        timeout (float): The maximum time to wait in seconds, or None to wait until admitted.
+
+        Returns:
+        bool: True if the request was admitted, False if the timeout expired first.
+        """
+        # asyncio is imported by the first asynchronous request, so importing this module stays fast
+        import asyncio
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                delay = self.limiter.dispatch()
+                if self.admitted.is_set():
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    delay = min(delay, remaining)
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Leave the queue if the wait is interrupted, so the requests behind are not blocked
+            self.cancel()
+            raise
+
+    def cancel(self):
+        """
+        Leave the queue, if the request is not admitted yet.
+        """
+        self.limiter.cancel(self)
+
+
+# Class for the rate limiter of a model
+class ModelRateLimiter:
+    """
+    Admits the chat completion requests of a model in the order they arrive, within its requests per minute and
+    tokens per minute. A request waits until both buckets hold enough for it and every request queued before it has
+    been admitted, so a large request is not overtaken by smaller ones.
+    """
+
+    def __init__(self, rpm: Union[float, None], tpm: Union[float, None], poll_interval: float):
+        """
+        Initialize the limiter.
+
+        Parameters:
+        rpm (float): The requests per minute, or None for no limit.
+        tpm (float): The tokens per minute, or None for no limit.
+        poll_interval (float): The maximum time a waiting request sleeps before checking the queue again.
+        """
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.poll_interval = poll_interval
+        self.queue: Deque[Ticket] = deque()
+        self.lock = threading.Lock()
+        self.admitted_count = 0
+
+    def enqueue(self, tokens: int) -> Ticket:
+        """
+        Queue a request, admitting it at once if nothing is queued before it and the limits allow it.
+
+        Parameters:
+        tokens (int): The estimated tokens of the request.
+
+        Returns:
+        Ticket: The ticket of the request.
+        """
+        ticket = Ticket(limiter=self, tokens=tokens)
+        with self.lock:
+            self.queue.append(ticket)
+        self.dispatch()
+        return ticket
+
+    def dispatch(self) -> float:
+        """
+        Admit the requests at the head of the queue that the limits allow.
+
+        Returns:
+        float: The time until the next queued request may be admitted, at most poll_interval.
+        """
+        with self.lock:
+            while self.queue:
+                ticket = self.queue[0]
+                now = time.monotonic()
+                delay = max(
+                    self.requests.delay(1, now) if self.requests else 0.0,
+                    self.tokens.delay(ticket.tokens, now) if self.tokens else 0.0
+                )
+                if delay > 0:
+                    return min(delay, self.poll_interval)
+                if self.requests:
+                    self.requests.take(1)
+                if self.tokens:
+                    self.tokens.take(ticket.tokens)
+                self.queue.popleft()
+                self.admitted_count += 1
+                ticket.admitted.set()
+        return self.poll_interval
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        Return the position of a ticket in the queue.
+
+        Parameters:
+        ticket (Ticket): The ticket.
+
+        Returns:
+        int: The position starting at 1, or 0 if the ticket is not queued.
+        """
+        with self.lock:
+            for index, queued in enumerate(self.queue):
+                if queued is ticket:
+                    return index + 1
+        return 0
+
+    def cancel(self, ticket: Ticket):
+        """
+        Remove a ticket from the queue, letting the requests behind it move up.
+
+        Parameters:
+        ticket (Ticket): The ticket.
+        """
+        with self.lock:
+            if ticket in self.queue:
+                self.queue.remove(ticket)
+        self.dispatch()
+
+
+# Class for the process-wide rate limiter
+class RateLimiter:
+    """
+    Admission controller shared by all sessions, holding a ModelRateLimiter for each model entry that sets 'rpm' or
+    'tpm' in the 'model' section of the configuration.
+    """
+
+    def __init__(self, config: Dict):
+        """
+        Initialize the limiters of the models.
+
+        Parameters:
+        config (Dict): The configuration dictionary.
+        """
+        self.rate_limit_config = {**DEFAULT_RATE_LIMIT_CONFIG, **config.get('rate_limit', {})}
+        self.limiters: Dict[str, ModelRateLimiter] = {}
+        for model_choice in get_model_choices(config):
+            model_config = config['model'][model_choice]
+            if model_config.get('rpm') or model_config.get('tpm'):
+                self.limiters[model_choice] = ModelRateLimiter(
+                    rpm=model_config.get('rpm'), tpm=model_config.get('tpm'),
+                    poll_interval=self.rate_limit_config['poll_interval']
+                )
+
+    def estimate_tokens(self, kwargs_for_chat_completion: Dict, model_name: str) -> int:
+        """
+        Estimate the tokens a request counts against the tokens per minute: its prompt, and its 'max_tokens' or the
+        configured 'reply_tokens'.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request.
+        model_name (str): The name of the model.
+
+        Returns:
+        int: The estimated tokens.
+        """
+        prompt_tokens = sum(count_message_tokens(message, model_name) for message in kwargs_for_chat_completion['messages'])
+        reply_tokens = kwargs_for_chat_completion.get('max_tokens') or self.rate_limit_config['reply_tokens']
+        return prompt_tokens + TOKENS_PER_REPLY + reply_tokens
+
+    def enqueue(self, model_choice: str, tokens: int) -> Union[Ticket, None]:
+        """
+        Queue a request to a model.
+
+        Parameters:
+        model_choice (str): The model entry.
+        tokens (int): The estimated tokens of the request.
+
+        Returns:
+        Ticket: The ticket of the request, or None if the model has no limits.
+        """
+        limiter = self.limiters.get(model_choice)
+        if limiter is None:
+            return None
+        return limiter.enqueue(tokens)
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Return the state of the queue of each model.
+
+        Returns:
+        Dict[str, Dict]: The number of queued and admitted requests of each limited model.
+        """
+        return {
+            model_choice: {'queued': len(limiter.queue), 'admitted': limiter.admitted_count}
+            for model_choice, limiter in self.limiters.items()
+        }
+
+
+# Function to get the process-wide rate limiter
+def get_rate_limiter(config: Dict) -> Union[RateLimiter, None]:
+    """
+    This function returns the rate limiter shared by the whole process, creating it on first use, or None if no model
+    entry sets 'rpm' or 'tpm'.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    RateLimiter: The shared rate limiter, or None if no model is limited.
+    """
+    global _rate_limiter, _rate_limiter_configured
+    if _rate_limiter_configured:
+        return _rate_limiter
+    with _rate_limiter_lock:
+        if not _rate_limiter_configured:
+            rate_limiter = RateLimiter(config)
+            _rate_limiter = rate_limiter if rate_limiter.limiters else None
+            _rate_limiter_configured = True
+    return _rate_limiter
+
+
+# Function to queue a chat completion request
+def request_admission(bot_backend: BotBackend, kwargs_for_chat_completion: Dict,
+                      check_in_flight: bool = True) -> Union[Ticket, None]:
+    """
+    This function queues a chat completion request of a bot backend with the rate limiter of its model.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend sending the request.
+    kwargs_for_chat_completion (Dict): The arguments of the request, as returned by prepare_chat_completion.
+    check_in_flight (bool): Whether to let a request identical to one in flight through without queueing it, since it
+    will share the stream of that request instead of being sent.
+
+    Returns:
+    Ticket: The ticket of the request, or None if the model has no limits or the request will not be sent.
+    """
+    rate_limiter = get_rate_limiter(bot_backend.config)
+    if rate_limiter is None or bot_backend.gpt_model_choice not in rate_limiter.limiters:
+        return None
+    single_flight = get_single_flight(bot_backend.config)
+    if check_in_flight and single_flight is not None and single_flight.in_flight(kwargs_for_chat_completion):
+        return None
+    model_name = bot_backend.config['model'][bot_backend.gpt_model_choice]['model_name']
+    tokens = rate_limiter.estimate_tokens(kwargs_for_chat_completion, model_name)
+    return rate_limiter.enqueue(bot_backend.gpt_model_choice, tokens)
+
+
+# Function to follow a queued request
+def queue_positions(ticket: Ticket) -> Iterator[int]:
+    """
+    This function waits until a request is admitted, yielding its position in the queue every poll interval meanwhile.
+    If the caller stops waiting, the request leaves the queue.
+
+    Parameters:
+    ticket (Ticket): The ticket of the request.
+
+    Returns:
+    Iterator[int]: The positions of the request while it waits.
+    """
+    try:
+        while not ticket.wait(timeout=ticket.limiter.poll_interval):
+            yield ticket.position
+    finally:
+        ticket.cancel()
+
+
+# Function to follow a queued request asynchronously
+async def aqueue_positions(ticket: Ticket) -> AsyncIterator[int]:
+    """
+    This function is the asynchronous counterpart of queue_positions.
+
+    Parameters:
+    ticket (Ticket): The ticket of the request.
+
+    Returns:
+    AsyncIterator[int]: The positions of the request while it waits.
+    """
+    try:
+        while not await ticket.await_admission(timeout=ticket.limiter.poll_interval):
+            yield ticket.position
+    finally:
+        ticket.cancel()
+
+
+# Function to describe a queued request
+def queue_message(bot_backend: BotBackend, position: int) -> str:
+    """
+    This function builds the text shown in the chat while a request waits in the queue.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend sending the request.
+    position (int): The position of the request in the queue.
+
+    Returns:
+    str: The text to show.
+    """
+    return f'⏳ {bot_backend.gpt_model_choice} is at its rate limit, your request is number {position} in the queue…'
@@ -0,0 +1,332 @@
+from parse_response import *
+from benchmark import print_table
+from collections import deque
+import argparse
+import glob
+import time
+import tracemalloc
+
+
+# Class to record streamed responses
+class StreamRecorder:
+    """
+    Records the raw chunks of streamed responses, and the responses of the functions they call, into a JSONL file.
+
+    Each line is a record with a 'type' key: a 'message' record holds the message of the user that started the turn,
+    'chunk' records hold a chunk exactly as it was received from chat_completion, and 'function_response' records hold
+    what the called function returned, so a function call can be replayed without running its code. Images output by
+    the code are kept base64 encoded in the function responses.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open the recording file for appending.
+
+        Parameters:
+        path (str): The path of the JSONL file.
+        """
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record_message(self, message: str):
+        """
+        Write the message of the user that starts a turn.
+
+        Parameters:
+        message (str): The message of the user.
+        """
+        self._write({'type': 'message', 'content': message})
+
+    def record(self, response: Iterable) -> Iterator:
+        """
+        Pass a stream through while writing its chunks to the recording.
+
+        Parameters:
+        response (Iterable): The stream of chunks returned by chat_completion.
+
+        Returns:
+        Iterator: The same stream of chunks.
+        """
+        for chunk in response:
+            self._write({'type': 'chunk', 'chunk': chunk})
+            yield chunk
+
+    def attach(self, bot_backend: BotBackend):
+        """
+        Record the responses of the code executed by a bot backend.
+
+        Parameters:
+        bot_backend (BotBackend): The bot backend whose execute_code calls are recorded.
+        """
+        execute_code = bot_backend.execute_code
+
+        def recording_execute_code(code: str):
+            text_to_gpt, content_to_display = execute_code(code)
+            self._write({
+                'type': 'function_response',
+                'text_to_gpt': text_to_gpt,
+                'content_to_display': content_to_display
+            })
+            return text_to_gpt, content_to_display
+
+        bot_backend.execute_code = recording_execute_code
+
+    def close(self):
+        """
+        Close the recording file.
+        """
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, record: Dict):
+        """
+        Write a record as a line of the recording.
+
+        Parameters:
+        record (Dict): The record to write.
+        """
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+
+# Class for a bot backend replaying recorded function responses
+class ReplayBotBackend(BotBackend):
+    """
+    Bot backend whose execute_code returns the recorded function responses in order instead of running the code.
+    """
+
+    def __init__(self, function_responses: List[Dict]):
+        """
+        Initialize the bot backend with the function responses to replay.
+
+        Parameters:
+        function_responses (List[Dict]): The 'function_response' records of a recording.
+        """
+        super().__init__()
+        self.function_responses = deque(function_responses)
+
+    def execute_code(self, code: str) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Return the next recorded function response.
+
+        Parameters:
+        code (str): The code the recorded response was produced by, ignored.
+
+        Returns:
+        Tuple[str, List[Tuple[str, str]]]: The text sent back to GPT and the content to display.
+        """
+        if not self.function_responses:
+            raise RuntimeError('The recording has no more function responses')
+        record = self.function_responses.popleft()
+        return record['text_to_gpt'], [tuple(item) for item in record['content_to_display']]
+
+
+# Function to load a recording
+def load_recording(path: str) -> Tuple[str, List[Dict], List[Dict]]:
+    """
+    This function reads a JSONL recording.
+
+    Parameters:
+    path (str): The path of the JSONL file.
+
+    Returns:
+    Tuple[str, List[Dict], List[Dict]]: The first recorded message of the user, the recorded chunks and the recorded
+    function responses.
+    """
+    message, chunks, function_responses = '', [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['type'] == 'message' and not message:
+                message = record['content']
+            elif record['type'] == 'chunk':
+                chunks.append(record['chunk'])
+            elif record['type'] == 'function_response':
+                function_responses.append(record)
+    return message, chunks, function_responses
+
+
+# Function to record a chat turn
+def record_turn(message: str, path: str, gpt_model_choice: str = None) -> List:
+    """
+    This function sends a message with a fresh bot backend and records every response of the turn, including the
+    responses that follow a function call, the way the bot function of the UI runs a turn.
+
+    Parameters:
+    message (str): The message of the user.
+    path (str): The path of the JSONL file the turn is appended to.
+    gpt_model_choice (str): The model to use. Defaults to the model of a new bot backend.
+
+    Returns:
+    List: The history of the turn.
+    """
+    bot_backend = BotBackend()
+    if gpt_model_choice is not None:
+        bot_backend.update_gpt_model_choice(gpt_model_choice)
+    bot_backend.add_text_message(user_text=message)
+    history = [[message, None]]
+
+    try:
+        with StreamRecorder(path) as recorder:
+            recorder.record_message(message)
+            recorder.attach(bot_backend)
+            while bot_backend.finish_reason in ('new_input', 'function_call'):
+                if history[-1][0] is None:
+                    history.append([None, ''])
+                else:
+                    history[-1][1] = ''
+                response = recorder.record(chat_completion(bot_backend=bot_backend, use_cache=False))
+                for chunk in response:
+                    history, whether_exit = parse_response(chunk=chunk, history=history, bot_backend=bot_backend)
+                    if whether_exit:
+                        return history
+    finally:
+        bot_backend.close()
+    return history
+
+
+# Class for a hook timing the strategies
+class StrategyTimerHook(ChoiceHook):
+    """
+    Hook accumulating the time spent in each strategy.
+    """
+
+    def __init__(self):
+        self.strategy_times: Dict[str, float] = {}
+
+    def after_strategy(self, strategy: ChoiceStrategy, choice: Dict, bot_backend: BotBackend, elapsed: float):
+        name = type(strategy).__name__
+        self.strategy_times[name] = self.strategy_times.get(name, 0.0) + elapsed
+
+
+# Function to feed chunks through parse_response
+def feed(message: str, chunks: List[Dict], function_responses: List[Dict],
+         handler: ChoiceHandler = None) -> Tuple[int, List]:
+    """
+    This function feeds recorded chunks through parse_response with a fresh bot backend, as the bot function of the UI
+    does, and returns the elapsed time. Like the bot function, it starts a new history row for each response.
+
+    Parameters:
+    message (str): The recorded message of the user.
+    chunks (List[Dict]): The recorded chunks.
+    function_responses (List[Dict]): The recorded function responses.
+    handler (ChoiceHandler): A handler to send the choices to directly instead of calling parse_response.
+
+    Returns:
+    Tuple[int, List]: The elapsed nanoseconds and the final history.
+    """
+    bot_backend = ReplayBotBackend(function_responses=function_responses)
+    bot_backend.add_text_message(user_text=message)
+    history = [[message, None]]
+    new_response = True
+    try:
+        start = time.perf_counter_ns()
+        for chunk in chunks:
+            if new_response:
+                if history[-1][0] is None:
+                    history.append([None, ''])
+                else:
+                    history[-1][1] = ''
+                new_response = False
+            if handler is None:
+                history, whether_exit = parse_response(
+                    chunk=chunk, history=history, bot_backend=bot_backend, sync_history=False
+                )
+            elif chunk['choices']:
+                history, whether_exit = handler.handle(
+                    choice=chunk['choices'][0], bot_backend=bot_backend, history=history, whether_exit=False
+                )
+            else:
+                continue
+            if whether_exit:
+                break
+            if chunk['choices'] and chunk['choices'][0]['finish_reason'] is not None:
+                new_response = True
+        bot_backend.sync_content_row()
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        bot_backend.close()
+    return elapsed, history
+
+
+# Function to replay a recording
+def replay(path: str, repeat: int = 5) -> Dict:
+    """
+    This function replays a recording through parse_response and measures its throughput, the time spent in each
+    strategy and the memory allocated.
+
+    The throughput is the best of several plain runs. The strategies are timed in a separate run, by a hook on a
+    separate handler, so timing them does not slow down the measured throughput, and the allocations are traced in a
+    third run.
+
+    Parameters:
+    path (str): The path of the JSONL recording.
+    repeat (int): The number of plain runs.
+
+    Returns:
+    Dict: The number of chunks, the chunks per second, the microseconds spent in each strategy, and the number of
+    allocated blocks still alive and the peak traced memory after the replay.
+    """
+    message, chunks, function_responses = load_recording(path)
+
+    best = min(feed(message, chunks, function_responses)[0] for _ in range(repeat))
+
+    timer = StrategyTimerHook()
+    timed_handler = ChoiceHandler()
+    timed_handler.add_hook(timer)
+    feed(message, chunks, function_responses, handler=timed_handler)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        _, history = feed(message, chunks, function_responses)
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+    return {
+        'recording': os.path.basename(path),
+        'chunks': len(chunks),
+        'chunks_per_sec': len(chunks) / (best / 1e9) if best else float('inf'),
+        **{f'{type(strategy).__name__}_us': timer.strategy_times.get(type(strategy).__name__, 0.0) * 1e6
+           for strategy in timed_handler.strategy_instances},
+        'retained_blocks': retained_blocks,
+        'peak_kib': peak / 1024
+    }
+
+
+# Main function
+if __name__ == '__main__':
+    """
+    This is the main function that gets executed when the script is run directly.
+    It records a chat turn, or replays recordings and prints their measurements.
+    """
+    parser = argparse.ArgumentParser(description='Record streamed responses and replay them through parse_response')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='send a message and record the responses of the turn')
+    record_parser.add_argument('message')
+    record_parser.add_argument('--out', required=True, help='JSONL file the turn is appended to')
+    record_parser.add_argument('--model', default=None, help='model entry of config.json to use')
+
+    replay_parser = subparsers.add_parser('replay', help='replay recordings through parse_response')
+    replay_parser.add_argument('paths', nargs='*', default=[os.path.join('fixtures', '*.jsonl')])
+    replay_parser.add_argument('--repeat', type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        for row in record_turn(message=args.message, path=args.out, gpt_model_choice=args.model):
+            print(row)
+    elif args.command == 'replay':
+        paths = sorted(path for pattern in args.paths for path in glob.glob(pattern))
+        print_table([replay(path, repeat=args.repeat) for path in paths])
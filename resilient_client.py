@@ -0,0 +1,440 @@
+import asyncio
+import queue
+import random
+import threading
+import time
+import aiohttp
+import openai
+import requests
+from api_client import arequest_options, get_http_config, get_http_session, request_options
+from metrics import MetricsRegistry
+from typing import *
+
+# Default settings of the request retries, overridden by the 'retry' section of the configuration
+DEFAULT_RETRY_CONFIG = {
+    'max_attempts': 4,
+    'base_delay': 0.5,
+    'max_delay': 8.0,
+    'retry_statuses': [408, 409, 429, 500, 502, 503, 504],
+    'hedge_after': None
+}
+
+# Errors raised without an HTTP status that are worth retrying
+TRANSIENT_ERRORS = (
+    openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain,
+    openai.error.ServiceUnavailableError, requests.RequestException, aiohttp.ClientError, asyncio.TimeoutError,
+    ConnectionError
+)
+
+
+# Function to get the retry configuration
+def get_retry_config(config: Dict) -> Dict:
+    """
+    This function merges the 'retry' section of the configuration with the default settings.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    Dict: The retry settings.
+    """
+    return {**DEFAULT_RETRY_CONFIG, **config.get('retry', {})}
+
+
+# Function to get the endpoints of a model
+def get_endpoints(config: Dict, model_choice: str, api_settings: Dict = None) -> List[Dict]:
+    """
+    This function returns the endpoints serving a model, in the order they are tried. A model entry may list its
+    endpoints under 'endpoints', each with the same keys as the top level of the configuration ('API_TYPE',
+    'API_base', 'API_VERSION', 'API_KEY') and a 'model_name' or, for Azure, an 'engine'. Missing keys default to the
+    API settings of the bot backend, or the top level of the configuration, and to the model entry. Without
+    'endpoints', the model is served by that API only.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+    model_choice (str): The model entry.
+    api_settings (Dict): The api_type, api_base, api_version and api_key of the bot backend, or None to read them
+    from the top level of the configuration.
+
+    Returns:
+    List[Dict]: The endpoints, each with the 'api_settings' of its requests and the 'model_kwargs' naming the model.
+    """
+    if api_settings is None:
+        api_settings = {
+            'api_type': config['API_TYPE'], 'api_base': config['API_base'],
+            'api_version': config['API_VERSION'], 'api_key': config['API_KEY']
+        }
+    model_config = config['model'][model_choice]
+    endpoints = []
+    for entry in model_config.get('endpoints') or [{}]:
+        api_type = entry.get('API_TYPE', api_settings['api_type'])
+        model_name = entry.get('engine') or entry.get('model_name') or model_config['model_name']
+        endpoints.append({
+            'api_settings': {
+                'api_type': api_type,
+                'api_base': entry.get('API_base', api_settings['api_base']),
+                'api_version': entry.get('API_VERSION', api_settings['api_version']),
+                'api_key': entry.get('API_KEY') or api_settings['api_key']
+            },
+            'model_kwargs': {'engine': model_name} if api_type == 'azure' else {'model': model_name}
+        })
+    return endpoints
+
+
+# Function to tell whether a failed request should be retried
+def is_retryable(error: BaseException, retry_config: Dict) -> bool:
+    """
+    This function tells whether a request that failed before streaming its first chunk should be retried.
+
+    Parameters:
+    error (BaseException): The error raised by the request.
+    retry_config (Dict): The retry settings.
+
+    Returns:
+    bool: True for the HTTP statuses listed in 'retry_statuses' and for connection errors and timeouts.
+    """
+    status = getattr(error, 'http_status', None)
+    if status is not None:
+        return status in retry_config['retry_statuses']
+    return isinstance(error, TRANSIENT_ERRORS) or type(error) is openai.error.APIError
+
+
+# Function to compute the delay before a retry
+def backoff_delay(attempt: int, retry_config: Dict, error: BaseException = None) -> float:
+    """
+    This function computes the delay before retrying a request, with full-jitter exponential backoff: a random delay
+    between 0 and base_delay * 2 ** attempt, capped at max_delay. A Retry-After header sent with the error is
+    honoured, within max_delay.
+
+    Parameters:
+    attempt (int): The number of the failed attempt, starting at 0.
+    retry_config (Dict): The retry settings.
+    error (BaseException): The error raised by the failed attempt.
+
+    Returns:
+    float: The delay in seconds.
+    """
+    delay = random.uniform(0, min(retry_config['max_delay'], retry_config['base_delay'] * 2 ** attempt))
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('retry-after', headers.get('Retry-After', 0)))
+    except (TypeError, ValueError):
+        retry_after = 0
+    return min(max(delay, retry_after), retry_config['max_delay'])
+
+
+# Class for a resilient chat completion request
+class ResilientCompletion:
+    """
+    Chat completion request sent to the endpoints of a model with retries, failover and optional hedging.
+
+    An attempt succeeds once the first chunk of its stream has arrived; a failure before that is retried on the next
+    endpoint after a jittered exponential backoff, up to max_attempts attempts. Once a chunk has been received the
+    stream is returned as is, since retrying it would repeat content already shown. With hedge_after set, an attempt
+    whose first chunk has not arrived after hedge_after seconds is raced against a second request to the next
+    endpoint, and whichever streams first is kept while the other is abandoned.
+    """
+
+    def __init__(self, config: Dict, kwargs_for_chat_completion: Dict, endpoints: List[Dict],
+                 metrics: MetricsRegistry = None, metric_labels: Dict = None):
+        """
+        Initialize the request.
+
+        Parameters:
+        config (Dict): The configuration dictionary.
+        kwargs_for_chat_completion (Dict): The arguments of the request, the model is named by the endpoint.
+        endpoints (List[Dict]): The endpoints to try, see get_endpoints.
+        metrics (MetricsRegistry): The metrics registry, or None if metrics are disabled.
+        metric_labels (Dict): The labels of the metrics of the request.
+        """
+        self.config = config
+        self.retry_config = get_retry_config(config)
+        self.kwargs = {key: value for key, value in kwargs_for_chat_completion.items() if key not in ('model', 'engine')}
+        self.endpoints = endpoints
+        self.metrics = metrics
+        self.metric_labels = metric_labels or {}
+
+    def create(self) -> Iterator:
+        """
+        Send the request, retrying and hedging as configured.
+
+        Returns:
+        Iterator: The stream of chunks of the successful attempt.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.retry_config['hedge_after'] is None:
+                    return self._open(self.endpoints[attempt % len(self.endpoints)])
+                return self._hedge(attempt)
+            except Exception as e:
+                if attempt + 1 >= self.retry_config['max_attempts'] or not is_retryable(e, self.retry_config):
+                    raise
+                time.sleep(self._retry_delay(attempt, e))
+                attempt += 1
+
+    async def acreate(self) -> AsyncIterator:
+        """
+        Asynchronous counterpart of create.
+
+        Returns:
+        AsyncIterator: The stream of chunks of the successful attempt.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.retry_config['hedge_after'] is None:
+                    return await self._aopen(self.endpoints[attempt % len(self.endpoints)])
+                return await self._ahedge(attempt)
+            except Exception as e:
+                if attempt + 1 >= self.retry_config['max_attempts'] or not is_retryable(e, self.retry_config):
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, e))
+                attempt += 1
+
+    def _retry_delay(self, attempt: int, error: BaseException) -> float:
+        """
+        Compute the delay before retrying a failed attempt, and observe it in the metrics.
+
+        Parameters:
+        attempt (int): The number of the failed attempt, starting at 0.
+        error (BaseException): The error raised by the failed attempt.
+
+        Returns:
+        float: The delay in seconds.
+        """
+        delay = backoff_delay(attempt, self.retry_config, error)
+        if self.metrics is not None:
+            self.metrics.observe('wiztalk_completion_retry_delay_seconds', delay, **self.metric_labels)
+        return delay
+
+    def _open(self, endpoint: Dict) -> Iterator:
+        """
+        Send the request to an endpoint and wait for its first chunk.
+
+        Parameters:
+        endpoint (Dict): The endpoint.
+
+        Returns:
+        Iterator: The stream of chunks, starting with the first chunk.
+        """
+        start = time.perf_counter()
+        response = openai.ChatCompletion.create(
+            **self.kwargs, **endpoint['model_kwargs'],
+            **request_options(config=self.config, api_settings=endpoint['api_settings'])
+        )
+        if not self.kwargs.get('stream'):
+            return response
+        stream = OpenedStream(response, get_http_session(get_http_config(self.config)).last_response())
+        if self.metrics is not None:
+            stream.chunks = self.metrics.instrument_stream(response, start, **self.metric_labels)
+        try:
+            stream.first_chunks.append(next(stream.chunks))
+        except StopIteration:
+            pass
+        except BaseException:
+            stream.close()
+            raise
+        return stream
+
+    async def _aopen(self, endpoint: Dict) -> AsyncIterator:
+        """
+        Asynchronous counterpart of _open.
+
+        Parameters:
+        endpoint (Dict): The endpoint.
+
+        Returns:
+        AsyncIterator: The stream of chunks, starting with the first chunk.
+        """
+        start = time.perf_counter()
+        response = await openai.ChatCompletion.acreate(
+            **self.kwargs, **endpoint['model_kwargs'],
+            **arequest_options(config=self.config, api_settings=endpoint['api_settings'])
+        )
+        if not self.kwargs.get('stream'):
+            return response
+        stream = AsyncOpenedStream(response)
+        if self.metrics is not None:
+            stream.chunks = self.metrics.ainstrument_stream(response, start, **self.metric_labels)
+        try:
+            stream.first_chunks.append(await stream.chunks.__anext__())
+        except StopAsyncIteration:
+            pass
+        except BaseException:
+            await stream.aclose()
+            raise
+        return stream
+
+    def _hedge(self, attempt: int) -> Iterator:
+        """
+        Race the attempt against a second request to the next endpoint if its first chunk is late.
+
+        Parameters:
+        attempt (int): The number of the attempt, selecting the endpoints.
+
+        Returns:
+        Iterator: The stream of the request that streamed first.
+        """
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {'winner': None}
+
+        def run(endpoint):
+            try:
+                stream = self._open(endpoint)
+            except Exception as e:
+                results.put((None, e))
+                return
+            with lock:
+                won = state['winner'] is None
+                if won:
+                    state['winner'] = stream
+            if won:
+                results.put((stream, None))
+            else:
+                stream.close()
+
+        def start(index):
+            endpoint = self.endpoints[index % len(self.endpoints)]
+            threading.Thread(target=run, args=(endpoint,), name='hedged-request', daemon=True).start()
+
+        start(attempt)
+        running = 1
+        try:
+            stream, error = results.get(timeout=self.retry_config['hedge_after'])
+        except queue.Empty:
+            start(attempt + 1)
+            running = 2
+            stream, error = results.get()
+        running -= 1
+        while stream is None and running:
+            stream, error = results.get()
+            running -= 1
+        if stream is None:
+            raise error
+        return stream
+
+    async def _ahedge(self, attempt: int) -> AsyncIterator:
+        """
+        Asynchronous counterpart of _hedge.
+
+        Parameters:
+        attempt (int): The number of the attempt, selecting the endpoints.
+
+        Returns:
+        AsyncIterator: The stream of the request that streamed first.
+        """
+        def start(index):
+            return asyncio.ensure_future(self._aopen(self.endpoints[index % len(self.endpoints)]))
+
+        pending = {start(attempt)}
+        done, pending = await asyncio.wait(pending, timeout=self.retry_config['hedge_after'])
+        if not done:
+            pending.add(start(attempt + 1))
+        error = None
+        try:
+            while True:
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        await task.result().aclose()
+                if winner is not None:
+                    return winner
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(close_abandoned_stream)
+
+
+# Class for the stream of a successful attempt
+class OpenedStream:
+    """
+    Stream of chunks of an attempt whose first chunk has arrived. Closing it closes the HTTP response it reads, so an
+    abandoned stream, like the losing request of a hedge, releases its connection and stops reading tokens.
+    """
+
+    def __init__(self, chunks: Iterator, http_response=None):
+        """
+        Initialize the stream.
+
+        Parameters:
+        chunks (Iterator): The chunks of the response.
+        http_response (requests.Response): The HTTP response streaming the chunks, or None if it is not known.
+        """
+        self.chunks = chunks
+        self.http_response = http_response
+        self.first_chunks: List = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first_chunks:
+            return self.first_chunks.pop()
+        return next(self.chunks)
+
+    def close(self):
+        """
+        Stop the stream and close its HTTP response.
+        """
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        if self.http_response is not None:
+            self.http_response.close()
+
+
+# Class for the asynchronous stream of a successful attempt
+class AsyncOpenedStream:
+    """
+    Asynchronous counterpart of OpenedStream. Closing it closes the stream returned by the openai module, which
+    releases its HTTP response.
+    """
+
+    def __init__(self, response: AsyncIterator):
+        """
+        Initialize the stream.
+
+        Parameters:
+        response (AsyncIterator): The stream returned by the openai module.
+        """
+        self.response = response
+        self.chunks = response
+        self.first_chunks: List = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.first_chunks:
+            return self.first_chunks.pop()
+        return await self.chunks.__anext__()
+
+    async def aclose(self):
+        """
+        Stop the stream and release its HTTP response.
+        """
+        if self.chunks is not self.response and hasattr(self.chunks, 'aclose'):
+            await self.chunks.aclose()
+        if hasattr(self.response, 'aclose'):
+            await self.response.aclose()
+
+
+# Function to close the stream of a hedged request abandoned by its caller
+def close_abandoned_stream(task: asyncio.Task):
+    """
+    This function closes the stream of a hedged request cancelled by the caller, if the request had succeeded
+    before the cancellation reached it.
+
+    Parameters:
+    task (asyncio.Task): The task of the request.
+    """
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
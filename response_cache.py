@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+# Default settings of the response cache, overridden by the 'response_cache' section of the configuration
+DEFAULT_RESPONSE_CACHE_CONFIG = {
+    'enabled': True,
+    'memory_entries': 256,
+    'disk_directory': 'cache/responses',
+    'disk_max_bytes': 50 * 1024 * 1024,
+    'ttl_seconds': 24 * 60 * 60
+}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+# Class for the completion response cache
+class ResponseCache:
+    """
+    Two-tier cache of streamed chat completion responses.
+
+    A response is stored as the list of its chunks, serialized to JSON, under a hash of all the arguments of the
+    request, and expires ttl_seconds after it was stored. The memory tier keeps the most recently used entries; the
+    disk tier keeps one file per entry, written to a temporary file first and renamed into place outside the lock, and
+    evicts the least recently used files once its total size exceeds the limit. The modification time of a file is the
+    time its entry was stored, and its access time the time it was last used. A file that cannot be read or decoded is
+    forgotten like a missing one. Cached responses are replayed as a stream of chunks, so parse_response handles them
+    exactly like a live response.
+    """
+
+    def __init__(self, memory_entries: int, disk_directory: Union[str, None], disk_max_bytes: int, ttl_seconds: float):
+        """
+        Initialize the cache and index the entries already stored on disk.
+
+        Parameters:
+        memory_entries (int): The maximum number of entries of the memory tier.
+        disk_directory (str): The directory of the disk tier, or None to disable it.
+        disk_max_bytes (int): The maximum total size of the disk tier in bytes.
+        ttl_seconds (float): The number of seconds a response stays cached.
+        """
+        self.memory_entries = memory_entries
+        self.disk_directory = disk_directory
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.memory: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.disk_index: OrderedDict[str, Tuple[int, float]] = OrderedDict()
+        self.disk_bytes = 0
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0}
+        self.lock = threading.Lock()
+
+        if self.disk_directory is not None:
+            os.makedirs(self.disk_directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.disk_directory):
+                if entry.is_file() and entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, entry.name[:-len('.json')], stat.st_size, stat.st_mtime))
+                elif entry.is_file() and entry.name.endswith('.tmp'):
+                    # Left over by a write interrupted by the end of the process
+                    os.remove(entry.path)
+            for _, key, size, stored_at in sorted(entries):
+                self.disk_index[key] = (size, stored_at)
+                self.disk_bytes += size
+
+    @staticmethod
+    def make_key(kwargs_for_chat_completion: Dict) -> str:
+        """
+        Compute the cache key of a request.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request, including its model, messages and functions.
+
+        Returns:
+        str: The hexadecimal SHA-256 hash of the arguments.
+        """
+        payload = json.dumps(kwargs_for_chat_completion, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Union[List[Dict], None]:
+        """
+        Look up a response in the memory tier, then in the disk tier.
+
+        Parameters:
+        key (str): The cache key.
+
+        Returns:
+        List[Dict]: A fresh copy of the cached chunks.
+        None: If the response is not cached, or has expired.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return json.loads(entry[1])
+            self.memory.pop(key, None)
+            disk_entry = self.disk_index.get(key)
+            if disk_entry is not None and now - disk_entry[1] > self.ttl_seconds:
+                self._forget_disk_entry(key)
+                disk_entry = None
+            if disk_entry is None:
+                self.counters['misses'] += 1
+                return None
+
+        # The file is read outside the lock, so a slow disk does not hold up the memory hits of other requests
+        _, stored_at = disk_entry
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                serialized = f.read()
+            chunks = json.loads(serialized)
+            os.utime(path, (now, stored_at))
+        except (OSError, ValueError):
+            chunks = None
+        with self.lock:
+            if chunks is None:
+                if self.disk_index.get(key) == disk_entry:
+                    self._forget_disk_entry(key)
+                self.counters['misses'] += 1
+                return None
+            if key in self.disk_index:
+                self.disk_index.move_to_end(key)
+            self._remember(key, stored_at, serialized)
+            self.counters['disk_hits'] += 1
+            return chunks
+
+    def contains(self, key: str) -> bool:
+        """
+        Tell whether a response is cached and not expired, without reading it or counting a hit or a miss.
+
+        Parameters:
+        key (str): The cache key.
+
+        Returns:
+        bool: True if the response is in either tier.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                return True
+            disk_entry = self.disk_index.get(key)
+            return disk_entry is not None and now - disk_entry[1] <= self.ttl_seconds
+
+    def put(self, key: str, chunks: List[Dict]):
+        """
+        Store a response in both tiers.
+
+        Parameters:
+        key (str): The cache key.
+        chunks (List[Dict]): The chunks of the response.
+        """
+        serialized = json.dumps(chunks, ensure_ascii=False)
+        stored_at = time.time()
+        with self.lock:
+            self._remember(key, stored_at, serialized)
+            self.counters['stores'] += 1
+        if self.disk_directory is None:
+            return
+        data = serialized.encode('utf-8')
+        if len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.utime(temp_path, (stored_at, stored_at))
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self._forget_disk_entry(key, delete=False)
+            self.disk_index[key] = (len(data), stored_at)
+            self.disk_bytes += len(data)
+            while self.disk_bytes > self.disk_max_bytes and self.disk_index:
+                self._forget_disk_entry(next(iter(self.disk_index)))
+
+    def stats(self) -> Dict:
+        """
+        Return the hit and miss counters and the size of both tiers.
+
+        Returns:
+        Dict: The cache statistics.
+        """
+        with self.lock:
+            return {
+                **self.counters,
+                'memory_entries': len(self.memory),
+                'disk_entries': len(self.disk_index),
+                'disk_bytes': self.disk_bytes
+            }
+
+    @staticmethod
+    def replay(chunks: List[Dict]) -> Iterator[Dict]:
+        """
+        Replay cached chunks as a synchronous stream.
+
+        Parameters:
+        chunks (List[Dict]): The cached chunks.
+
+        Returns:
+        Iterator[Dict]: The stream of chunks.
+        """
+        yield from chunks
+
+    @staticmethod
+    async def areplay(chunks: List[Dict]) -> AsyncIterator[Dict]:
+        """
+        Replay cached chunks as an asynchronous stream.
+
+        Parameters:
+        chunks (List[Dict]): The cached chunks.
+
+        Returns:
+        AsyncIterator[Dict]: The stream of chunks.
+        """
+        for chunk in chunks:
+            yield chunk
+
+    def record(self, key: str, response: Iterable) -> Iterator:
+        """
+        Pass a live stream through while recording its chunks, and store them once the response has finished with
+        the 'stop' finish reason. Interrupted responses and function calls are not cached.
+
+        Parameters:
+        key (str): The cache key.
+        response (Iterable): The live stream of chunks.
+
+        Returns:
+        Iterator: The same stream of chunks.
+        """
+        chunks = []
+        for chunk in response:
+            chunks.append(chunk)
+            yield chunk
+        if self._is_complete(chunks):
+            self.put(key, chunks)
+
+    async def arecord(self, key: str, response: AsyncIterable) -> AsyncIterator:
+        """
+        Asynchronous counterpart of record. The response is stored in a worker thread, so writing its file does not
+        block the event loop.
+
+        Parameters:
+        key (str): The cache key.
+        response (AsyncIterable): The live stream of chunks.
+
+        Returns:
+        AsyncIterator: The same stream of chunks.
+        """
+        chunks = []
+        async for chunk in response:
+            chunks.append(chunk)
+            yield chunk
+        if self._is_complete(chunks):
+            import asyncio
+            await asyncio.to_thread(self.put, key, chunks)
+
+    @staticmethod
+    def _is_complete(chunks: List[Dict]) -> bool:
+        """
+        Tell whether recorded chunks form a complete, cacheable response.
+
+        Parameters:
+        chunks (List[Dict]): The recorded chunks.
+
+        Returns:
+        bool: True if the last choice finished with the 'stop' finish reason.
+        """
+        for chunk in reversed(chunks):
+            if chunk['choices']:
+                return chunk['choices'][0]['finish_reason'] == 'stop'
+        return False
+
+    def _remember(self, key: str, stored_at: float, serialized: str):
+        """
+        Store a serialized response in the memory tier, evicting the least recently used entries.
+
+        Parameters:
+        key (str): The cache key.
+        stored_at (float): The time the response was stored, in seconds since the epoch.
+        serialized (str): The serialized chunks.
+        """
+        self.memory[key] = (stored_at, serialized)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        """
+        Return the path of the file of a disk entry.
+
+        Parameters:
+        key (str): The cache key.
+
+        Returns:
+        str: The path of the file.
+        """
+        return os.path.join(self.disk_directory, f'{key}.json')
+
+    def _forget_disk_entry(self, key: str, delete: bool = True):
+        """
+        Remove an entry from the disk index, and optionally delete its file.
+
+        Parameters:
+        key (str): The cache key.
+        delete (bool): Whether to delete the file of the entry.
+        """
+        entry = self.disk_index.pop(key, None)
+        if entry is not None:
+            self.disk_bytes -= entry[0]
+        if delete:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+
+# Function to get the process-wide response cache
+def get_response_cache(config: Dict) -> Union[ResponseCache, None]:
+    """
+    This function returns the response cache shared by all bot backends, creating it on first use from the
+    'response_cache' section of the configuration.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    ResponseCache: The shared response cache, or None if the cache is disabled.
+    """
+    global _response_cache
+    cache_config = {**DEFAULT_RESPONSE_CACHE_CONFIG, **config.get('response_cache', {})}
+    if not cache_config['enabled']:
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    memory_entries=cache_config['memory_entries'],
+                    disk_directory=cache_config['disk_directory'],
+                    disk_max_bytes=cache_config['disk_max_bytes'],
+                    ttl_seconds=cache_config['ttl_seconds']
+                )
+    return _response_cache
+
+
+# Function to get the statistics of the response cache
+def response_cache_stats() -> Dict:
+    """
+    This function returns the hit and miss counters of the response cache, or an empty dictionary if it has not been
+    created.
+
+    Returns:
+    Dict: The cache statistics.
+    """
+    if _response_cache is None:
+        return {}
+    return _response_cache.stats()
@@ -0,0 +1,343 @@
+from backend import *
+from session_store import get_session_store
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Default settings of the session manager, overridden by the 'sessions' section of the configuration
+DEFAULT_SESSIONS_CONFIG = {
+    'max_sessions': 500,
+    'max_memory_bytes': 512 * 1024 * 1024,
+    'idle_timeout': 1800,
+    'reap_interval': 60,
+    'spill_to_disk': True,
+    'spill_directory': 'cache/sessions'
+}
+
+_session_manager = None
+_session_manager_lock = threading.Lock()
+
+
+# Function to estimate the memory used by a bot backend
+def estimate_session_memory(bot_backend: BotBackend) -> int:
+    """
+    This function estimates the memory held by a bot backend: the size of the strings of its conversation, plus the
+    size of the records holding them. The system message and the roles, shared by all sessions, are not counted.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend instance.
+
+    Returns:
+    int: The estimated number of bytes.
+    """
+    total = sys.getsizeof(bot_backend.conversation)
+    for message in bot_backend.conversation:
+        if message is system_message:
+            continue
+        total += sys.getsizeof(message)
+        for value in (message.content, message.name):
+            if isinstance(value, str):
+                total += sys.getsizeof(value)
+        if message.function_call is not None:
+            total += sys.getsizeof(message.function_call) + sum(
+                sys.getsizeof(value) for value in message.function_call.values())
+    return total
+
+
+# Class for the session registry
+class SessionManager:
+    """
+    Registry of the bot backends of all sessions, keyed by their unique_id.
+
+    The Gradio state of a session only holds its unique_id, so the registry decides how long a bot backend stays in
+    memory. It tracks when each session was last active and estimates its memory. Sessions idle for longer than
+    idle_timeout are evicted, and the least recently active sessions are evicted whenever the number of sessions or
+    their total memory exceeds its limit. Sessions in the middle of a turn are never evicted. The sessions to evict are
+    picked with the lock held, but evicted after it is released, so a slow disk or kernel does not hold up the other
+    sessions. An evicted session is spilled to disk if enabled, and rehydrated the next time it is requested; a session
+    requested while it is being spilled is taken back as it is. A session is rehydrated without the lock held, so
+    reading it does not hold up the other sessions; concurrent requests for it wait for the first one to rehydrate it.
+    With the session store enabled, the session is spilled by saving its last messages to the store instead of writing
+    a spill file, and a session unknown to the registry, for example after the process restarted, is rehydrated from
+    the store.
+    """
+
+    def __init__(self, sessions_config: Dict):
+        """
+        Initialize the registry and start the reaper thread.
+
+        Parameters:
+        sessions_config (Dict): The session manager settings.
+        """
+        self.max_sessions = sessions_config['max_sessions']
+        self.max_memory_bytes = sessions_config['max_memory_bytes']
+        self.idle_timeout = sessions_config['idle_timeout']
+        self.reap_interval = sessions_config['reap_interval']
+        self.spill_directory = sessions_config['spill_directory'] if sessions_config['spill_to_disk'] else None
+
+        self.sessions: OrderedDict[str, BotBackend] = OrderedDict()
+        self.last_active: Dict[str, float] = {}
+        self.memory: Dict[str, int] = {}
+        self.spilling: Dict[str, Tuple[BotBackend, object]] = {}
+        self.rehydrating: Dict[str, threading.Event] = {}
+        self.counters = {'created': 0, 'evicted': 0, 'spilled': 0, 'rehydrated': 0}
+        self.lock = threading.RLock()
+
+        if self.spill_directory is not None:
+            os.makedirs(self.spill_directory, exist_ok=True)
+
+        reaper = threading.Thread(target=self._reap_forever, name='session-reaper', daemon=True)
+        reaper.start()
+
+    def get(self, unique_id: Union[str, None]) -> BotBackend:
+        """
+        Return the bot backend of a session, rehydrating it from disk if it was spilled, or create a new session if it
+        is unknown.
+
+        Parameters:
+        unique_id (str): The unique id of the session, or None for a new session.
+
+        Returns:
+        BotBackend: The bot backend of the session.
+        """
+        while True:
+            with self.lock:
+                bot_backend = self.sessions.get(unique_id) if unique_id is not None else None
+                if bot_backend is None:
+                    bot_backend, _ = self.spilling.pop(unique_id, (None, None))
+                if bot_backend is not None or unique_id is None:
+                    bot_backend, candidates = self._register(bot_backend)
+                    break
+                rehydrating = self.rehydrating.get(unique_id)
+                leader = rehydrating is None
+                if leader:
+                    rehydrating = self.rehydrating[unique_id] = threading.Event()
+            if leader:
+                # Read the session without the lock, then register it unless another request registered it meanwhile
+                try:
+                    bot_backend = self._rehydrate(unique_id)
+                    with self.lock:
+                        bot_backend, candidates = self._register(bot_backend, rehydrated=True)
+                finally:
+                    with self.lock:
+                        del self.rehydrating[unique_id]
+                        rehydrating.set()
+                break
+            # Another request is rehydrating the session, look it up again once it is done
+            rehydrating.wait()
+        for candidate in candidates:
+            self.evict(candidate)
+        return bot_backend
+
+    def evict(self, unique_id: str, spill: bool = True):
+        """
+        Remove a session from memory. A spilled session keeps its files and can be rehydrated; otherwise the session
+        ends and its files are removed. Either way, its last messages are saved to the session store if it is enabled.
+
+        Parameters:
+        unique_id (str): The unique id of the session.
+        spill (bool): Whether to spill the session to disk, if spilling is enabled.
+        """
+        with self.lock:
+            bot_backend = self.sessions.get(unique_id)
+            if bot_backend is None or bot_backend.in_turn:
+                return
+            del self.sessions[unique_id]
+            self.last_active.pop(unique_id, None)
+            self.memory.pop(unique_id, None)
+            self.counters['evicted'] += 1
+            # Queue the last messages before the lock is released, so a rehydration of the session waits for them
+            session_store = get_session_store(bot_backend.config)
+            if session_store is not None:
+                session_store.save(bot_backend)
+            spill = spill and (session_store is not None or self.spill_directory is not None)
+            if spill:
+                # Keep the bot backend reachable until it is spilled, so get() does not rehydrate a stale copy
+                spilling = (bot_backend, object())
+                self.spilling[unique_id] = spilling
+
+        if not spill:
+            bot_backend.close()
+            return
+        if session_store is None:
+            temp_path = f'{self._spill_path(unique_id)}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(bot_backend.to_state(), f, ensure_ascii=False)
+            os.replace(temp_path, self._spill_path(unique_id))
+        kernel_pool = get_kernel_pool(bot_backend.config)
+        if kernel_pool is not None:
+            kernel_pool.release(unique_id=unique_id, remove_work_dir=False)
+        with self.lock:
+            # A session taken back meanwhile keeps its spill file, which is only read once it is spilled again
+            if self.spilling.get(unique_id) is spilling:
+                del self.spilling[unique_id]
+                self.counters['spilled'] += 1
+
+    def reap(self):
+        """
+        Refresh the memory estimates, evict the sessions idle for longer than the idle timeout, and enforce the limits.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for unique_id, bot_backend in self.sessions.items():
+                self.memory[unique_id] = estimate_session_memory(bot_backend)
+            expired = [unique_id for unique_id, last_active in self.last_active.items()
+                       if now - last_active > self.idle_timeout and not self._in_turn(unique_id)]
+        for unique_id in expired:
+            self.evict(unique_id)
+        with self.lock:
+            candidates = self._over_limits()
+        for candidate in candidates:
+            self.evict(candidate)
+
+    def stats(self) -> Dict:
+        """
+        Return statistics about the live sessions.
+
+        Returns:
+        Dict: The number of live sessions, their total and largest estimated memory, the idle time of the least recently
+        active one, and the counters of created, evicted, spilled and rehydrated sessions.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'live_sessions': len(self.sessions),
+                'memory_bytes': sum(self.memory.values()),
+                'largest_session_bytes': max(self.memory.values(), default=0),
+                'oldest_idle_seconds': now - min(self.last_active.values(), default=now),
+                **self.counters
+            }
+
+    def _register(self, bot_backend: Union[BotBackend, None],
+                  rehydrated: bool = False) -> Tuple[BotBackend, List[str]]:
+        """
+        Register a bot backend as the most recently active session, creating a new session if there is none, and pick
+        the sessions to evict. A bot backend already registered for the session wins over one rehydrated concurrently.
+        Must be called with the lock held.
+
+        Parameters:
+        bot_backend (BotBackend): The bot backend of the session, or None to create a new session.
+        rehydrated (bool): Whether the bot backend was just rehydrated.
+
+        Returns:
+        Tuple[BotBackend, List[str]]: The bot backend of the session, and the unique ids of the sessions to evict.
+        """
+        if bot_backend is None:
+            bot_backend = BotBackend()
+            self.counters['created'] += 1
+        elif bot_backend.unique_id in self.sessions:
+            bot_backend = self.sessions[bot_backend.unique_id]
+        elif rehydrated:
+            self.counters['rehydrated'] += 1
+        if bot_backend.unique_id not in self.sessions:
+            self.sessions[bot_backend.unique_id] = bot_backend
+            self.memory[bot_backend.unique_id] = estimate_session_memory(bot_backend)
+        self.sessions.move_to_end(bot_backend.unique_id)
+        self.last_active[bot_backend.unique_id] = time.monotonic()
+        return bot_backend, self._over_limits(keep=bot_backend.unique_id)
+
+    def _over_limits(self, keep: str = None) -> List[str]:
+        """
+        Pick the least recently active sessions to evict so the number of sessions and their memory are back within
+        their limits. Must be called with the lock held.
+
+        Parameters:
+        keep (str): The unique id of a session that must not be evicted.
+
+        Returns:
+        List[str]: The unique ids of the sessions to evict.
+        """
+        sessions = len(self.sessions)
+        memory = sum(self.memory.values())
+        candidates = []
+        for unique_id in self.sessions:
+            if sessions <= self.max_sessions and memory <= self.max_memory_bytes:
+                break
+            if unique_id != keep and not self._in_turn(unique_id):
+                candidates.append(unique_id)
+                sessions -= 1
+                memory -= self.memory.get(unique_id, 0)
+        return candidates
+
+    def _in_turn(self, unique_id: str) -> bool:
+        """
+        Tell whether a session is in the middle of a turn. Must be called with the lock held.
+
+        Parameters:
+        unique_id (str): The unique id of the session.
+
+        Returns:
+        bool: True if a turn of the bot backend is running.
+        """
+        bot_backend = self.sessions.get(unique_id)
+        return bot_backend is not None and bot_backend.in_turn
+
+    def _rehydrate(self, unique_id: str) -> Union[BotBackend, None]:
+        """
+        Load a spilled session from its spill file, removing it, or else from the session store. Called without the
+        lock held.
+
+        Parameters:
+        unique_id (str): The unique id of the session.
+
+        Returns:
+        BotBackend: The rehydrated bot backend, or None if the session was neither spilled nor stored.
+        """
+        state = None
+        if self.spill_directory is not None:
+            path = self._spill_path(unique_id)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+            else:
+                os.remove(path)
+        if state is None:
+            session_store = get_session_store(get_config())
+            if session_store is not None:
+                state = session_store.load(unique_id)
+        if state is None:
+            return None
+        return BotBackend.from_state(state)
+
+    def _spill_path(self, unique_id: str) -> str:
+        """
+        Return the path of the spill file of a session.
+
+        Parameters:
+        unique_id (str): The unique id of the session.
+
+        Returns:
+        str: The path of the spill file.
+        """
+        return os.path.join(self.spill_directory, f'{os.path.basename(str(unique_id))}.json')
+
+    def _reap_forever(self):
+        """
+        Reap idle sessions periodically.
+        """
+        while True:
+            time.sleep(self.reap_interval)
+            self.reap()
+
+
+# Function to get the process-wide session manager
+def get_session_manager(config: Dict) -> SessionManager:
+    """
+    This function returns the session manager shared by the whole process, creating it on first use from the
+    'sessions' section of the configuration.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    SessionManager: The shared session manager.
+    """
+    global _session_manager
+    if _session_manager is None:
+        with _session_manager_lock:
+            if _session_manager is None:
+                _session_manager = SessionManager({**DEFAULT_SESSIONS_CONFIG, **config.get('sessions', {})})
+    return _session_manager
@@ -0,0 +1,317 @@
+from backend import *
+import queue
+import sqlite3
+import threading
+import time
+
+# Default settings of the session store, overridden by the 'session_store' section of the configuration
+DEFAULT_SESSION_STORE_CONFIG = {
+    'enabled': True,
+    'path': 'cache/sessions.sqlite3',
+    'batch_size': 1000,
+    'write_retries': 3
+}
+
+# Maximum time in seconds a load waits for the saves queued for its session
+LOAD_TIMEOUT_SECONDS = 10
+
+_session_store = None
+_session_store_configured = False
+_session_store_lock = threading.Lock()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    gpt_model_choice TEXT NOT NULL,
+    start_seq INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    name TEXT,
+    function_call TEXT,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+'''
+
+
+# Class for the durable session store
+class SessionStore:
+    """
+    Append-only log of the conversations of all sessions, kept in a SQLite database in WAL mode.
+
+    Each message added to a conversation is appended once, numbered by its position in the log of its session, and
+    the system message, shared by all sessions, is not stored. Restarting a session does not delete anything: its
+    conversation starts again further along its log. Saving only queues the new messages, and a background thread
+    writes everything queued in one transaction, so the chat turn never waits for the disk and a busy process commits
+    many turns at once. A session is loaded back from its unique_id with one range scan of the primary key, so opening
+    the store and rehydrating a session take the same time however many turns are stored.
+
+    The position of a conversation in the log is kept by its bot backend, in store_cursor, so a bot backend evicted
+    from memory and the one rehydrated in its place never share it. A transaction that keeps failing after
+    write_retries retries moves the cursors of its bot backends back, so their next save queues the lost messages
+    again.
+    """
+
+    def __init__(self, path: str, batch_size: int, write_retries: int):
+        """
+        Initialize the store, creating the database if needed, and start the writer thread.
+
+        Parameters:
+        path (str): The path of the SQLite database.
+        batch_size (int): The maximum number of queued saves written in one transaction.
+        write_retries (int): The number of times a failed transaction is retried before its saves are given up.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.write_retries = write_retries
+        self.pending: Dict[str, int] = {}
+        self.counters = {'saved_messages': 0, 'transactions': 0, 'errors': 0, 'dropped_saves': 0}
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+        self.read_lock = threading.Lock()
+        self.tasks = queue.Queue()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.read_connection = self._connect()
+        self.read_connection.executescript(SCHEMA)
+
+        writer = threading.Thread(target=self._write_forever, name='session-store-writer', daemon=True)
+        writer.start()
+
+    def save(self, bot_backend: BotBackend):
+        """
+        Queue the messages added to the conversation of a bot backend since it was last saved.
+
+        Parameters:
+        bot_backend (BotBackend): The bot backend.
+        """
+        conversation = bot_backend.conversation
+        with self.lock:
+            cursor = bot_backend.store_cursor
+            start_seq, saved = cursor
+            rows = [
+                (bot_backend.unique_id, start_seq + index - 1, message.role, message.content, message.name,
+                 None if message.function_call is None else json.dumps(message.function_call, ensure_ascii=False))
+                for index, message in enumerate(conversation[saved:], start=saved)
+            ]
+            cursor[1] = saved + len(rows)
+            self.pending[bot_backend.unique_id] = self.pending.get(bot_backend.unique_id, 0) + 1
+            self.tasks.put((bot_backend, saved,
+                            (bot_backend.unique_id, bot_backend.gpt_model_choice, start_seq, time.time()), rows))
+
+    def reset(self, bot_backend: BotBackend):
+        """
+        Start the conversation of a restarted bot backend again after the messages already stored, keeping them in the
+        log.
+
+        Parameters:
+        bot_backend (BotBackend): The restarted bot backend.
+        """
+        with self.lock:
+            cursor = bot_backend.store_cursor
+            cursor[0] += cursor[1] - 1
+            cursor[1] = 1
+        self.save(bot_backend)
+
+    def load(self, unique_id: str) -> Union[Dict, None]:
+        """
+        Load the current conversation of a session, after the saves already queued for it are written, or after
+        LOAD_TIMEOUT_SECONDS if they are still not. The saves of the other sessions are not waited for, and are not
+        blocked while the session is read.
+
+        Parameters:
+        unique_id (str): The unique id of the session.
+
+        Returns:
+        Dict: The state of the session, as returned by BotBackend.to_state with its store_cursor, or None if the session
+        is not stored.
+        """
+        with self.written:
+            self.written.wait_for(lambda: not self.pending.get(unique_id), timeout=LOAD_TIMEOUT_SECONDS)
+        with self.read_lock:
+            session = self.read_connection.execute(
+                'SELECT gpt_model_choice, start_seq FROM sessions WHERE session_id = ?', (unique_id,)
+            ).fetchone()
+            if session is None:
+                return None
+            gpt_model_choice, start_seq = session
+            rows = self.read_connection.execute(
+                'SELECT role, content, name, function_call FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq',
+                (unique_id, start_seq)
+            ).fetchall()
+
+        conversation = [system_message.to_dict()]
+        for role, content, name, function_call in rows:
+            message = {'role': role, 'content': content}
+            if name is not None:
+                message['name'] = name
+            if function_call is not None:
+                message['function_call'] = json.loads(function_call)
+            conversation.append(message)
+        return {'unique_id': unique_id, 'gpt_model_choice': gpt_model_choice, 'conversation': conversation,
+                'store_cursor': [start_seq, len(rows) + 1]}
+
+    def flush(self):
+        """
+        Wait until every queued save has been written.
+        """
+        self.tasks.join()
+
+    def stats(self) -> Dict:
+        """
+        Return the number of saved messages, of transactions, of failed transactions and of saves given up after
+        them, and the pending saves.
+
+        Returns:
+        Dict: The store statistics.
+        """
+        with self.lock:
+            return {**self.counters, 'pending': self.tasks.qsize()}
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the database in WAL mode, so reads are not blocked by the writer.
+
+        Returns:
+        sqlite3.Connection: The connection.
+        """
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _write_forever(self):
+        """
+        Write the queued saves, each time in one transaction with the saves queued while the previous one committed.
+        """
+        connection = self._connect()
+        while True:
+            tasks = [self.tasks.get()]
+            while len(tasks) < self.batch_size:
+                try:
+                    tasks.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for attempt in range(self.write_retries + 1):
+                    try:
+                        self._write(connection, tasks)
+                    except Exception:
+                        with self.lock:
+                            self.counters['errors'] += 1
+                        if attempt < self.write_retries:
+                            time.sleep(0.1 * 2 ** attempt)
+                        continue
+                    with self.lock:
+                        self.counters['saved_messages'] += sum(len(rows) for _, _, _, rows in tasks)
+                        self.counters['transactions'] += 1
+                    break
+                else:
+                    self._rewind(tasks)
+            finally:
+                with self.written:
+                    for bot_backend, _, _, _ in tasks:
+                        self.pending[bot_backend.unique_id] -= 1
+                        if not self.pending[bot_backend.unique_id]:
+                            del self.pending[bot_backend.unique_id]
+                    self.written.notify_all()
+                for _ in tasks:
+                    self.tasks.task_done()
+
+    def _write(self, connection: sqlite3.Connection, tasks: List[Tuple]):
+        """
+        Write queued saves in one transaction.
+
+        Parameters:
+        connection (sqlite3.Connection): The connection of the writer thread.
+        tasks (List[Tuple]): The queued saves.
+        """
+        with connection:
+            for _, _, session, rows in tasks:
+                connection.execute(
+                    'INSERT INTO sessions (session_id, gpt_model_choice, start_seq, updated_at) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (session_id) DO UPDATE SET '
+                    'gpt_model_choice = excluded.gpt_model_choice, start_seq = excluded.start_seq, '
+                    'updated_at = excluded.updated_at',
+                    session
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO messages (session_id, seq, role, content, name, function_call) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+
+    def _rewind(self, tasks: List[Tuple]):
+        """
+        Move the cursors of the bot backends of saves that could not be written back to the first message they held, so
+        their next save queues these messages again. A cursor that was reset since is left alone.
+
+        Parameters:
+        tasks (List[Tuple]): The saves given up.
+        """
+        with self.lock:
+            for bot_backend, saved, (_, _, start_seq, _), _ in tasks:
+                cursor = bot_backend.store_cursor
+                if cursor[0] == start_seq:
+                    cursor[1] = min(cursor[1], saved)
+            self.counters['dropped_saves'] += len(tasks)
+
+
+# Function to get the process-wide session store
+def get_session_store(config: Dict) -> Union[SessionStore, None]:
+    """
+    This function returns the session store shared by the whole process, creating it on first use from the
+    'session_store' section of the configuration, or None if it is disabled.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    SessionStore: The shared session store, or None if it is disabled.
+    """
+    global _session_store, _session_store_configured
+    if _session_store_configured:
+        return _session_store
+    with _session_store_lock:
+        if not _session_store_configured:
+            session_store_config = {**DEFAULT_SESSION_STORE_CONFIG, **config.get('session_store', {})}
+            if session_store_config['enabled']:
+                _session_store = SessionStore(path=session_store_config['path'],
+                                              batch_size=session_store_config['batch_size'],
+                                              write_retries=session_store_config['write_retries'])
+            _session_store_configured = True
+    return _session_store
+
+
+# Function to save the new messages of a session
+def save_session(bot_backend: BotBackend):
+    """
+    This function queues the messages added to the conversation of a bot backend since it was last saved, if the
+    session store is enabled.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend.
+    """
+    session_store = get_session_store(bot_backend.config)
+    if session_store is not None:
+        session_store.save(bot_backend)
+
+
+# Function to restart the stored conversation of a session
+def reset_session(bot_backend: BotBackend):
+    """
+    This function starts the stored conversation of a restarted bot backend again, if the session store is enabled.
+    The messages of the previous conversation are kept in the log.
+
+    Parameters:
+    bot_backend (BotBackend): The restarted bot backend.
+    """
+    session_store = get_session_store(bot_backend.config)
+    if session_store is not None:
+        session_store.reset(bot_backend)
@@ -0,0 +1,387 @@
+import hashlib
+import json
+import threading
+from typing import *
+
+# Default settings of the single-flight layer, overridden by the 'single_flight' section of the configuration
+DEFAULT_SINGLE_FLIGHT_CONFIG = {
+    'enabled': True
+}
+
+_single_flight = None
+_single_flight_configured = False
+_single_flight_lock = threading.Lock()
+
+
+# Class for a shared synchronous stream
+class Flight:
+    """
+    Upstream stream of chunks shared by the subscribers of identical requests.
+
+    The chunks received are kept for the lifetime of the flight, so a subscriber joining late first gets every chunk
+    already received, then the live ones. There is no dedicated reader: whichever subscriber needs a chunk that has not
+    arrived yet reads it from the upstream stream while the others wait for it, so the stream keeps going as long as
+    one subscriber is reading it. Once the last subscriber leaves an unfinished flight, the upstream stream is closed.
+    """
+
+    def __init__(self, open_stream: Callable[[], Iterator], release: Callable[['Flight'], None]):
+        """
+        Initialize the flight.
+
+        Parameters:
+        open_stream (Callable[[], Iterator]): The function sending the request and returning its stream of chunks.
+        release (Callable[[Flight], None]): The function removing the flight from the registry once it is over.
+        """
+        self.open_stream = open_stream
+        self.release = release
+        self.upstream = None
+        self.chunks: List = []
+        self.done = False
+        self.error: Union[BaseException, None] = None
+        # The flight is created by the request that opens it, so subscribers joining before the request is sent wait
+        # for it instead of reading a stream that does not exist yet
+        self.reading = True
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+    def open(self):
+        """
+        Send the request. An error is raised to the caller and to every subscriber.
+        """
+        try:
+            self.upstream = iter(self.open_stream())
+        except BaseException as e:
+            self._finish(error=e)
+            raise
+        with self.condition:
+            self.reading = False
+            self.condition.notify_all()
+
+    def subscribe(self) -> Iterator:
+        """
+        Stream the chunks of the flight from the first one.
+
+        Returns:
+        Iterator: The stream of chunks.
+        """
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    while index >= len(self.chunks) and not self.done and self.reading:
+                        self.condition.wait()
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                    elif self.done:
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    else:
+                        self.reading = True
+                        chunk = None
+                if chunk is None:
+                    self._read()
+                    continue
+                index += 1
+                yield chunk
+        finally:
+            self._leave()
+
+    def _read(self):
+        """
+        Read the next chunk from the upstream stream and share it with the subscribers.
+        """
+        try:
+            chunk = next(self.upstream)
+        except StopIteration:
+            self._finish()
+            return
+        except BaseException as e:
+            self._finish(error=e)
+            return
+        with self.condition:
+            self.chunks.append(chunk)
+            self.reading = False
+            self.condition.notify_all()
+
+    def _finish(self, error: BaseException = None):
+        """
+        End the flight, removing it from the registry so new requests start their own.
+
+        Parameters:
+        error (BaseException): The error that ended the stream, or None if it finished.
+        """
+        self.release(self)
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.reading = False
+            self.condition.notify_all()
+
+    def _leave(self):
+        """
+        Unsubscribe, closing the upstream stream if nobody is left to read it.
+        """
+        with self.condition:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+        if abandoned:
+            self._finish(error=RuntimeError('The shared stream was abandoned by all its subscribers'))
+            if hasattr(self.upstream, 'close'):
+                self.upstream.close()
+
+
+# Class for a shared asynchronous stream
+class AsyncFlight:
+    """
+    Asynchronous counterpart of Flight, shared by the subscribers of one event loop.
+
+    The upstream stream is read by a task of its own rather than by a subscriber, so a subscriber cancelled while it
+    waits, for example when its browser tab is closed, does not interrupt the stream of the others.
+    """
+
+    def __init__(self, open_stream: Callable[[], Awaitable[AsyncIterator]], release: Callable[['AsyncFlight'], None]):
+        """
+        Initialize the flight.
+
+        Parameters:
+        open_stream (Callable[[], Awaitable[AsyncIterator]]): The coroutine function sending the request and returning
+        its stream of chunks.
+        release (Callable[[AsyncFlight], None]): The function removing the flight from the registry once it is over.
+        """
+        # asyncio is imported by the first asynchronous request, so importing this module stays fast
+        import asyncio
+        self.open_stream = open_stream
+        self.release = release
+        self.task: Union[asyncio.Task, None] = None
+        self.opened = False
+        self.chunks: List = []
+        self.done = False
+        self.error: Union[BaseException, None] = None
+        self.subscribers = 0
+        self.condition = asyncio.Condition()
+
+    async def open(self):
+        """
+        Send the request and wait until it is answered. An error is raised to the caller and to every subscriber.
+        """
+        import asyncio
+        self.task = asyncio.ensure_future(self._read())
+        try:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.opened or self.done)
+        except BaseException:
+            await self._leave()
+            raise
+        if not self.opened:
+            raise self.error
+
+    async def subscribe(self) -> AsyncIterator:
+        """
+        Stream the chunks of the flight from the first one.
+
+        Returns:
+        AsyncIterator: The stream of chunks.
+        """
+        index = 0
+        try:
+            while True:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                if index < len(self.chunks):
+                    index += 1
+                    yield self.chunks[index - 1]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+        finally:
+            await self._leave()
+
+    async def _read(self):
+        """
+        Send the request and share the chunks of its stream with the subscribers.
+        """
+        import asyncio
+        upstream = None
+        try:
+            upstream = await self.open_stream()
+            async with self.condition:
+                self.opened = True
+                self.condition.notify_all()
+            async for chunk in upstream:
+                async with self.condition:
+                    self.chunks.append(chunk)
+                    self.condition.notify_all()
+        except asyncio.CancelledError:
+            await self._finish(error=RuntimeError('The shared stream was abandoned by all its subscribers'))
+            if hasattr(upstream, 'aclose'):
+                await upstream.aclose()
+            raise
+        except Exception as e:
+            await self._finish(error=e)
+        else:
+            await self._finish()
+
+    async def _finish(self, error: BaseException = None):
+        """
+        End the flight, removing it from the registry so new requests start their own.
+
+        Parameters:
+        error (BaseException): The error that ended the stream, or None if it finished.
+        """
+        self.release(self)
+        async with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    async def _leave(self):
+        """
+        Unsubscribe, cancelling the reading task if nobody is left to read the stream.
+        """
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self.task.cancel()
+
+
+# Class for the single-flight layer
+class SingleFlight:
+    """
+    Registry of the streamed chat completions in flight, keyed by their arguments. An identical request sent while one
+    is in flight subscribes to its stream instead of sending another upstream request.
+    """
+
+    def __init__(self):
+        self.flights: Dict[Tuple, Union[Flight, AsyncFlight]] = {}
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'coalesced': 0}
+
+    @staticmethod
+    def make_key(kwargs_for_chat_completion: Dict) -> str:
+        """
+        Compute the key of a request.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request.
+
+        Returns:
+        str: The hexadecimal SHA-256 hash of the arguments.
+        """
+        payload = json.dumps(kwargs_for_chat_completion, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def in_flight(self, kwargs_for_chat_completion: Dict) -> bool:
+        """
+        Tell whether an identical request is in flight, in this thread's event loop if one is running.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request.
+
+        Returns:
+        bool: True if the request would subscribe to a stream in flight.
+        """
+        import asyncio
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self.lock:
+            return (loop, self.make_key(kwargs_for_chat_completion)) in self.flights
+
+    def stream(self, kwargs_for_chat_completion: Dict, open_stream: Callable[[], Iterator]) -> Iterator:
+        """
+        Stream the response of a request, sharing the stream of an identical request in flight.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request.
+        open_stream (Callable[[], Iterator]): The function sending the request and returning its stream of chunks.
+
+        Returns:
+        Iterator: The stream of chunks.
+        """
+        flight, leader = self._join((None, self.make_key(kwargs_for_chat_completion)), Flight, open_stream)
+        if leader:
+            flight.open()
+        return flight.subscribe()
+
+    async def astream(self, kwargs_for_chat_completion: Dict,
+                      open_stream: Callable[[], Awaitable[AsyncIterator]]) -> AsyncIterator:
+        """
+        Asynchronous counterpart of stream. Requests are only shared within an event loop.
+
+        Parameters:
+        kwargs_for_chat_completion (Dict): The arguments of the request.
+        open_stream (Callable[[], Awaitable[AsyncIterator]]): The coroutine function sending the request and returning
+        its stream of chunks.
+
+        Returns:
+        AsyncIterator: The stream of chunks.
+        """
+        import asyncio
+        key = (asyncio.get_running_loop(), self.make_key(kwargs_for_chat_completion))
+        flight, leader = self._join(key, AsyncFlight, open_stream)
+        if leader:
+            await flight.open()
+        return flight.subscribe()
+
+    def stats(self) -> Dict:
+        """
+        Return the number of streamed requests and of those served by a stream in flight.
+
+        Returns:
+        Dict: The counters and the number of flights.
+        """
+        with self.lock:
+            return {**self.counters, 'in_flight': len(self.flights)}
+
+    def _join(self, key: Tuple, flight_class: Type, open_stream: Callable) -> Tuple[Union[Flight, AsyncFlight], bool]:
+        """
+        Subscribe to the flight of a key, creating it if there is none.
+
+        Parameters:
+        key (Tuple): The event loop, or None, and the key of the request.
+        flight_class (Type): Flight or AsyncFlight.
+        open_stream (Callable): The function sending the request.
+
+        Returns:
+        Tuple[Union[Flight, AsyncFlight], bool]: The flight, and whether it was created by this request.
+        """
+        def release(flight):
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+        with self.lock:
+            self.counters['requests'] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = flight_class(open_stream=open_stream, release=release)
+            else:
+                self.counters['coalesced'] += 1
+            flight.subscribers += 1
+        return flight, leader
+
+
+# Function to get the process-wide single-flight layer
+def get_single_flight(config: Dict) -> Union[SingleFlight, None]:
+    """
+    This function returns the single-flight layer shared by all bot backends, creating it on first use, or None if it
+    is disabled in the 'single_flight' section of the configuration.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    SingleFlight: The shared single-flight layer, or None if it is disabled.
+    """
+    global _single_flight, _single_flight_configured
+    if _single_flight_configured:
+        return _single_flight
+    with _single_flight_lock:
+        if not _single_flight_configured:
+            if {**DEFAULT_SINGLE_FLIGHT_CONFIG, **config.get('single_flight', {})}['enabled']:
+                _single_flight = SingleFlight()
+            _single_flight_configured = True
+    return _single_flight
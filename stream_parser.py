@@ -0,0 +1,232 @@
+import json
+import re
+from typing import *
+
+# Parser states, in the order they are reached while reading '{"code": "..."}'
+_SEEK_OBJECT = 0
+_SEEK_KEY = 1
+_IN_KEY = 2
+_SEEK_COLON = 3
+_SEEK_VALUE = 4
+_IN_VALUE = 5
+_AFTER_VALUE = 6
+
+# Characters that interrupt a plain run of string characters inside the value
+_SPECIAL_CHARS = re.compile(r'[\\"]')
+
+# Single-character JSON escapes
+_SIMPLE_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class IncrementalCodeParser:
+    """
+    Incremental counterpart of functions.parse_json for streamed function call arguments.
+
+    The parser consumes the argument deltas as they arrive, keeping its position, the escape state and the decoded
+    value between calls, so every delta is scanned exactly once. It follows the same rules as parse_json: the value of
+    the first key is the code, and if the model wrote raw newlines inside it (non-standard JSON) the raw text is used
+    instead of the decoded one.
+    """
+
+    def __init__(self):
+        """
+        Initialize the parser with an empty state.
+        """
+        self._fragments: List[str] = []
+        self._raw_value: List[str] = []
+        self._decoded_value: List[str] = []
+        self._trailer: List[str] = []
+        self.reset()
+
+    def reset(self):
+        """
+        Return the parser to its empty state, so the arguments of the next function call can be fed to it. The lists
+        holding the fragments are emptied in place rather than allocated again.
+        """
+        self._state = _SEEK_OBJECT
+        self._fragments.clear()
+        self._raw_value.clear()
+        self._decoded_value.clear()
+        self._trailer.clear()
+        self._escape = ''
+        self._has_raw_newline = False
+        self._has_surrogate = False
+        self._error = False
+        self._code_cache = None
+
+    @property
+    def has_code(self) -> bool:
+        """
+        Whether the opening quote of the code value has been seen and the value is still decodable.
+
+        Returns:
+        bool: True if a (possibly empty) code value is available, False otherwise.
+        """
+        return self._state >= _IN_VALUE and (self._has_raw_newline or not self._error)
+
+    @property
+    def code(self) -> Union[str, None]:
+        """
+        The code decoded so far, equivalent to parse_json(function_args, finished=False).
+
+        Returns:
+        str: The code decoded so far.
+        None: If the code value has not started yet or cannot be decoded.
+        """
+        if not self.has_code:
+            return None
+        if self._code_cache is None:
+            if self._has_raw_newline:
+                self._code_cache = ''.join(self._raw_value).strip('\n')
+            else:
+                self._code_cache = self._join_decoded()
+        return self._code_cache
+
+    def feed(self, delta: str):
+        """
+        Consume a new delta of the function arguments.
+
+        Parameters:
+        delta (str): The new part of the function arguments string.
+        """
+        if not delta:
+            return
+        self._fragments.append(delta)
+        self._code_cache = None
+
+        index = 0
+        length = len(delta)
+        while index < length and self._state < _IN_VALUE:
+            char = delta[index]
+            index += 1
+            if self._state == _SEEK_OBJECT:
+                if char == '{':
+                    self._state = _SEEK_KEY
+            elif char == '"':
+                if self._state == _SEEK_KEY:
+                    self._state = _IN_KEY
+                elif self._state == _IN_KEY:
+                    self._state = _SEEK_COLON
+                elif self._state == _SEEK_VALUE:
+                    self._state = _IN_VALUE
+            elif char == ':' and self._state == _SEEK_COLON:
+                self._state = _SEEK_VALUE
+
+        if index < length:
+            rest = delta[index:] if index else delta
+            self._raw_value.append(rest)
+            if '\n' in rest:
+                self._has_raw_newline = True
+            if self._state == _IN_VALUE:
+                self._decode(rest)
+            else:
+                self._trailer.append(rest)
+
+    def finish(self) -> Union[str, None]:
+        """
+        Return the complete code once all deltas were fed, equivalent to parse_json(function_args, finished=True).
+
+        Returns:
+        str: The extracted code string.
+        None: If the function arguments cannot be parsed.
+        """
+        if self._state >= _IN_VALUE:
+            raw_value = ''.join(self._raw_value)
+            end_brace = raw_value.rfind('}')
+            end_quote = raw_value.rfind('"', 0, end_brace) if end_brace != -1 else -1
+            if end_quote != -1:
+                code_str = raw_value[:end_quote]
+                if '\n' in code_str:
+                    return code_str.strip('\n')
+            if self._state == _AFTER_VALUE and not self._error and ''.join(self._trailer).strip() == '}':
+                return self._join_decoded()
+        try:
+            return json.loads(''.join(self._fragments))['code']
+        except Exception:
+            return None
+
+    def _decode(self, text: str):
+        """
+        Decode a piece of the JSON string value, resuming any escape sequence left open by the previous delta.
+
+        Parameters:
+        text (str): The raw text following the opening quote of the value.
+        """
+        index = 0
+        length = len(text)
+        while index < length:
+            if self._escape:
+                index = self._continue_escape(text, index)
+                continue
+            match = _SPECIAL_CHARS.search(text, index)
+            if match is None:
+                self._decoded_value.append(text[index:])
+                return
+            start = match.start()
+            if start > index:
+                self._decoded_value.append(text[index:start])
+            if text[start] == '"':
+                self._state = _AFTER_VALUE
+                self._trailer.append(text[start + 1:])
+                return
+            self._escape = '\\'
+            index = start + 1
+
+    def _continue_escape(self, text: str, index: int) -> int:
+        """
+        Consume characters of a pending escape sequence.
+
+        Parameters:
+        text (str): The raw text being decoded.
+        index (int): The position of the next unread character.
+
+        Returns:
+        int: The position of the next unread character after the consumed ones.
+        """
+        if self._escape == '\\':
+            char = text[index]
+            if char == 'u':
+                self._escape = '\\u'
+            elif char in _SIMPLE_ESCAPES:
+                self._decoded_value.append(_SIMPLE_ESCAPES[char])
+                self._escape = ''
+            else:
+                self._error = True
+                self._escape = ''
+            return index + 1
+
+        needed = 6 - len(self._escape)
+        self._escape += text[index:index + needed]
+        index += min(needed, len(text) - index)
+        if len(self._escape) == 6:
+            try:
+                code_point = int(self._escape[2:], 16)
+            except ValueError:
+                self._error = True
+            else:
+                if 0xD800 <= code_point <= 0xDFFF:
+                    self._has_surrogate = True
+                self._decoded_value.append(chr(code_point))
+            self._escape = ''
+        return index
+
+    def _join_decoded(self) -> str:
+        """
+        Join the decoded fragments, combining UTF-16 surrogate pairs written as two \\u escapes.
+
+        Returns:
+        str: The decoded value.
+        """
+        decoded = ''.join(self._decoded_value)
+        if self._has_surrogate:
+            decoded = decoded.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
+        return decoded
@@ -0,0 +1,139 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import *
+from messages import Message, ROLE_FUNCTION, ROLE_SYSTEM
+
+# Tokens added by the API around every message, and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Tokens reserved for the note replacing the omitted messages
+TOKENS_PER_OMITTED_NOTE = 24
+
+# Average number of characters per token, used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+# Maximum number of token counts kept by count_text_tokens
+TOKEN_COUNT_CACHE_SIZE = 65536
+
+# Token counts of the texts counted recently, keyed by the digest of the text and the model name
+_token_counts: OrderedDict[Tuple[bytes, str], int] = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+# Function to get the tokenizer of a model
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    """
+    This function returns the tiktoken encoding of a model, or None if tiktoken is not installed. tiktoken is imported
+    on first use, so importing this module stays fast.
+
+    Parameters:
+    model_name (str): The name of the model.
+
+    Returns:
+    tiktoken.Encoding: The encoding of the model, or None.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+# Function to count the tokens of a text
+def count_text_tokens(text: str, model_name: str) -> int:
+    """
+    This function counts the tokens of a text for a model. The result is cached under a digest of the text, so the
+    messages of a conversation are only tokenized once, not on every turn, and the cache does not keep the texts
+    themselves alive. Without tiktoken the count is estimated from the length of the text.
+
+    Parameters:
+    text (str): The text to count.
+    model_name (str): The name of the model.
+
+    Returns:
+    int: The number of tokens of the text.
+    """
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    key = (hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), model_name)
+    with _token_counts_lock:
+        tokens = _token_counts.get(key)
+        if tokens is not None:
+            _token_counts.move_to_end(key)
+            return tokens
+    tokens = len(encoding.encode(text, disallowed_special=()))
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return tokens
+
+
+# Function to count the tokens of a message
+def count_message_tokens(message: Union[Message, Dict], model_name: str) -> int:
+    """
+    This function counts the tokens a message takes in the prompt, including the tokens added around it by the API.
+
+    Parameters:
+    message (Union[Message, Dict]): The message to count.
+    model_name (str): The name of the model.
+
+    Returns:
+    int: The number of tokens of the message.
+    """
+    tokens = TOKENS_PER_MESSAGE
+    for value in message.values():
+        if isinstance(value, str):
+            tokens += count_text_tokens(value, model_name)
+        elif isinstance(value, dict):
+            tokens += sum(count_text_tokens(item, model_name) for item in value.values() if isinstance(item, str))
+    return tokens
+
+
+# Function to fit a conversation into a token budget
+def window_conversation(conversation: List[Message], model_name: str, budget: Union[int, None]) -> List[Message]:
+    """
+    This function selects the messages of a conversation that fit into a token budget. The first message (the system
+    message) and the last message are always kept, then the most recent messages are added while they fit. A function
+    response is never kept without the assistant message calling the function, even if the pair exceeds the budget.
+    When older messages are dropped, a short system note tells the model how many were omitted.
+
+    Parameters:
+    conversation (List[Message]): The full conversation, starting with the system message.
+    model_name (str): The name of the model.
+    budget (int): The maximum number of prompt tokens, or None to send the whole conversation.
+
+    Returns:
+    List[Message]: The messages to send.
+    """
+    if budget is None or len(conversation) <= 2:
+        return conversation
+
+    first_message, last_message = conversation[0], conversation[-1]
+    used_tokens = (TOKENS_PER_REPLY + TOKENS_PER_OMITTED_NOTE + count_message_tokens(first_message, model_name)
+                   + count_message_tokens(last_message, model_name))
+    kept_start = len(conversation) - 1
+    while kept_start > 1:
+        message_tokens = count_message_tokens(conversation[kept_start - 1], model_name)
+        if used_tokens + message_tokens > budget:
+            break
+        used_tokens += message_tokens
+        kept_start -= 1
+    while kept_start > 1 and conversation[kept_start].role == ROLE_FUNCTION:
+        kept_start -= 1
+
+    if kept_start == 1:
+        return conversation
+
+    omitted_note = Message(
+        ROLE_SYSTEM, f'[{kept_start - 1} earlier messages of this conversation were omitted to fit the context window.]'
+    )
+    return [first_message, omitted_note] + conversation[kept_start:]
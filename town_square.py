@@ -0,0 +1,226 @@
+from functions import *
+import asyncio
+import queue
+import threading
+
+# Default settings of the town square mode, overridden by the 'town_square' section of the configuration
+DEFAULT_TOWN_SQUARE_CONFIG = {
+    'parallel': True,
+    'experts': 3,
+    'merge': True
+}
+
+# Perspectives given to the experts, so the concurrent completions do not all argue the same position
+EXPERT_PERSPECTIVES = [
+    'argue for the most ambitious approach to my goal',
+    'challenge the plan by focusing on risks, constraints and what could go wrong',
+    'look for the simplest practical path and the first concrete step',
+    'bring an unexpected angle from a neighbouring domain',
+    'focus on how to measure progress and know when the goal is reached',
+]
+
+# Instruction sent to each expert of the town square debate
+EXPERT_INSTRUCTION = '''The user has summoned a /ts town square debate. You are Synapse_CoR expert {number} of {count}.
+Initialize yourself as a single expert agent suited to the goal, whose role is to {perspective}.
+Speak only as this expert, starting with your [emoji]:, in a few short paragraphs, and do not write the other experts' parts.'''
+
+# Instruction sent to Professor Synapse to merge the debate
+MERGE_INSTRUCTION = '''The {count} experts of the town square debate have spoken above.
+🧙🏾‍♂️, weigh their arguments, state where they agree and disagree, and recommend the next step.'''
+
+
+# Function to get the town square configuration
+def get_town_square_config(config: Dict) -> Dict:
+    """
+    This function merges the 'town_square' section of the configuration with the default settings.
+
+    Parameters:
+    config (Dict): The configuration dictionary.
+
+    Returns:
+    Dict: The town square settings.
+    """
+    return {**DEFAULT_TOWN_SQUARE_CONFIG, **config.get('town_square', {})}
+
+
+# Function to detect a town square turn
+def is_town_square_turn(bot_backend: BotBackend) -> bool:
+    """
+    This function checks whether the bot backend is about to answer a /ts command that should be run in parallel.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend instance.
+
+    Returns:
+    bool: True if the last message is a /ts command from the user and the parallel mode is enabled.
+    """
+    if bot_backend.finish_reason != 'new_input' or not get_town_square_config(bot_backend.config)['parallel']:
+        return False
+    last_message = bot_backend.conversation[-1]
+    return last_message.role == ROLE_USER and last_message.content.lstrip().startswith('/ts')
+
+
+# Class for a parallel town square debate
+class TownSquare:
+    """
+    Runs the experts of a /ts town square debate as concurrent completions.
+
+    Each expert gets its own row in the history, and the chunks of the experts are accumulated into their rows in the
+    order they arrive, so the wall-clock time of the debate is the time of the slowest expert. Once every expert has
+    finished, their replies are added to the conversation, followed, if enabled, by an instruction for Professor
+    Synapse to merge the debate, which the regular bot loop then answers. An expert whose completion failed shows its
+    error in its row only: its reply is left out of the conversation and of the merge.
+    """
+
+    def __init__(self, bot_backend: BotBackend, history: List, use_cache: bool = True):
+        """
+        Initialize the debate and add a history row for each expert.
+
+        Parameters:
+        bot_backend (BotBackend): The bot backend instance.
+        history (List): The history of the conversation.
+        use_cache (bool): Whether the completions of the experts may be answered from the response cache.
+        """
+        town_square_config = get_town_square_config(bot_backend.config)
+        self.bot_backend = bot_backend
+        self.history = history
+        self.use_cache = use_cache
+        self.count = town_square_config['experts']
+        self.merge = town_square_config['merge']
+        self.buffers = [ChunkBuffer() for _ in range(self.count)]
+        self.errors: List[Union[Exception, None]] = [None] * self.count
+
+        if history[-1][0] is None:
+            history.append([None, ''])
+        else:
+            history[-1][1] = ''
+        self.rows = [history[-1]]
+        for _ in range(self.count - 1):
+            history.append([None, ''])
+            self.rows.append(history[-1])
+
+        conversation = bot_backend.windowed_conversation()
+        self.expert_messages = [
+            conversation + [Message(ROLE_SYSTEM, EXPERT_INSTRUCTION.format(
+                number=index + 1, count=self.count, perspective=EXPERT_PERSPECTIVES[index % len(EXPERT_PERSPECTIVES)]
+            ))]
+            for index in range(self.count)
+        ]
+
+    def stream(self) -> Iterator[Dict]:
+        """
+        Run the expert completions in worker threads and accumulate their chunks as they arrive. If the caller stops
+        iterating, the worker threads stop at their next chunk and close their streams.
+
+        Returns:
+        Iterator[Dict]: The chunks of all experts, interleaved in arrival order.
+        """
+        chunks = queue.Queue()
+        stopped = threading.Event()
+
+        def run_expert(index):
+            try:
+                response = chat_completion(bot_backend=self.bot_backend, messages=self.expert_messages[index],
+                                           use_cache=self.use_cache)
+                try:
+                    for chunk in response:
+                        if stopped.is_set():
+                            break
+                        chunks.put((index, chunk))
+                finally:
+                    response.close()
+            except Exception as e:
+                chunks.put((index, e))
+            chunks.put((index, None))
+
+        for index in range(self.count):
+            threading.Thread(target=run_expert, args=(index,), name=f'town-square-expert-{index}', daemon=True).start()
+
+        try:
+            running = self.count
+            while running:
+                index, chunk = chunks.get()
+                if chunk is None:
+                    running -= 1
+                    continue
+                yield self._accumulate(index, chunk)
+        finally:
+            stopped.set()
+
+    async def astream(self) -> AsyncIterator[Dict]:
+        """
+        Asynchronous counterpart of stream, running the expert completions as tasks on the event loop, which are
+        cancelled if the caller stops iterating.
+
+        Returns:
+        AsyncIterator[Dict]: The chunks of all experts, interleaved in arrival order.
+        """
+        chunks = asyncio.Queue()
+
+        async def run_expert(index):
+            try:
+                response = await achat_completion(bot_backend=self.bot_backend, messages=self.expert_messages[index],
+                                                   use_cache=self.use_cache)
+                try:
+                    async for chunk in response:
+                        await chunks.put((index, chunk))
+                finally:
+                    await response.aclose()
+            except Exception as e:
+                await chunks.put((index, e))
+            await chunks.put((index, None))
+
+        tasks = [asyncio.ensure_future(run_expert(index)) for index in range(self.count)]
+        try:
+            running = self.count
+            while running:
+                index, chunk = await chunks.get()
+                if chunk is None:
+                    running -= 1
+                    continue
+                yield self._accumulate(index, chunk)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def sync_rows(self):
+        """
+        Write the replies received so far into the history rows of the experts.
+        """
+        for row, buffer, error in zip(self.rows, self.buffers, self.errors):
+            row[1] = buffer.getvalue() if error is None else f'{buffer.getvalue()}\n\nBackend error: {error}'
+
+    def finish(self):
+        """
+        Write the final replies into the history, add those of the experts that did not fail to the conversation, and
+        either request the merge pass or end the turn.
+        """
+        self.sync_rows()
+        replies = [buffer.getvalue() for buffer, error in zip(self.buffers, self.errors) if error is None]
+        for reply in replies:
+            self.bot_backend.conversation.append(Message(ROLE_ASSISTANT, reply))
+        if self.merge and replies:
+            self.bot_backend.conversation.append(Message(ROLE_SYSTEM, MERGE_INSTRUCTION.format(count=len(replies))))
+            self.bot_backend.update_finish_reason(finish_reason='new_input')
+        else:
+            self.bot_backend.update_finish_reason(finish_reason='stop')
+
+    def _accumulate(self, index: int, chunk) -> Dict:
+        """
+        Add the content of a chunk to the reply of an expert, or record the error raised by its completion.
+
+        Parameters:
+        index (int): The index of the expert.
+        chunk: The chunk received, or the exception raised by the completion.
+
+        Returns:
+        Dict: The chunk, or an empty chunk for an exception.
+        """
+        if isinstance(chunk, Exception):
+            self.errors[index] = chunk
+            return {'choices': []}
+        if chunk['choices']:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                self.buffers[index].append(content)
+        return chunk
@@ -1,52 +1,85 @@
 from parse_response import *
-import gradio as gr
+from town_square import TownSquare, is_town_square_turn
+from session_manager import get_session_manager
+from session_store import reset_session, save_session
+from model_router import route_turn
+from rate_limiter import aqueue_positions, queue_message, queue_positions
+from metrics import get_metrics
+import asyncio
+import concurrent.futures
+import time
 
 # Initialize the state dictionary
-def initialization(state_dict: Dict) -> None:
+def initialization(state_dict: Dict, session_id: str = None) -> List:
     """
     This function initializes the state dictionary and the bot backend.
     It also creates a cache directory if it doesn't exist and removes the OPENAI_API_KEY from the environment variables.
+    Given the unique id of an earlier session, the session is resumed, rehydrated from the session store if needed.
 
     Parameters:
     state_dict (Dict): The state dictionary to be initialized.
+    session_id (str): The unique id of the session to resume, or None for a new session.
 
     Returns:
-    None
+    List: The history of the conversation of the session.
     """
     # Create a cache directory if it doesn't exist
     if not os.path.exists('cache'):
         os.mkdir('cache')
     # Initialize the bot backend if it's not already initialized
-    if state_dict["bot_backend"] is None:
-        state_dict["bot_backend"] = BotBackend()
-        # Remove the OPENAI_API_KEY from the environment variables
-        if 'OPENAI_API_KEY' in os.environ:
-            del os.environ['OPENAI_API_KEY']
+    if state_dict["session_id"] is None:
+        state_dict["session_id"] = session_id
+    return conversation_history(get_bot_backend(state_dict))
+
+# Rebuild the chat history of a conversation
+def conversation_history(bot_backend: BotBackend) -> List:
+    """
+    This function rebuilds the chat history shown by the UI from the messages of the user and the replies of the
+    assistant in the conversation of a bot backend, for a resumed session.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend.
+
+    Returns:
+    List: The history of the conversation.
+    """
+    history = []
+    for message in bot_backend.conversation:
+        if message.role == ROLE_USER:
+            history.append([message.content, None])
+        elif message.role == ROLE_ASSISTANT and message.content:
+            if history and history[-1][1] is None:
+                history[-1][1] = message.content
+            else:
+                history.append([None, message.content])
+    return history
 
 # Get the bot backend from the state dictionary
 def get_bot_backend(state_dict: Dict) -> BotBackend:
     """
-    This function retrieves the bot backend from the state dictionary.
-    If the bot backend is not already initialized, it initializes it and removes the OPENAI_API_KEY from the environment variables.
+    This function retrieves the bot backend of the session from the session manager, which rehydrates it if it was
+    spilled to disk. If the session has no bot backend yet, one is created and the OPENAI_API_KEY is removed from the
+    environment variables.
 
     Parameters:
-    state_dict (Dict): The state dictionary from which the bot backend is retrieved.
+    state_dict (Dict): The state dictionary holding the unique id of the session.
 
     Returns:
-    BotBackend: The bot backend retrieved from the state dictionary.
+    BotBackend: The bot backend of the session.
     """
-    # Initialize the bot backend if it's not already initialized
-    if state_dict["bot_backend"] is None:
-        state_dict["bot_backend"] = BotBackend()
+    bot_backend = get_session_manager(get_config()).get(state_dict["session_id"])
+    # Remember the bot backend of a new session, or of a session that expired without being spilled
+    if state_dict["session_id"] != bot_backend.unique_id:
+        state_dict["session_id"] = bot_backend.unique_id
         # Remove the OPENAI_API_KEY from the environment variables
         if 'OPENAI_API_KEY' in os.environ:
-            del os.environ['OPENAI_API_KEY']    
-    return state_dict["bot_backend"]
+            del os.environ['OPENAI_API_KEY']
+    return bot_backend
 
 # Add text to the bot backend
 def add_text(state_dict: Dict, history: List, text: str) -> Tuple[List, Dict]:
     """
-    This function adds a text message to the bot backend and updates the history.
+    This function adds a text message to the bot backend, saves it to the session store, and updates the history.
 
     Parameters:
     state_dict (Dict): The state dictionary from which the bot backend is retrieved.
@@ -58,10 +91,12 @@ def add_text(state_dict: Dict, history: List, text: str) -> Tuple[List, Dict]:
     """
     bot_backend = get_bot_backend(state_dict)
     bot_backend.add_text_message(user_text=text)
+    save_session(bot_backend)
 
     # Add the text to the history
     history = history + [(text, None)]
 
+    import gradio as gr
     return history, gr.update(value="", interactive=False)
 
 # Restart the UI
@@ -75,6 +110,8 @@ def restart_ui(history: List) -> Tuple[List, Dict, Dict, Dict, Dict]:
     Returns:
     Tuple[List, Dict, Dict, Dict, Dict]: The cleared history and updates for the Gradio interface elements.
     """
+    import gradio as gr
+
     # Clear the history
     history.clear()
     return (
@@ -88,7 +125,8 @@ def restart_ui(history: List) -> Tuple[List, Dict, Dict, Dict, Dict]:
 # Restart the bot backend
 def restart_bot_backend(state_dict: Dict) -> None:
     """
-    This function restarts the bot backend by calling the restart method of the bot backend.
+    This function restarts the bot backend by calling the restart method of the bot backend, and starts its stored
+    conversation again.
 
     Parameters:
     state_dict (Dict): The state dictionary from which the bot backend is retrieved.
@@ -98,13 +136,95 @@ def restart_bot_backend(state_dict: Dict) -> None:
     """
     bot_backend = get_bot_backend(state_dict)
     bot_backend.restart()
+    reset_session(bot_backend)
+
+# Class to coalesce streamed chunks into UI updates
+class StreamThrottle:
+    """
+    Decides when the bot generator should yield the history to the UI while a response is streamed.
+
+    With coalescing enabled, chunks are batched and the history is yielded at most every stream_interval_ms
+    milliseconds or every stream_max_tokens chunks, whichever comes first. The history is always yielded when a chunk
+    carries a finish reason or the response must exit. With coalescing disabled, every chunk is yielded.
+    """
+
+    def __init__(self, ui_config: Dict):
+        """
+        Initialize the throttle from the 'ui' section of the configuration.
+
+        Parameters:
+        ui_config (Dict): The 'ui' section of the configuration.
+        """
+        self.enabled = ui_config.get('stream_coalescing', True)
+        self.interval = ui_config.get('stream_interval_ms', 50) / 1000
+        self.max_tokens = ui_config.get('stream_max_tokens', 16)
+        self.pending_tokens = 0
+        self.last_yield_time = time.monotonic()
+
+    def should_yield(self, chunk, whether_exit: bool) -> bool:
+        """
+        Account for a parsed chunk and tell whether the history should be yielded now.
+
+        Parameters:
+        chunk (dict): The chunk that was just parsed.
+        whether_exit (bool): The flag indicating whether to exit.
+
+        Returns:
+        bool: True if the history should be yielded, False if the chunk can be batched with the next ones.
+        """
+        self.pending_tokens += 1
+        now = time.monotonic()
+        finished = bool(chunk['choices']) and chunk['choices'][0]['finish_reason'] is not None
+        if (not self.enabled or whether_exit or finished or self.pending_tokens >= self.max_tokens
+                or now - self.last_yield_time >= self.interval):
+            self.pending_tokens = 0
+            self.last_yield_time = now
+            return True
+        return False
+
+
+# Function to wait for the images of a session to be written
+def wait_for_images(bot_backend: BotBackend):
+    """
+    This function waits until the images queued by the function responses of a session are on disk, so the history
+    never shows the path of an image that is still being written. With metrics enabled, the wait is observed.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend of the session.
+    """
+    futures = get_image_store(bot_backend.config).pending_writes(unique_id=bot_backend.unique_id)
+    if futures:
+        start = time.perf_counter()
+        concurrent.futures.wait(futures)
+        metrics = get_metrics(bot_backend.config)
+        if metrics is not None:
+            metrics.observe('wiztalk_image_wait_seconds', time.perf_counter() - start)
+
+
+# Asynchronous function to wait for the images of a session to be written
+async def await_images(bot_backend: BotBackend):
+    """
+    This function is the asynchronous counterpart of wait_for_images. It does not block the event loop.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend of the session.
+    """
+    futures = get_image_store(bot_backend.config).pending_writes(unique_id=bot_backend.unique_id)
+    if futures:
+        start = time.perf_counter()
+        await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+        metrics = get_metrics(bot_backend.config)
+        if metrics is not None:
+            metrics.observe('wiztalk_image_wait_seconds', time.perf_counter() - start)
+
 
 # Main bot function
 def bot(state_dict: Dict, history: List) -> List:
     """
-    This function runs the bot backend while the finish reason is 'new_input'. It gets the response from the chat completion,
-    parses the response, updates the history, and yields the updated history. If the parsed response indicates to exit, the function
-    will terminate with an exit code of -1.
+    This function runs a turn of the bot backend of the session with run_bot and yields the updated history. With
+    metrics enabled, the time the UI takes to consume each update is observed. The bot backend is marked in turn, so
+    the session manager does not evict it, and the messages of the turn are saved to the session store once it ends,
+    even if it fails.
 
     Parameters:
     state_dict (Dict): The state dictionary from which the bot backend is retrieved.
@@ -114,9 +234,54 @@ def bot(state_dict: Dict, history: List) -> List:
     List: The updated history of the conversation.
     """
     bot_backend = get_bot_backend(state_dict)
+    bot_backend.in_turn = True
+    try:
+        updates = run_bot(bot_backend=bot_backend, history=history)
+        metrics = get_metrics(bot_backend.config)
+        if metrics is not None:
+            updates = metrics.instrument_yields(updates)
+        yield from updates
+    finally:
+        bot_backend.in_turn = False
+        save_session(bot_backend)
+
 
-    # Keep running the bot while the finish reason is 'new_input'
-    while bot_backend.finish_reason in ('new_input'):
+# Function to run a turn of the bot
+def run_bot(bot_backend: BotBackend, history: List, use_cache: bool = True) -> Iterator[List]:
+    """
+    This function runs the bot backend while the finish reason is 'new_input' or 'function_call'. It gets the response from the chat completion,
+    parses the response, updates the history, and yields the updated history. Chunks are coalesced into UI updates according
+    to the 'ui' section of the configuration. A /ts command is answered by concurrent expert completions, see TownSquare.
+    With routing enabled, the model answering the turn is picked first, see ModelRouter. A request over the rate limit
+    of its model waits in the queue of the model, and its position is shown in the chat meanwhile, unless it is answered
+    from the response cache or shares the stream of an identical request in flight.
+    If the parsed response indicates to exit, the error is shown in the chat and a RuntimeError ends the turn. The images
+    output by executed code are written in the background, and the history is only yielded once they are on disk.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend of the session.
+    history (List): The history of the conversation.
+    use_cache (bool): Whether the completions of the turn may be answered from, and stored in, the response cache.
+
+    Returns:
+    Iterator[List]: The updated history of the conversation.
+    """
+    # Pick the model answering the turn, if routing is enabled
+    route_turn(bot_backend)
+
+    # Run the experts of a /ts town square debate concurrently
+    if is_town_square_turn(bot_backend):
+        town_square = TownSquare(bot_backend=bot_backend, history=history, use_cache=use_cache)
+        throttle = StreamThrottle(ui_config=bot_backend.config.get('ui', {}))
+        for chunk in town_square.stream():
+            if throttle.should_yield(chunk=chunk, whether_exit=False):
+                town_square.sync_rows()
+                yield history
+        town_square.finish()
+        yield history
+
+    # Keep running the bot while the finish reason is 'new_input' or 'function_call'
+    while bot_backend.finish_reason in ('new_input', 'function_call'):
         if history[-1][0] is None:
             history.append(
                 [None, ""]
@@ -124,20 +289,140 @@ def bot(state_dict: Dict, history: List) -> List:
         else:
             history[-1][1] = ""
 
+        # Wait for the rate limit of the model, showing the position of the request in the queue
+        kwargs_for_chat_completion = prepare_chat_completion(bot_backend)
+        ticket = admit_chat_completion(
+            bot_backend=bot_backend, kwargs_for_chat_completion=kwargs_for_chat_completion, use_cache=use_cache
+        )
+        if ticket is not None:
+            for position in queue_positions(ticket):
+                history[-1][1] = queue_message(bot_backend=bot_backend, position=position)
+                yield history
+            history[-1][1] = ""
+
         # Get the response from the chat completion
-        response = chat_completion(bot_backend=bot_backend)
+        response = chat_completion(bot_backend=bot_backend, use_cache=use_cache, admitted=ticket is not None,
+                                   kwargs_for_chat_completion=kwargs_for_chat_completion)
+        throttle = StreamThrottle(ui_config=bot_backend.config.get('ui', {}))
         # Parse the response and update the history
         for chunk in response:
             history, whether_exit = parse_response(
                 chunk=chunk,
                 history=history,
-                bot_backend=bot_backend
+                bot_backend=bot_backend,
+                sync_history=False
             )
-            yield history
-            # Exit if the parsed response indicates to exit
+            if throttle.should_yield(chunk=chunk, whether_exit=whether_exit):
+                bot_backend.sync_content_row()
+                wait_for_images(bot_backend)
+                yield history
+            # End the turn with an error if the parsed response indicates to exit, once the error has been shown
             if whether_exit:
-                exit(-1)
+                raise RuntimeError(f'The turn was aborted: {history[-1][1]}')
 
+    bot_backend.sync_content_row()
+    wait_for_images(bot_backend)
+    yield history
+
+
+# Asynchronous main bot function
+async def abot(state_dict: Dict, history: List) -> AsyncGenerator[List, None]:
+    """
+    This function is the asynchronous counterpart of bot. It streams the response with achat_completion, so an active chat
+    does not hold a worker thread while the response is generated and one event loop can serve many chats at once. The
+    bot backend is retrieved in a worker thread, since the session manager may read it from disk or evict others.
+
+    Parameters:
+    state_dict (Dict): The state dictionary from which the bot backend is retrieved.
+    history (List): The history of the conversation.
+
+    Returns:
+    AsyncGenerator[List, None]: The updated history of the conversation.
+    """
+    bot_backend = await asyncio.to_thread(get_bot_backend, state_dict)
+    bot_backend.in_turn = True
+    try:
+        updates = arun_bot(bot_backend=bot_backend, history=history)
+        metrics = get_metrics(bot_backend.config)
+        if metrics is not None:
+            updates = metrics.ainstrument_yields(updates)
+        async for update in updates:
+            yield update
+    finally:
+        bot_backend.in_turn = False
+        save_session(bot_backend)
+
+
+# Asynchronous function to run a turn of the bot
+async def arun_bot(bot_backend: BotBackend, history: List, use_cache: bool = True) -> AsyncGenerator[List, None]:
+    """
+    This function is the asynchronous counterpart of run_bot. The code of a function call is executed in a worker
+    thread, see aparse_response, and the writes of its images are awaited, so neither blocks the event loop.
+
+    Parameters:
+    bot_backend (BotBackend): The bot backend of the session.
+    history (List): The history of the conversation.
+    use_cache (bool): Whether the completions of the turn may be answered from, and stored in, the response cache.
+
+    Returns:
+    AsyncGenerator[List, None]: The updated history of the conversation.
+    """
+    # Pick the model answering the turn, if routing is enabled
+    route_turn(bot_backend)
+
+    # Run the experts of a /ts town square debate concurrently
+    if is_town_square_turn(bot_backend):
+        town_square = TownSquare(bot_backend=bot_backend, history=history, use_cache=use_cache)
+        throttle = StreamThrottle(ui_config=bot_backend.config.get('ui', {}))
+        async for chunk in town_square.astream():
+            if throttle.should_yield(chunk=chunk, whether_exit=False):
+                town_square.sync_rows()
+                yield history
+        town_square.finish()
+        yield history
+
+    # Keep running the bot while the finish reason is 'new_input' or 'function_call'
+    while bot_backend.finish_reason in ('new_input', 'function_call'):
+        if history[-1][0] is None:
+            history.append(
+                [None, ""]
+            )
+        else:
+            history[-1][1] = ""
+
+        # Wait for the rate limit of the model, showing the position of the request in the queue
+        kwargs_for_chat_completion = prepare_chat_completion(bot_backend)
+        ticket = admit_chat_completion(
+            bot_backend=bot_backend, kwargs_for_chat_completion=kwargs_for_chat_completion, use_cache=use_cache
+        )
+        if ticket is not None:
+            async for position in aqueue_positions(ticket):
+                history[-1][1] = queue_message(bot_backend=bot_backend, position=position)
+                yield history
+            history[-1][1] = ""
+
+        # Get the response from the chat completion
+        response = await achat_completion(bot_backend=bot_backend, use_cache=use_cache, admitted=ticket is not None,
+                                          kwargs_for_chat_completion=kwargs_for_chat_completion)
+        throttle = StreamThrottle(ui_config=bot_backend.config.get('ui', {}))
+        # Parse the response and update the history
+        async for chunk in response:
+            history, whether_exit = await aparse_response(
+                chunk=chunk,
+                history=history,
+                bot_backend=bot_backend,
+                sync_history=False
+            )
+            if throttle.should_yield(chunk=chunk, whether_exit=whether_exit):
+                bot_backend.sync_content_row()
+                await await_images(bot_backend)
+                yield history
+            # End the turn with an error if the parsed response indicates to exit, once the error has been shown
+            if whether_exit:
+                raise RuntimeError(f'The turn was aborted: {history[-1][1]}')
+
+    bot_backend.sync_content_row()
+    await await_images(bot_backend)
     yield history
 
 
@@ -147,15 +432,20 @@ if __name__ == '__main__':
     This is the main function that gets executed when the script is run directly.
     It gets the configuration, creates a Gradio interface, and starts the interface.
     """
+    # Gradio is only needed to build the interface, so importing this module stays fast
+    import gradio as gr
+
     # Get the configuration
     config = get_config()
+    # Start pre-warming the Jupyter kernels if code execution is enabled
+    get_kernel_pool(config)
     # Create a Gradio interface
     with gr.Blocks(theme=gr.themes.Base()) as block:
         """
         Reference: https://www.gradio.app/guides/creating-a-chatbot-fast
         """
         # UI components
-        state = gr.State(value={"bot_backend": None})
+        state = gr.State(value={"session_id": None})
         with gr.Tab("WizTalk"):
             chatbot = gr.Chatbot([], elem_id="chatbot", label="Professor Synapse", show_label=False,height=550)
             with gr.Row():
@@ -165,19 +455,25 @@ if __name__ == '__main__':
                         placeholder="Enter text and press enter",
                         container=False
                     )
+            session_info = gr.Markdown()
                 
  
         # Components function binding
+        bot_fn = abot if config.get('ui', {}).get('async_streaming', True) else bot
         txt_msg = text_box.submit(add_text, [state, chatbot, text_box], [chatbot, text_box], queue=False).then(
-            bot, [state, chatbot], chatbot
+            bot_fn, [state, chatbot], chatbot
         )
         
         txt_msg.then(lambda: gr.update(interactive=True), None, [text_box], queue=False)
         
 
-        # Load the initialization function
-        block.load(fn=initialization, inputs=[state])
+        # Load the initialization function, resuming the session named by the 'session' query parameter if any
+        def load_session(state_dict: Dict, request: gr.Request) -> Tuple[List, str]:
+            history = initialization(state_dict, session_id=request.query_params.get('session'))
+            return history, f"Open this page with `?session={state_dict['session_id']}` to resume this chat."
+
+        block.load(fn=load_session, inputs=[state], outputs=[chatbot, session_info])
 
     # Start the Gradio interface
-    block.queue()
+    block.queue(concurrency_count=config.get('ui', {}).get('concurrency_count', 1))
     block.launch(inbrowser=True)